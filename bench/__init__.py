@@ -0,0 +1,6 @@
+"""ESI knife benchmarks.
+
+These are not installed with the package, run them from a checkout, ie:
+
+    python -m bench.throughput
+"""
@@ -0,0 +1,382 @@
+"""CPU and allocation microbenchmarks of the worker's processing stages.
+
+Run with `python -m bench.cpu`. Results are generated by the fake ESI
+(bench.fake_esi) for a Director of a corporation with 10k members by
+default, giving 500k corporation assets and 100k wallet journal entries,
+then each stage is timed on its own:
+
+    build_urls   the URLs to fetch, from the spec and fanned out IDs
+    get_ids      _get_all_ids over the results
+    apply_ids    _apply_all_ids with a name for every ID
+    get_names    _get_names batching, against a local fake ESI
+    encode       the legacy gzip and base64 document
+    write_data   storing the results as blobs and a manifest
+    get_data     reading them back
+
+Timings are the fastest and median of --repeat runs with the garbage
+collector disabled. Each stage is then run once more under tracemalloc for
+its peak traced memory and allocated blocks still held after it. The cache
+is redis if ESI_KNIFE_REDIS_HOST is reachable, otherwise in memory.
+
+Usage:
+    cpu [options]
+
+Options:
+    --members N        members in the generated corporation [default: 10000]
+    --repeat N         timed runs of each stage [default: 5]
+    --stages STAGES    comma separated stages to run, default all
+    --json FILE        also write the results to FILE
+    --compare FILE     compare with a previous --json FILE
+"""
+
+
+import gc
+import sys
+import json
+import time
+import hashlib
+import tracemalloc
+import subprocess
+
+try:
+    from urllib.parse import unquote
+except ImportError:
+    # python2
+    from urllib import unquote
+
+import docopt
+import ujson
+
+from esi_knife import CACHE
+from esi_knife import SCOPES
+from esi_knife import utils
+from esi_knife import worker
+from esi_knife import columnar
+
+from bench import fake_esi
+
+
+STAGES = (
+    "build_urls",
+    "get_ids",
+    "apply_ids",
+    "get_names",
+    "encode",
+    "write_data",
+    "get_data",
+)
+
+
+def _copy(data):
+    """Return a deep copy of JSON-able data."""
+
+    return ujson.loads(ujson.dumps(data))
+
+
+class Fixtures(object):
+    """Generated inputs for every stage, built once.
+
+    Args:
+        members: integer members in the generated corporation
+    """
+
+    def __init__(self, members):
+        self.fake = fake_esi.FakeESI(corp_size=members)
+        self.spec = fake_esi.spec()
+        self.scopes = unquote(SCOPES)
+        self.roles = fake_esi.ROLES
+        self.known_params = {
+            "character_id": fake_esi.CHARACTER_ID,
+            "corporation_id": fake_esi.CORPORATION_ID,
+            "alliance_id": fake_esi.ALLIANCE_ID,
+        }
+        self.all_params = self._all_params()
+        self.urls = worker.build_urls(
+            self.scopes,
+            self.roles,
+            self.spec,
+            self.known_params,
+            self.all_params,
+        )
+        self.results = {
+            url: columnar.compact(self.fake.generate(
+                url.split(self.spec["basePath"], 1)[1]
+            )[0])
+            for url in self.urls
+        }
+        self.ids = worker._get_all_ids(  # pylint: disable=W0212
+            self.results
+        )
+        self.names = {x: "Name {}".format(x) for x in self.ids}
+
+    def _ids(self, path, key):
+        """Return the key of each generated item for path."""
+
+        data, _, _ = self.fake.generate(path.format(**self.known_params))
+        return [item[key] for item in data]
+
+    def _all_params(self):
+        """Return the IDs to fan out on, as expand_params would."""
+
+        labels, _, _ = self.fake.generate(
+            "/characters/{character_id}/mail/labels/".format(
+                **self.known_params
+            )
+        )
+        return {
+            "character_id": {
+                "event_id": self._ids(
+                    "/characters/{character_id}/calendar/",
+                    "event_id",
+                ),
+                "contract_id": self._ids(
+                    "/characters/{character_id}/contracts/",
+                    "contract_id",
+                ),
+                "fitting_id": self._ids(
+                    "/characters/{character_id}/fittings/",
+                    "fitting_id",
+                ),
+                "label_id": [x["label_id"] for x in labels["labels"]],
+                "planet_id": self._ids(
+                    "/characters/{character_id}/planets/",
+                    "planet_id",
+                ),
+                "mail_id": self._ids(
+                    "/characters/{character_id}/mail/",
+                    "mail_id",
+                ),
+            },
+            "corporation_id": {
+                "observer_id": self._ids(
+                    "/corporation/{corporation_id}/mining/observers/",
+                    "observer_id",
+                ),
+                "contract_id": self._ids(
+                    "/corporations/{corporation_id}/contracts/",
+                    "contract_id",
+                ),
+                "starbase_id": self._ids(
+                    "/corporations/{corporation_id}/starbases/",
+                    "starbase_id",
+                ),
+                # one division, for the 10 * members journal entries
+                "division": [1],
+            },
+        }
+
+    def drop_blobs(self):
+        """Delete the stored blobs of the results, so they're written."""
+
+        keys = []
+        for data in self.results.values():
+            keys.extend(utils.blob_keys(hashlib.sha1(
+                ujson.dumps(data).encode("utf-8")
+            ).hexdigest()))
+        CACHE.delete_many(*keys)
+
+    def describe(self):
+        """Return a dictionary describing the generated inputs."""
+
+        return {
+            "members": self.fake.corp_size,
+            "urls": len(self.urls),
+            "ids": len(self.ids),
+            "json_mbytes": sum(
+                len(ujson.dumps(x)) for x in self.results.values()
+            ) / 1048576.0,
+        }
+
+
+def _stages(fixtures, url):
+    """Return {stage: (setup, run)}, setup's return is passed to run.
+
+    Args:
+        fixtures: Fixtures instance
+        url: string base URL of a fake ESI, for get_names
+    """
+
+    def _build_urls(_):
+        worker.build_urls(
+            fixtures.scopes,
+            fixtures.roles,
+            fixtures.spec,
+            fixtures.known_params,
+            fixtures.all_params,
+        )
+
+    def _get_names(_):
+        # resolved names are cached by the caller, there's none here
+        worker.ESI = url
+        worker._get_names(fixtures.ids)  # pylint: disable=W0212
+
+    return {
+        "build_urls": (lambda: None, _build_urls),
+        "get_ids": (
+            lambda: None,
+            lambda _: worker._get_all_ids(  # pylint: disable=W0212
+                fixtures.results
+            ),
+        ),
+        "apply_ids": (
+            lambda: _copy(fixtures.results),
+            lambda results: worker._apply_all_ids(  # pylint: disable=W0212
+                results,
+                fixtures.names,
+            ),
+        ),
+        "get_names": (lambda: None, _get_names),
+        "encode": (
+            lambda: None,
+            lambda _: [x for x in utils.encoded_chunks(fixtures.results)],
+        ),
+        "write_data": (
+            fixtures.drop_blobs,
+            lambda _: utils.write_data("bench", fixtures.results),
+        ),
+        "get_data": (
+            lambda: utils.write_data("bench", fixtures.results),
+            lambda _: utils.get_data("bench"),
+        ),
+    }
+
+
+def measure(setup, run, repeat):
+    """Time and trace the allocations of run(setup()).
+
+    Returns:
+        dictionary of the stage's measurements
+    """
+
+    times = []
+    for _ in range(repeat):
+        arg = setup()
+        gc.collect()
+        gc.disable()
+        try:
+            start = time.perf_counter()
+            run(arg)
+            times.append(time.perf_counter() - start)
+        finally:
+            gc.enable()
+        del arg
+
+    arg = setup()
+    gc.collect()
+    tracemalloc.start()
+    try:
+        before = tracemalloc.take_snapshot()
+        kept = run(arg)
+        _, peak = tracemalloc.get_traced_memory()
+        after = tracemalloc.take_snapshot()
+    finally:
+        tracemalloc.stop()
+    del kept
+
+    blocks = sum(x.count_diff for x in after.compare_to(before, "filename"))
+    times.sort()
+    return {
+        "min": times[0],
+        "median": times[len(times) // 2],
+        "peak_mbytes": peak / 1048576.0,
+        "blocks": blocks,
+    }
+
+
+def _commit():
+    """Return the current git commit, if we're in a checkout."""
+
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"],
+            stderr=subprocess.STDOUT,
+        ).decode("utf-8").strip()
+    except Exception:
+        return None
+
+
+def _print(results, previous=None):
+    """Print a table of results, with the change from previous."""
+
+    print("{:>11} {:>10} {:>10} {:>10} {:>10}{}".format(
+        "stage", "min s", "median s", "peak MB", "blocks",
+        "  vs {}".format(previous.get("commit")) if previous else "",
+    ))
+    for stage in STAGES:
+        if stage not in results["stages"]:
+            continue
+        row = results["stages"][stage]
+        change = ""
+        try:
+            before = previous["stages"][stage]
+        except (KeyError, TypeError):
+            pass
+        else:
+            change = "  {:+.1f}% time {:+.1f}% peak".format(
+                100.0 * (row["min"] - before["min"]) / before["min"],
+                100.0 * (row["peak_mbytes"] - before["peak_mbytes"]) /
+                (before["peak_mbytes"] or 1),
+            )
+        print("{:>11} {:>10.4f} {:>10.4f} {:>10.1f} {:>10d}{}".format(
+            stage,
+            row["min"],
+            row["median"],
+            row["peak_mbytes"],
+            row["blocks"],
+            change,
+        ))
+
+
+def main():
+    """Benchmark entrypoint."""
+
+    args = docopt.docopt(__doc__)
+    stages = args["--stages"].split(",") if args["--stages"] else STAGES
+    unknown = set(stages) - set(STAGES)
+    if unknown:
+        raise SystemExit("unknown stages: {}".format(", ".join(unknown)))
+
+    start = time.time()
+    fixtures = Fixtures(int(args["--members"]))
+    inputs = fixtures.describe()
+    print(
+        "{members} members, {urls} URLs, {ids} IDs, {json_mbytes:.1f}MB of "
+        "JSON generated in {seconds:.1f}s".format(
+            seconds=time.time() - start,
+            **inputs
+        ),
+        file=sys.stderr,
+    )
+
+    httpd, url = fake_esi.serve(fixtures.fake)
+    try:
+        functions = _stages(fixtures, url)
+        results = {
+            "commit": _commit(),
+            "inputs": inputs,
+            "stages": {
+                stage: measure(
+                    functions[stage][0],
+                    functions[stage][1],
+                    int(args["--repeat"]),
+                )
+                for stage in stages
+            },
+        }
+    finally:
+        httpd.shutdown()
+
+    previous = None
+    if args["--compare"]:
+        with open(args["--compare"], "r") as openprevious:
+            previous = json.load(openprevious)
+
+    _print(results, previous)
+
+    if args["--json"]:
+        with open(args["--json"], "w") as openjson:
+            json.dump(results, openjson, indent=2, sort_keys=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,794 @@
+"""Local stand-in for ESI, serving generated data.
+
+Serves a synthetic swagger.json covering every route the worker knows how
+to fan out on, /verify/, /ping, /universe/names/ and generated data for a
+character in a corporation of a configurable size. Latency, 5xx errors, the
+error limit (420s with X-Esi-Error-Limit-* headers), X-Pages, Expires and
+ETags are all simulated.
+
+Tokens are the character ID to verify as, or anything else for the default
+character. Request counts are served from /_stats, and reset with a POST to
+/_reset. Run with `python -m bench.fake_esi`.
+
+Usage:
+    fake_esi [options]
+
+Options:
+    --port PORT          port to listen on [default: 8081]
+    --corp-size N        members in the corporation [default: 100]
+    --latency SECONDS    mean latency added to each response [default: 0]
+    --error-rate RATE    fraction of requests failing with a 502 [default: 0]
+    --error-limit N      errors allowed per window before 420s [default: 100]
+"""
+
+
+import re
+import json
+import time
+import random
+import hashlib
+import threading
+from email.utils import formatdate
+
+try:
+    from http import server
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qs, unquote
+except ImportError:
+    # python2
+    import BaseHTTPServer as server
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse, parse_qs
+    from urllib import unquote
+
+import docopt
+
+from esi_knife import SCOPES
+
+
+CHARACTER_ID = 90000001
+CORPORATION_ID = 98000001
+ALLIANCE_ID = 99000001
+ROLES = ["Director", "Accountant", "Station_Manager"]
+PAGE_SIZE = 1000
+EXPIRES = 300
+IMMUTABLE_EXPIRES = 86400
+
+
+def _scope(name):
+    return "esi-{}.v1".format(name)
+
+
+# (route, scope, roles, fixture), fixtures are FakeESI._<fixture> methods
+ROUTES = [
+    ("/characters/{character_id}/", None, None, "character"),
+    ("/characters/{character_id}/assets/",
+     _scope("assets.read_assets"), None, "assets"),
+    ("/characters/{character_id}/blueprints/",
+     _scope("characters.read_blueprints"), None, "blueprints"),
+    ("/characters/{character_id}/calendar/",
+     _scope("calendar.read_calendar_events"), None, "calendar"),
+    ("/characters/{character_id}/calendar/{event_id}/",
+     _scope("calendar.read_calendar_events"), None, "event"),
+    ("/characters/{character_id}/clones/",
+     _scope("clones.read_clones"), None, "clones"),
+    ("/characters/{character_id}/contacts/",
+     _scope("characters.read_contacts"), None, "contacts"),
+    ("/characters/{character_id}/contracts/",
+     _scope("contracts.read_character_contracts"), None, "contracts"),
+    ("/characters/{character_id}/contracts/{contract_id}/bids/",
+     _scope("contracts.read_character_contracts"), None, "bids"),
+    ("/characters/{character_id}/contracts/{contract_id}/items/",
+     _scope("contracts.read_character_contracts"), None, "contract_items"),
+    ("/characters/{character_id}/fittings/",
+     _scope("fittings.read_fittings"), None, "fittings"),
+    ("/characters/{character_id}/implants/",
+     _scope("clones.read_implants"), None, "implants"),
+    ("/characters/{character_id}/killmails/recent/",
+     _scope("killmails.read_killmails"), None, "killmails"),
+    ("/characters/{character_id}/location/",
+     _scope("location.read_location"), None, "location"),
+    ("/characters/{character_id}/mail/",
+     _scope("mail.read_mail"), None, "mail"),
+    ("/characters/{character_id}/mail/labels/",
+     _scope("mail.read_mail"), None, "labels"),
+    ("/characters/{character_id}/mail/{mail_id}/",
+     _scope("mail.read_mail"), None, "mail_body"),
+    ("/characters/{character_id}/planets/",
+     _scope("planets.manage_planets"), None, "planets"),
+    ("/characters/{character_id}/planets/{planet_id}/",
+     _scope("planets.manage_planets"), None, "planet"),
+    ("/characters/{character_id}/roles/",
+     _scope("characters.read_corporation_roles"), None, "roles"),
+    ("/characters/{character_id}/skillqueue/",
+     _scope("skills.read_skillqueue"), None, "skillqueue"),
+    ("/characters/{character_id}/skills/",
+     _scope("skills.read_skills"), None, "skills"),
+    ("/characters/{character_id}/wallet/",
+     _scope("wallet.read_character_wallet"), None, "balance"),
+    ("/characters/{character_id}/wallet/journal/",
+     _scope("wallet.read_character_wallet"), None, "journal"),
+    ("/characters/{character_id}/wallet/transactions/",
+     _scope("wallet.read_character_wallet"), None, "transactions"),
+    ("/corporations/{corporation_id}/assets/",
+     _scope("assets.read_corporation_assets"), ["Director"], "corp_assets"),
+    ("/corporations/{corporation_id}/contracts/",
+     _scope("contracts.read_corporation_contracts"), None, "corp_contracts"),
+    ("/corporations/{corporation_id}/contracts/{contract_id}/bids/",
+     _scope("contracts.read_corporation_contracts"), None, "bids"),
+    ("/corporations/{corporation_id}/contracts/{contract_id}/items/",
+     _scope("contracts.read_corporation_contracts"), None, "contract_items"),
+    ("/corporations/{corporation_id}/killmails/recent/",
+     _scope("killmails.read_corporation_killmails"), ["Director"],
+     "corp_killmails"),
+    ("/corporations/{corporation_id}/members/",
+     _scope("corporations.read_corporation_membership"), None, "members"),
+    ("/corporations/{corporation_id}/membertracking/",
+     _scope("corporations.track_members"), ["Director"], "tracking"),
+    ("/corporations/{corporation_id}/roles/",
+     _scope("corporations.read_corporation_membership"), None,
+     "member_roles"),
+    ("/corporations/{corporation_id}/starbases/",
+     _scope("corporations.read_starbases"), ["Director"], "starbases"),
+    ("/corporations/{corporation_id}/starbases/{starbase_id}/",
+     _scope("corporations.read_starbases"), ["Director"], "starbase"),
+    ("/corporations/{corporation_id}/structures/",
+     _scope("corporations.read_structures"), ["Station_Manager"],
+     "structures"),
+    ("/corporations/{corporation_id}/wallets/",
+     _scope("wallet.read_corporation_wallets"), ["Accountant"], "wallets"),
+    ("/corporations/{corporation_id}/wallets/{division}/journal/",
+     _scope("wallet.read_corporation_wallets"), ["Accountant"],
+     "corp_journal"),
+    ("/corporation/{corporation_id}/mining/observers/",
+     _scope("industry.read_corporation_mining"), ["Accountant"],
+     "observers"),
+    ("/corporation/{corporation_id}/mining/observers/{observer_id}/",
+     _scope("industry.read_corporation_mining"), ["Accountant"],
+     "observer"),
+    ("/alliances/{alliance_id}/contacts/",
+     _scope("alliances.read_contacts"), None, "contacts"),
+    ("/alliances/{alliance_id}/corporations/", None, None, "alliance_corps"),
+    ("/killmails/{killmail_id}/{killmail_hash}/", None, None, "killmail"),
+]
+
+IMMUTABLE = ("event", "mail_body", "contract_items", "killmail")
+
+
+def spec():
+    """Return the synthetic swagger spec for ROUTES."""
+
+    paths = {}
+    for route, scope, roles, _ in ROUTES:
+        operation = {
+            "parameters": [
+                {"in": "path", "name": name, "required": True}
+                for name in re.findall(r"{(\w+)}", route)
+            ],
+        }
+        if scope:
+            operation["security"] = [{"evesso": [scope]}]
+        if roles:
+            operation["x-required-roles"] = roles
+        paths[route] = {"get": operation}
+
+    paths["/universe/names/"] = {"post": {"parameters": []}}
+    return {"swagger": "2.0", "basePath": "/latest", "paths": paths}
+
+
+def _matcher(route):
+    """Return a compiled regex for a route template."""
+
+    return re.compile("^{}$".format(
+        re.sub(r"{(\w+)}", r"(?P<\1>[^/]+)", route)
+    ))
+
+
+class FakeESI(object):  # pylint: disable=R0902
+    """Generated ESI data and the simulated server behaviour.
+
+    KWargs:
+        corp_size: integer members in the character's corporation
+        latency: float mean seconds added to each response
+        error_rate: float fraction of requests failing with a 502
+        error_limit: integer errors allowed per window before 420s
+        error_window: integer seconds in each error limit window
+        seed: integer seed for generated data and errors
+    """
+
+    def __init__(self, corp_size=100, latency=0.0,  # pylint: disable=R0913
+                 error_rate=0.0, error_limit=100, error_window=60, seed=0):
+        self.corp_size = corp_size
+        self.latency = latency
+        self.error_rate = error_rate
+        self.error_limit = error_limit
+        self.error_window = error_window
+        self.seed = seed
+        self.routes = [
+            (_matcher(route), route, fixture)
+            for route, _, _, fixture in ROUTES
+        ]
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._window_start = time.time()
+        self._errors_in_window = 0
+        self.stats = {}
+        self.reset()
+
+    def reset(self):
+        """Reset the request statistics and error limit."""
+
+        with self._lock:
+            self.stats = {
+                "requests": 0,
+                "errors": 0,
+                "error_limited": 0,
+                "not_modified": 0,
+                "bytes": 0,
+                "error_budget": 0,  # most errors in one window
+                "routes": {},
+            }
+            self._window_start = time.time()
+            self._errors_in_window = 0
+
+    def _count(self, key, route=None, size=0):
+        with self._lock:
+            self.stats[key] += 1
+            self.stats["bytes"] += size
+            if route:
+                self.stats["routes"][route] = \
+                    self.stats["routes"].get(route, 0) + 1
+
+    def _error_limit(self, error=False):
+        """Return (remaining errors, seconds to reset), counting an error."""
+
+        with self._lock:
+            now = time.time()
+            if now - self._window_start >= self.error_window:
+                self._window_start = now
+                self._errors_in_window = 0
+            if error:
+                self._errors_in_window += 1
+                self.stats["error_budget"] = max(
+                    self.stats["error_budget"],
+                    self._errors_in_window,
+                )
+            return (
+                max(self.error_limit - self._errors_in_window, 0),
+                int(self._window_start + self.error_window - now) + 1,
+            )
+
+    def _rng(self, *key):
+        """Return a Random seeded by key, for repeatable generated data."""
+
+        return random.Random("{}:{}".format(self.seed, key))
+
+    def respond(self, method, path, query, headers, body):
+        """Handle one request.
+
+        Returns:
+            tuple of (status, {header: value}, bytes body)
+        """
+
+        if self.latency:
+            time.sleep(self._random.expovariate(1.0 / self.latency))
+
+        remaining, reset = self._error_limit()
+        limit_headers = {
+            "X-Esi-Error-Limit-Remain": str(remaining),
+            "X-Esi-Error-Limit-Reset": str(reset),
+        }
+        if remaining <= 0:
+            self._count("error_limited")
+            return 420, limit_headers, b'{"error": "error limited"}'
+
+        if path.startswith("/latest"):
+            path = path[len("/latest"):]
+
+        if self.error_rate and self._random.random() < self.error_rate:
+            remaining, reset = self._error_limit(error=True)
+            self._count("errors")
+            limit_headers["X-Esi-Error-Limit-Remain"] = str(remaining)
+            return 502, limit_headers, b'{"error": "bad gateway"}'
+
+        try:
+            data, pages, route, fixture = self._data(
+                method,
+                path,
+                query,
+                headers,
+                body,
+            )
+        except KeyError:
+            self._error_limit(error=True)
+            self._count("errors")
+            return 404, limit_headers, b'{"error": "not found"}'
+
+        payload = json.dumps(data).encode("utf-8")
+        etag = '"{}"'.format(hashlib.sha1(payload).hexdigest())
+        response_headers = dict(limit_headers)
+        response_headers["ETag"] = etag
+        response_headers["Expires"] = formatdate(
+            time.time() + (
+                IMMUTABLE_EXPIRES if fixture in IMMUTABLE else EXPIRES
+            ),
+            usegmt=True,
+        )
+        if pages > 1:
+            response_headers["X-Pages"] = str(pages)
+
+        if headers.get("If-None-Match") == etag:
+            self._count("not_modified", route)
+            return 304, response_headers, b""
+
+        self._count("requests", route, len(payload))
+        return 200, response_headers, payload
+
+    def _data(self, method, path, query,  # pylint: disable=R0913
+              headers, body):
+        """Return (data, pages, route, fixture) for a request.
+
+        Raises:
+            KeyError if there's no such route
+        """
+
+        if path == "/verify/":
+            token = headers.get("Authorization", "").split(" ")[-1]
+            return {
+                "CharacterID": int(token) if token.isdigit()
+                               else CHARACTER_ID,
+                "CharacterName": "Fake Character",
+                "Scopes": unquote(SCOPES),
+                "TokenType": "Character",
+            }, 1, "/verify/", "verify"
+
+        if path == "/swagger.json":
+            return spec(), 1, "/swagger.json", "spec"
+
+        if path == "/ping":
+            return "ok", 1, "/ping", "ping"
+
+        if path == "/universe/names/" and method == "POST":
+            return [
+                {"id": x, "name": "Name {}".format(x), "category": "type"}
+                for x in json.loads(body.decode("utf-8"))
+            ], 1, "/universe/names/", "names"
+
+        data, route, fixture = self.generate(path)
+        if isinstance(data, list) and len(data) > PAGE_SIZE:
+            page = int(query.get("page", ["1"])[0])
+            pages = (len(data) + PAGE_SIZE - 1) // PAGE_SIZE
+            return data[(page - 1) * PAGE_SIZE:page * PAGE_SIZE], pages, \
+                route, fixture
+        return data, 1, route, fixture
+
+    def generate(self, path):
+        """Return the generated data for path, without paging.
+
+        Args:
+            path: string path after the /latest base path
+
+        Returns:
+            tuple of (data, route template, fixture name)
+
+        Raises:
+            KeyError if there's no such route
+        """
+
+        for matcher, route, fixture in self.routes:
+            match = matcher.match(path)
+            if match:
+                break
+        else:
+            raise KeyError(path)
+
+        return getattr(self, "_{}".format(fixture))(
+            self._rng(path),
+            **match.groupdict()
+        ), route, fixture
+
+    # generated data, scaled by corp_size for corporation routes
+
+    @staticmethod
+    def _items(rng, count, **fields):
+        """Return count dictionaries, fields are callables of (rng, i)."""
+
+        return [
+            {key: value(rng, i) for key, value in fields.items()}
+            for i in range(count)
+        ]
+
+    def _character(self, rng, character_id):
+        return {
+            "name": "Character {}".format(character_id),
+            "corporation_id": CORPORATION_ID,
+            "alliance_id": ALLIANCE_ID,
+            "birthday": "2010-01-01T00:00:00Z",
+            "race_id": rng.randint(1, 8),
+        }
+
+    def _assets(self, rng, character_id=None, count=1500):
+        return self._items(
+            rng,
+            count,
+            item_id=lambda r, i: 1000000000000 + i,
+            type_id=lambda r, i: r.randint(34, 40000),
+            location_id=lambda r, i: r.choice([60003760, 60008494]),
+            location_flag=lambda r, i: r.choice(["Hangar", "Cargo"]),
+            location_type=lambda r, i: "station",
+            quantity=lambda r, i: r.randint(1, 10000),
+            is_singleton=lambda r, i: False,
+        )
+
+    def _corp_assets(self, rng, corporation_id):
+        return self._assets(rng, count=50 * self.corp_size)
+
+    def _blueprints(self, rng, character_id):
+        return self._items(
+            rng,
+            50,
+            item_id=lambda r, i: 2000000000000 + i,
+            type_id=lambda r, i: r.randint(600, 700),
+            location_id=lambda r, i: 60003760,
+            material_efficiency=lambda r, i: r.randint(0, 10),
+            time_efficiency=lambda r, i: r.randint(0, 20),
+            runs=lambda r, i: -1,
+        )
+
+    def _calendar(self, rng, character_id):
+        return self._items(
+            rng,
+            10,
+            event_id=lambda r, i: 3000 + i,
+            title=lambda r, i: "Event {}".format(i),
+            event_date=lambda r, i: "2020-01-01T00:00:00Z",
+        )
+
+    def _event(self, rng, character_id, event_id):
+        return {
+            "event_id": int(event_id),
+            "owner_id": CORPORATION_ID,
+            "title": "Event {}".format(event_id),
+            "text": "x" * rng.randint(10, 500),
+            "duration": 60,
+        }
+
+    def _clones(self, rng, character_id):
+        return {"home_location": {"location_id": 60003760}, "jump_clones": []}
+
+    def _contacts(self, rng, **_):
+        return self._items(
+            rng,
+            100,
+            contact_id=lambda r, i: 90000100 + i,
+            contact_type=lambda r, i: "character",
+            standing=lambda r, i: r.choice([-10.0, 5.0, 10.0]),
+        )
+
+    def _contracts(self, rng, character_id=None, count=20):
+        return self._items(
+            rng,
+            count,
+            contract_id=lambda r, i: 4000 + i,
+            issuer_id=lambda r, i: CHARACTER_ID,
+            issuer_corporation_id=lambda r, i: CORPORATION_ID,
+            type=lambda r, i: r.choice(["item_exchange", "auction"]),
+            status=lambda r, i: r.choice(["outstanding", "finished"]),
+            price=lambda r, i: float(r.randint(1, 1000000)),
+        )
+
+    def _corp_contracts(self, rng, corporation_id):
+        return self._contracts(rng, count=self.corp_size // 10 + 5)
+
+    def _bids(self, rng, contract_id, **_):
+        return self._items(
+            rng,
+            rng.randint(0, 3),
+            bid_id=lambda r, i: int(contract_id) * 10 + i,
+            bidder_id=lambda r, i: 90000100 + i,
+            amount=lambda r, i: float(r.randint(1, 1000000)),
+        )
+
+    def _contract_items(self, rng, contract_id, **_):
+        return self._items(
+            rng,
+            rng.randint(1, 10),
+            record_id=lambda r, i: int(contract_id) * 100 + i,
+            type_id=lambda r, i: r.randint(34, 40000),
+            quantity=lambda r, i: r.randint(1, 1000),
+            is_included=lambda r, i: True,
+        )
+
+    def _fittings(self, rng, character_id):
+        return self._items(
+            rng,
+            20,
+            fitting_id=lambda r, i: 5000 + i,
+            name=lambda r, i: "Fit {}".format(i),
+            ship_type_id=lambda r, i: 587,
+            items=lambda r, i: [{"type_id": 2881, "flag": 27}],
+        )
+
+    def _implants(self, rng, character_id):
+        return [rng.randint(9899, 9999) for _ in range(5)]
+
+    def _killmails(self, rng, character_id=None, count=10):
+        return [
+            {
+                "killmail_id": 70000000 + i,
+                "killmail_hash": hashlib.sha1(str(i).encode()).hexdigest(),
+            }
+            for i in range(count)
+        ]
+
+    def _corp_killmails(self, rng, corporation_id):
+        return self._killmails(rng, count=self.corp_size // 20 + 3)
+
+    def _killmail(self, rng, killmail_id, killmail_hash):
+        return {
+            "killmail_id": int(killmail_id),
+            "solar_system_id": 30000142,
+            "victim": {
+                "character_id": CHARACTER_ID,
+                "corporation_id": CORPORATION_ID,
+                "ship_type_id": rng.randint(580, 650),
+                "damage_taken": rng.randint(100, 100000),
+            },
+            "attackers": self._items(
+                rng,
+                rng.randint(1, 20),
+                character_id=lambda r, i: 90000100 + i,
+                corporation_id=lambda r, i: 98000100,
+                ship_type_id=lambda r, i: r.randint(580, 650),
+                damage_done=lambda r, i: r.randint(1, 1000),
+            ),
+        }
+
+    def _location(self, rng, character_id):
+        return {"solar_system_id": 30000142, "station_id": 60003760}
+
+    def _mail(self, rng, character_id):
+        return self._items(
+            rng,
+            50,
+            mail_id=lambda r, i: 6000 + i,
+            subject=lambda r, i: "Mail {}".format(i),
+            timestamp=lambda r, i: "2020-01-01T00:00:00Z",
+        )
+
+    def _labels(self, rng, character_id):
+        return {
+            "labels": [{"label_id": 1, "name": "Inbox"}],
+            "total_unread_count": 0,
+        }
+
+    def _mail_body(self, rng, character_id, mail_id):
+        return {
+            "body": "x" * rng.randint(10, 2000),
+            "from": 90000100,
+            "subject": "Mail {}".format(mail_id),
+            "timestamp": "2020-01-01T00:00:00Z",
+        }
+
+    def _planets(self, rng, character_id):
+        return self._items(
+            rng,
+            3,
+            planet_id=lambda r, i: 40000000 + i,
+            solar_system_id=lambda r, i: 30000142,
+            upgrade_level=lambda r, i: 4,
+        )
+
+    def _planet(self, rng, character_id, planet_id):
+        return {"pins": [], "links": [], "routes": []}
+
+    def _roles(self, rng, character_id):
+        return {"roles": ROLES}
+
+    def _skillqueue(self, rng, character_id):
+        return self._items(
+            rng,
+            10,
+            skill_id=lambda r, i: 3300 + i,
+            finished_level=lambda r, i: 5,
+            queue_position=lambda r, i: i,
+        )
+
+    def _skills(self, rng, character_id):
+        return {
+            "skills": self._items(
+                rng,
+                300,
+                skill_id=lambda r, i: 3300 + i,
+                trained_skill_level=lambda r, i: r.randint(0, 5),
+                skillpoints_in_skill=lambda r, i: r.randint(0, 256000),
+            ),
+            "total_sp": 50000000,
+        }
+
+    def _balance(self, rng, character_id):
+        return rng.random() * 1e9
+
+    def _journal(self, rng, character_id=None, count=500):
+        return self._items(
+            rng,
+            count,
+            id=lambda r, i: 7000000000 + i,
+            ref_type=lambda r, i: r.choice(["bounty_prizes", "market_escrow"]),
+            amount=lambda r, i: r.random() * 1e6,
+            balance=lambda r, i: r.random() * 1e9,
+            date=lambda r, i: "2020-01-01T00:00:00Z",
+            first_party_id=lambda r, i: 1000125,
+            second_party_id=lambda r, i: CHARACTER_ID,
+        )
+
+    def _corp_journal(self, rng, corporation_id, division):
+        return self._journal(rng, count=10 * self.corp_size)
+
+    def _transactions(self, rng, character_id):
+        return self._items(
+            rng,
+            200,
+            transaction_id=lambda r, i: 8000000000 + i,
+            type_id=lambda r, i: r.randint(34, 40000),
+            client_id=lambda r, i: 90000100 + i,
+            location_id=lambda r, i: 60003760,
+            unit_price=lambda r, i: r.random() * 1e6,
+            quantity=lambda r, i: r.randint(1, 100),
+        )
+
+    def _members(self, rng, corporation_id):
+        return [CHARACTER_ID + i for i in range(self.corp_size)]
+
+    def _tracking(self, rng, corporation_id):
+        return [
+            {
+                "character_id": CHARACTER_ID + i,
+                "location_id": 60003760,
+                "ship_type_id": rng.randint(580, 650),
+                "logon_date": "2020-01-01T00:00:00Z",
+            }
+            for i in range(self.corp_size)
+        ]
+
+    def _member_roles(self, rng, corporation_id):
+        return [
+            {"character_id": CHARACTER_ID + i, "roles": []}
+            for i in range(self.corp_size)
+        ]
+
+    def _starbases(self, rng, corporation_id):
+        return self._items(
+            rng,
+            self.corp_size // 100 + 1,
+            starbase_id=lambda r, i: 1010000000000 + i,
+            system_id=lambda r, i: 30000142,
+            type_id=lambda r, i: 12235,
+        )
+
+    def _starbase(self, rng, corporation_id, starbase_id):
+        return {"fuels": [{"type_id": 4051, "quantity": 1000}]}
+
+    def _structures(self, rng, corporation_id):
+        return self._items(
+            rng,
+            self.corp_size // 50 + 1,
+            structure_id=lambda r, i: 1020000000000 + i,
+            type_id=lambda r, i: 35832,
+            system_id=lambda r, i: 30000142,
+        )
+
+    def _wallets(self, rng, corporation_id):
+        return [
+            {"division": i, "balance": rng.random() * 1e10}
+            for i in range(1, 8)
+        ]
+
+    def _observers(self, rng, corporation_id):
+        return self._items(
+            rng,
+            self.corp_size // 100 + 1,
+            observer_id=lambda r, i: 1030000000000 + i,
+            observer_type=lambda r, i: "structure",
+        )
+
+    def _observer(self, rng, corporation_id, observer_id):
+        return self._items(
+            rng,
+            min(self.corp_size, 100),
+            character_id=lambda r, i: CHARACTER_ID + i,
+            type_id=lambda r, i: r.randint(1230, 1240),
+            quantity=lambda r, i: r.randint(1, 100000),
+        )
+
+    def _alliance_corps(self, rng, alliance_id):
+        return [CORPORATION_ID + i for i in range(10)]
+
+
+class _ThreadingServer(ThreadingMixIn, server.HTTPServer):
+    daemon_threads = True
+
+
+def serve(fake, host="127.0.0.1", port=0):
+    """Start serving fake in a background thread.
+
+    Returns:
+        tuple of (HTTPServer, string base URL)
+    """
+
+    class Handler(server.BaseHTTPRequestHandler):
+        """Pass requests to the FakeESI."""
+
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *_, **__):  # pylint: disable=arguments-differ
+            """Silence logging."""
+
+            pass
+
+        def _respond(self, method):
+            parsed = urlparse(self.path)
+            length = int(self.headers.get("Content-Length") or 0)
+            body = self.rfile.read(length) if length else b""
+
+            if parsed.path == "/_stats":
+                status, headers, payload = 200, {}, json.dumps(
+                    fake.stats
+                ).encode("utf-8")
+            elif parsed.path == "/_reset":
+                fake.reset()
+                status, headers, payload = 200, {}, b"{}"
+            else:
+                status, headers, payload = fake.respond(
+                    method,
+                    parsed.path,
+                    parse_qs(parsed.query),
+                    self.headers,
+                    body,
+                )
+
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            for key, value in headers.items():
+                self.send_header(key, value)
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def do_GET(self):  # pylint: disable=invalid-name
+            """Accept a GET request."""
+
+            self._respond("GET")
+
+        def do_POST(self):  # pylint: disable=invalid-name
+            """Accept a POST request."""
+
+            self._respond("POST")
+
+    httpd = _ThreadingServer((host, port), Handler)
+    thread = threading.Thread(target=httpd.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return httpd, "http://{}:{}".format(host, httpd.server_address[1])
+
+
+def main():
+    """Run the fake ESI until interrupted."""
+
+    args = docopt.docopt(__doc__)
+    httpd, url = serve(FakeESI(
+        corp_size=int(args["--corp-size"]),
+        latency=float(args["--latency"]),
+        error_rate=float(args["--error-rate"]),
+        error_limit=int(args["--error-limit"]),
+    ), port=int(args["--port"]))
+    print("fake ESI at {}, use ESI_BASE_URL={}".format(url, url))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        httpd.shutdown()
+
+
+if __name__ == "__main__":
+    main()
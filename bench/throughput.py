@@ -0,0 +1,248 @@
+"""End to end throughput of knife jobs against the fake ESI.
+
+Run with `python -m bench.throughput`. Starts a fake ESI (bench.fake_esi)
+and, for each corporation size, a fresh process which knifes a Director of
+that corporation:
+
+    results  worker.get_results, cold
+    knife    the full job from verified token to stored result, cold
+    reknife  the same job again, incremental from the knife snapshot
+
+reporting wall time, requests/s, peak RSS and the ESI error budget used (the
+most errors seen in one error limit window, as a percentage of the limit).
+
+A size's stages share its process, so peak RSS is cumulative: each stage's
+is the most used by it or any stage before it.
+
+Usage:
+    throughput [options]
+
+Options:
+    --sizes SIZES          comma separated corporation sizes
+                           [default: 10,100,1000]
+    --latency SECONDS      mean latency added to each response
+                           [default: 0.02]
+    --error-rate RATE      fraction of requests failing with a 502
+                           [default: 0]
+    --error-limit N        errors allowed per window before 420s
+                           [default: 100]
+    --json FILE            also write the results to FILE
+    --compare FILE         compare wall times with a previous --json FILE
+    --single SIZE          (internal) run the stages for one size
+    --url URL              (internal) fake ESI base URL
+"""
+
+
+import os
+import sys
+import json
+import time
+import resource
+import subprocess
+
+import docopt
+import requests
+
+from bench import fake_esi
+
+
+STAGES = ("results", "knife", "reknife")
+
+
+def _peak_rss():
+    """Return the peak RSS of this process so far in MB."""
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        peak /= 1024  # bytes, not KB
+    return peak / 1024.0
+
+
+def _stage(url, error_limit, func):
+    """Run func against a freshly reset fake ESI.
+
+    Returns:
+        dictionary of the stage's measurements
+    """
+
+    requests.post("{}/_reset".format(url))
+    start = time.time()
+    func()
+    wall = time.time() - start
+    stats = requests.get("{}/_stats".format(url)).json()
+
+    return {
+        "wall": wall,
+        "requests": stats["requests"],
+        "not_modified": stats["not_modified"],
+        "rps": (stats["requests"] + stats["not_modified"]) / wall,
+        "errors": stats["errors"],
+        "error_limited": stats["error_limited"],
+        "error_budget": 100.0 * stats["error_budget"] / error_limit,
+        "mbytes": stats["bytes"] / 1048576.0,
+        "peak_rss": _peak_rss(),
+    }
+
+
+def run_single(url, error_limit):
+    """Run every stage for the fake ESI's character.
+
+    Called in its own process, with ESI_BASE_URL pointing at the fake.
+    """
+
+    from esi_knife import CACHE
+    from esi_knife import Keys
+    from esi_knife import utils
+    from esi_knife import worker
+    from esi_knife import immutable
+    from esi_knife.scheduler import Scheduler
+
+    def _setup(path, **kwargs):
+        # the stages see the simulated errors, setting up shouldn't
+        for _ in range(10):
+            _, _, res = utils.request_or_wait(
+                "{}{}".format(url, path),
+                **kwargs
+            )
+            if not isinstance(res, str):
+                return res
+        raise SystemExit("fake ESI failed: {}".format(res))
+
+    token = str(fake_esi.CHARACTER_ID)
+    headers = {"Authorization": "Bearer {}".format(token)}
+    verify = _setup("/verify/", headers=headers)
+    character_id = verify["CharacterID"]
+    roles = _setup(
+        "/latest/characters/{}/roles/".format(character_id),
+        headers=headers,
+    )
+    public = _setup("/latest/characters/{}/".format(character_id))
+    utils.refresh_spec()
+
+    def _results():
+        with Scheduler() as scheduler:
+            worker.get_results(
+                public,
+                character_id,
+                verify["Scopes"],
+                roles["roles"],
+                headers,
+                scheduler=scheduler,
+            ).close()
+
+    def _knife(uuid):
+        worker.knife(uuid, token, verify, roles["roles"])
+        if not utils.has_data(uuid):
+            raise SystemExit("knife job {} failed".format(uuid))
+
+    measured = {}
+    measured["results"] = _stage(url, error_limit, _results)
+
+    immutable.RESOURCES = immutable.LRU(immutable.MAX_BYTES)
+    CACHE.delete("{}{}".format(Keys.snapshot.value, character_id))
+    measured["knife"] = _stage(url, error_limit, lambda: _knife("bench-1"))
+    measured["reknife"] = _stage(url, error_limit, lambda: _knife("bench-2"))
+    return measured
+
+
+def _run_size(fake, url, size, args):
+    """Run the stages for one corporation size in a fresh process."""
+
+    fake.corp_size = size
+    env = dict(os.environ)
+    env["ESI_BASE_URL"] = url
+    env.setdefault("ESI_KNIFE_REDIS_CONNECT_TIMEOUT", "0.2")
+
+    output = subprocess.check_output(
+        [
+            sys.executable,
+            "-m",
+            "bench.throughput",
+            "--single",
+            str(size),
+            "--url",
+            url,
+            "--error-limit",
+            args["--error-limit"],
+        ],
+        env=env,
+    )
+    return json.loads(output.decode("utf-8").strip().splitlines()[-1])
+
+
+def _print(results, previous=None):
+    """Print a table of results, with the change from previous."""
+
+    print("{:>6} {:>8} {:>9} {:>9} {:>9} {:>7} {:>6} {:>7} {:>9}{}".format(
+        "size", "stage", "wall s", "requests", "req/s", "errors", "420s",
+        "budget", "peak MB", "  vs prev" if previous else "",
+    ))
+    for size in sorted(results, key=int):
+        for stage in STAGES:
+            row = results[size][stage]
+            change = ""
+            try:
+                before = previous[size][stage]["wall"]
+            except (KeyError, TypeError):
+                pass
+            else:
+                change = "  {:+.1f}%".format(
+                    100.0 * (row["wall"] - before) / before
+                )
+            print(
+                "{:>6} {:>8} {:>9.2f} {:>9d} {:>9.1f} {:>7d} {:>6d} "
+                "{:>6.0f}% {:>9.1f}{}".format(
+                    size,
+                    stage,
+                    row["wall"],
+                    row["requests"] + row["not_modified"],
+                    row["rps"],
+                    row["errors"],
+                    row["error_limited"],
+                    row["error_budget"],
+                    row["peak_rss"],
+                    change,
+                )
+            )
+
+
+def main():
+    """Benchmark entrypoint."""
+
+    args = docopt.docopt(__doc__)
+
+    if args["--single"]:
+        print(json.dumps(run_single(
+            args["--url"],
+            int(args["--error-limit"]),
+        )))
+        return
+
+    fake = fake_esi.FakeESI(
+        latency=float(args["--latency"]),
+        error_rate=float(args["--error-rate"]),
+        error_limit=int(args["--error-limit"]),
+    )
+    httpd, url = fake_esi.serve(fake)
+    try:
+        results = {
+            size: _run_size(fake, url, int(size), args)
+            for size in args["--sizes"].split(",")
+        }
+    finally:
+        httpd.shutdown()
+
+    previous = None
+    if args["--compare"]:
+        with open(args["--compare"], "r") as openprevious:
+            previous = json.load(openprevious)
+
+    _print(results, previous)
+
+    if args["--json"]:
+        with open(args["--json"], "w") as openjson:
+            json.dump(results, openjson, indent=2, sort_keys=True)
+
+
+if __name__ == "__main__":
+    main()
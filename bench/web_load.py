@@ -0,0 +1,367 @@
+"""Load test of the web frontend.
+
+Run with `python -m bench.web_load`. Stores generated results for a number
+of characters, along with pending and processing jobs, then drives a mix of
+requests at the web app from concurrent greenlets for a while, reporting the
+throughput and latency percentiles of each endpoint:
+
+    view       /view/<token>/ of a stored result
+    view_json  the same, as application/json
+    pending    /view/<token>/ of a job still pending or processing
+    metrics    /metrics
+
+Each of --results is a keyspace size to measure at, results are added to
+reach each one in turn. The app is called in process through Flask's test
+client against an in-memory redis (fakeredis, `pip install fakeredis`), or
+a real one with --redis. To load a running deployment instead, pass its
+--url along with the --redis it uses, so the generated results are stored
+where it can find them.
+
+Rate limits are raised out of the way unless ESI_KNIFE_RATE_LIMITS is set,
+they are still checked on every request. Each greenlet is its own client IP.
+
+Usage:
+    web_load [options]
+
+Options:
+    --results SIZES        comma separated numbers of stored results
+                           [default: 100,1000]
+    --pending N            pending and processing jobs stored [default: 50]
+    --mix MIX              endpoint weights
+                           [default: view=6,view_json=1,pending=2,metrics=1]
+    --concurrency N        concurrent clients [default: 20]
+    --duration SECONDS     seconds to run at each size [default: 10]
+    --redis URL            redis to use, ie redis://localhost:6379/0
+    --url URL              load a running web frontend at URL
+    --json FILE            also write the results to FILE
+    --compare FILE         compare with a previous --json FILE
+"""
+
+
+from gevent import monkey
+monkey.patch_all()
+
+
+import os
+import json
+import time
+import random
+import importlib
+
+import docopt
+import gevent
+
+from bench import fake_esi
+
+
+ENDPOINTS = ("view", "view_json", "pending", "metrics")
+REQUEST_TIMEOUT = 30  # seconds, for requests to a running frontend
+
+# character routes without fan out, for each generated result
+RESULT_ROUTES = [
+    route for route, _, _, _ in fake_esi.ROUTES
+    if route.startswith("/characters/") and route.count("{") == 1
+]
+
+
+def _install_redis(redis_url=None):
+    """Point the knife cache at redis_url, or an in-memory redis."""
+
+    # the class the app's flask_cache redis backend builds
+    from flask_cache.backends import RedisCache
+
+    from esi_knife import APP
+    from esi_knife import CACHE
+
+    if redis_url:
+        import redis
+        client = redis.Redis.from_url(redis_url)
+    else:
+        try:
+            import fakeredis
+        except ImportError:
+            raise SystemExit("pip install fakeredis, or use --redis")
+        client = fakeredis.FakeRedis()
+
+    cache = CACHE._resolve()  # pylint: disable=protected-access
+    app = APP._resolve()  # pylint: disable=protected-access
+    cache.app = app
+    app.extensions["cache"][cache] = RedisCache(client, key_prefix="knife.")
+
+
+def populate(start, stop, pending):
+    """Store generated results for characters start to stop.
+
+    Returns:
+        list of uuids of pending and processing jobs
+    """
+
+    from esi_knife import ESI
+    from esi_knife import Keys
+    from esi_knife import CACHE
+    from esi_knife import utils
+
+    for i in range(start, stop):
+        character_id = fake_esi.CHARACTER_ID + i
+        fake = fake_esi.FakeESI(seed=i)
+        utils.write_data("result-{}".format(i), {
+            "{}/latest{}".format(ESI, path): fake.generate(path)[0]
+            for path in (
+                route.format(character_id=character_id)
+                for route in RESULT_ROUTES
+            )
+        })
+
+    jobs = []
+    for i in range(pending):
+        token = "job-{}".format(i)
+        state = Keys.pending if i % 2 else Keys.processing
+        CACHE.set("{}{}".format(state.value, token), "1", timeout=86400)
+        jobs.append(token)
+    return jobs
+
+
+def _percentile(ordered, percent):
+    """Return the nearest rank percentile of an ordered list."""
+
+    if not ordered:
+        return 0
+    return ordered[min(
+        len(ordered) - 1,
+        max(0, int(round(percent / 100.0 * len(ordered))) - 1),
+    )]
+
+
+class Client(object):
+    """Issue requests in process, or to a running frontend.
+
+    Args:
+        address: string client IP address
+        url: optional base URL of a running frontend
+    """
+
+    def __init__(self, address, url=None):
+        self.headers = {"X-Forwarded-For": address}
+        if url:
+            import requests
+            self.url = url.rstrip("/")
+            self.session = requests.Session()
+            self.test_client = None
+        else:
+            from esi_knife import APP
+            self.url = None
+            self.session = None
+            self.test_client = APP.test_client()
+
+    def get(self, path, accept=None):
+        """Request path, returning the status code."""
+
+        headers = dict(self.headers)
+        if accept:
+            headers["Accept"] = accept
+        if self.test_client is not None:
+            return self.test_client.get(path, headers=headers).status_code
+        return self.session.get(
+            self.url + path,
+            headers=headers,
+            allow_redirects=False,
+            timeout=REQUEST_TIMEOUT,
+        ).status_code
+
+
+def _mix(spec, jobs):
+    """Return the endpoints of a --mix and their cumulative weights.
+
+    Args:
+        spec: string --mix of endpoint=weight pairs
+        jobs: list of pending and processing uuids, pending needs some
+
+    Returns:
+        tuple of (endpoints, cumulative weights, total weight)
+    """
+
+    weights = dict(
+        (name, float(weight)) for name, weight in
+        (x.split("=") for x in spec.split(","))
+    )
+    unknown = set(weights) - set(ENDPOINTS)
+    if unknown:
+        raise SystemExit("unknown endpoints: {}".format(", ".join(unknown)))
+    if not jobs:
+        weights.pop("pending", None)
+    endpoints = sorted(weights)
+    cumulative = []
+    total = 0
+    for name in endpoints:
+        total += weights[name]
+        cumulative.append(total)
+    return endpoints, cumulative, total
+
+
+def drive(args, results, jobs):
+    """Run the request mix for --duration seconds.
+
+    Args:
+        args: docopt arguments
+        results: integer stored results to view
+        jobs: list of pending and processing uuids
+
+    Returns:
+        dictionary of {endpoint: measurements}, and the total
+    """
+
+    endpoints, cumulative, total = _mix(args["--mix"], jobs)
+    latencies = {name: [] for name in endpoints}
+    errors = {name: 0 for name in endpoints}
+    deadline = time.time() + float(args["--duration"])
+
+    def _client(number):
+        rng = random.Random(number)
+        client = Client(
+            "10.{}.{}.{}".format(number // 65536, number // 256 % 256,
+                                 number % 256),
+            args["--url"],
+        )
+        while time.time() < deadline:
+            pick = rng.random() * total
+            name = endpoints[[x >= pick for x in cumulative].index(True)]
+            if name == "metrics":
+                path, accept = "/metrics", None
+            elif name == "pending":
+                path, accept = "/view/{}/".format(rng.choice(jobs)), None
+            else:
+                path = "/view/result-{}/".format(rng.randrange(results))
+                accept = "application/json" if name == "view_json" else None
+
+            start = time.time()
+            try:
+                status = client.get(path, accept=accept)
+            except Exception:
+                status = None
+            latencies[name].append(time.time() - start)
+            if status != 200:
+                errors[name] += 1
+            gevent.sleep(0)  # in process nothing else yields
+
+    start = time.time()
+    gevent.joinall([
+        gevent.spawn(_client, i) for i in range(int(args["--concurrency"]))
+    ])
+    return _measure(latencies, errors, time.time() - start)
+
+
+def _measure(latencies, errors, wall):
+    """Return {endpoint: measurements} and the total, see drive."""
+
+    measured = {}
+    everything = []
+    for name in latencies:
+        ordered = sorted(latencies[name])
+        everything.extend(ordered)
+        measured[name] = _summary(ordered, errors[name], wall)
+    measured["total"] = _summary(sorted(everything), sum(errors.values()),
+                                 wall)
+    return measured
+
+
+def _summary(ordered, errors, wall):
+    """Return the measurements of one endpoint's ordered latencies."""
+
+    return {
+        "requests": len(ordered),
+        "errors": errors,
+        "rps": len(ordered) / wall,
+        "p50": _percentile(ordered, 50) * 1000,
+        "p90": _percentile(ordered, 90) * 1000,
+        "p99": _percentile(ordered, 99) * 1000,
+        "max": (ordered[-1] if ordered else 0) * 1000,
+    }
+
+
+def _print(measured, previous=None):
+    """Print a table of measurements, with the change from previous."""
+
+    print("{:>7} {:>9} {:>8} {:>7} {:>8} {:>8} {:>8} {:>8} {:>8}{}".format(
+        "results", "endpoint", "requests", "errors", "req/s", "p50 ms",
+        "p90 ms", "p99 ms", "max ms", "  p99 vs prev" if previous else "",
+    ))
+    for size in sorted(measured, key=int):
+        for name in ENDPOINTS + ("total",):
+            if name not in measured[size]:
+                continue
+            row = measured[size][name]
+            change = ""
+            try:
+                before = previous[size][name]["p99"]
+            except (KeyError, TypeError):
+                pass
+            else:
+                if before:
+                    change = "  {:+.1f}%".format(
+                        100.0 * (row["p99"] - before) / before
+                    )
+            print(
+                "{:>7} {:>9} {:>8d} {:>7d} {:>8.1f} {:>8.1f} {:>8.1f} "
+                "{:>8.1f} {:>8.1f}{}".format(
+                    size,
+                    name,
+                    row["requests"],
+                    row["errors"],
+                    row["rps"],
+                    row["p50"],
+                    row["p90"],
+                    row["p99"],
+                    row["max"],
+                    change,
+                )
+            )
+
+
+def main():
+    """Load test entrypoint."""
+
+    args = docopt.docopt(__doc__)
+    if args["--url"] and not args["--redis"]:
+        raise SystemExit("--url needs the --redis it uses to store results")
+
+    os.environ.setdefault("ESI_KNIFE_RATE_LIMITS", "default:1000000000/1")
+    os.environ.setdefault("ESI_KNIFE_REDIS_CONNECT_TIMEOUT", "0.2")
+
+    from esi_knife import APP
+
+    # registers the frontend's routes on APP
+    importlib.import_module("esi_knife.web")
+
+    _install_redis(args["--redis"])
+    # /metrics reports on the worker, this one has nothing to do
+    APP.knife_worker = gevent.spawn(gevent.sleep, 86400)
+
+    measured = {}
+    stored = 0
+    try:
+        for size in (int(x) for x in args["--results"].split(",")):
+            start = time.time()
+            jobs = populate(stored, size, int(args["--pending"]))
+            stored = max(stored, size)
+            print("stored {} results in {:.1f}s".format(
+                stored,
+                time.time() - start,
+            ))
+            measured[str(size)] = drive(args, stored, jobs)
+    finally:
+        APP.knife_worker.kill()
+
+    previous = None
+    if args["--compare"]:
+        with open(args["--compare"], "r") as openprevious:
+            previous = json.load(openprevious)
+
+    _print(measured, previous)
+
+    if args["--json"]:
+        with open(args["--json"], "w") as openjson:
+            json.dump(measured, openjson, indent=2, sort_keys=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -5,6 +5,7 @@ import os
 import enum
 import socket
 import logging
+import threading
 
 try:
     from urllib.parse import quote
@@ -12,63 +13,134 @@ except ImportError:
     # python2
     from urllib import quote
 
-from flask_cache import Cache
-from flask import Flask
-
 
 __version__ = "0.0.2"
 
 
-ESI = os.environ.get("ESI_BASE_URL", "https://esi.evetech.net")
+def env_flag(name, default):
+    """Return the boolean setting of the environment variable name.
+
+    Anything but 0, false or no turns it on.
 
-APP = Flask(__name__)
-APP.error_limited = False
+    Args:
+        name: string environment variable name
+        default: boolean when the variable is unset or empty
+    """
+
+    value = os.environ.get(name, "").strip().lower()
+    if not value:
+        return default
+    return value not in ("0", "false", "no")
+
+
+ESI = os.environ.get("ESI_BASE_URL", "https://esi.evetech.net")
 
 
 _GUNICORN_LOG = logging.getLogger("gunicorn.error")
-APP.logger.handlers = _GUNICORN_LOG.handlers
-APP.logger.setLevel(_GUNICORN_LOG.level)  # pylint: disable=no-member
-LOG = APP.logger
-del _GUNICORN_LOG
+LOG = logging.getLogger(__name__)  # shared with APP.logger
+LOG.handlers = _GUNICORN_LOG.handlers
+LOG.setLevel(_GUNICORN_LOG.level)
 
 
-_REDIS_HOST = os.environ.get("ESI_KNIFE_REDIS_HOST", "redis")
-_REDIS_PORT = int(os.environ.get("ESI_KNIFE_REDIS_PORT", 6379))
-_TEST_SOCKET = socket.socket()
+class Lazy(object):
+    """Proxy to an object which is only built on first use.
+
+    Importing esi_knife should not build a Flask app or connect to redis,
+    the CLI only needs a fraction of either.
+    """
+
+    def __init__(self, factory):
+        object.__setattr__(self, "_factory", factory)
+        object.__setattr__(self, "_target", None)
+        object.__setattr__(self, "_lock", threading.RLock())
+
+    def _resolve(self):
+        """Build the target object if required and return it."""
+
+        if self._target is None:
+            with self._lock:
+                if self._target is None:
+                    object.__setattr__(self, "_target", self._factory())
+        return self._target
+
+    def __getattr__(self, name):
+        return getattr(self._resolve(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self._resolve(), name, value)
+
+    def __call__(self, *args, **kwargs):
+        return self._resolve()(*args, **kwargs)
+
+
+def _build_app():
+    """Create the Flask app."""
+
+    from flask import Flask
+
+    app = Flask(__name__)
+    app.error_limited = False
+    app.logger.handlers = _GUNICORN_LOG.handlers
+    app.logger.setLevel(_GUNICORN_LOG.level)  # pylint: disable=no-member
+    return app
+
+
+def _build_cache():
+    """Create the cache backend, redis if it's reachable or in memory."""
+
+    from flask_cache import Cache
+
+    redis_host = os.environ.get("ESI_KNIFE_REDIS_HOST", "redis")
+    redis_port = int(os.environ.get("ESI_KNIFE_REDIS_PORT", 6379))
+    test_socket = socket.socket()
+    test_socket.settimeout(
+        float(os.environ.get("ESI_KNIFE_REDIS_CONNECT_TIMEOUT", 2))
+    )
+
+    try:
+        test_socket.connect((redis_host, redis_port))
+    except Exception as error:
+        LOG.info("redis unavailable: %r", error)
+        return Cache(APP._resolve(), config={  # pylint: disable=W0212
+            "CACHE_TYPE": "simple",
+            "CACHE_DEFAULT_TIMEOUT": 300,
+            # results are stored as a blob per route (see storage), the
+            # default threshold of 500 entries would evict them
+            "CACHE_THRESHOLD": 1000000,
+        })
+    finally:
+        test_socket.close()
 
-try:
-    _TEST_SOCKET.connect((_REDIS_HOST, _REDIS_PORT))
-except Exception as error:
-    LOG.info("redis unavailable: %r", error)
-    CACHE = Cache(APP, config={
-        "CACHE_TYPE": "simple",
-        "CACHE_DEFAULT_TIMEOUT": 300,
-    })
-else:
     try:
         with open("/app/redis-password", "r") as openpasswd:
-            _REDIS_PASSWD = openpasswd.read().strip()
+            redis_passwd = openpasswd.read().strip()
     except Exception:
-        _REDIS_PASSWD = None
+        redis_passwd = None
 
-    CACHE = Cache(APP, config={
-        "CACHE_TYPE": os.environ.get("ESI_KNIFE_CACHE_TYPE", "redis"),
-        "CACHE_REDIS_URL": "redis://{}:{}/{}".format(
-            _REDIS_HOST,
-            _REDIS_PORT,
+    import redis
+
+    # one pool shared by the cache, pipelines and pub/sub in this process
+    pool = redis.BlockingConnectionPool.from_url(
+        "redis://{}:{}/{}".format(
+            redis_host,
+            redis_port,
             os.environ.get("ESI_KNIFE_REDIS_DB", "0"),
         ),
+        password=redis_passwd,
+        max_connections=int(os.environ.get("ESI_KNIFE_REDIS_POOL_SIZE", 50)),
+        timeout=10,
+    )
+
+    return Cache(APP._resolve(), config={  # pylint: disable=W0212
+        "CACHE_TYPE": os.environ.get("ESI_KNIFE_CACHE_TYPE", "redis"),
+        "CACHE_REDIS_HOST": redis.Redis(connection_pool=pool),
         "CACHE_DEFAULT_TIMEOUT": 300,
         "CACHE_KEY_PREFIX": "knife.",
-        "CACHE_REDIS_PASSWORD": _REDIS_PASSWD,
     })
-    del _REDIS_PASSWD
-finally:
-    _TEST_SOCKET.close()
 
-del _TEST_SOCKET
-del _REDIS_PORT
-del _REDIS_HOST
+
+APP = Lazy(_build_app)
+CACHE = Lazy(_build_cache)
 
 
 SCOPES = quote(" ".join([
@@ -147,6 +219,49 @@ EXPOSED_URL = os.environ.get(
 )
 
 
+# attribute keys that can be resolved via /universe/names/
+ID_KEYS = [
+    "type_id",
+    "creator_id",
+    "creator_corporation_id",
+    "executor_corporation_id",
+    "contact_id",
+    "alliance_id",
+    "corporation_id",
+    "issuer_corporation_id",
+    "issuer_id",
+    "ship_type_id",
+    "installer_id",
+    "blueprint_type_id",
+    "product_type_id",
+    "solar_system_id",
+    # "from",  /mail/, can include mailing lists though
+    # "recipient_id",  /mail/, can include mailing lists though
+    # "sender_id",  /notifications/, can include factions though
+    "region_id",
+    # "planet_id",  use /universe/planets/{planet_id}/
+    "skill_id",
+    # "first_party_id",  includes factions
+    # "second_party_id",  includes factions
+    "tax_receiver_id",
+    "client_id",
+    "ceo_id",
+    "home_station_id",
+    "assignee_id",
+]
+
+# TODO
+LOCATION_ID_KEYS = [
+    "location_id",
+    "end_location_id",
+    "start_location_id",
+    "blueprint_location_id",
+    "facility_id",
+    "output_location_id",
+    # "station_id",  # in industry/jobs, double check if this can be a cit
+]
+
+
 class Keys(enum.Enum):
     """Redis key prefixes."""
 
@@ -157,3 +272,14 @@ class Keys(enum.Enum):
     complete = "complete."
     alltime = "alltime."
     spec = "esijson."
+    progress = "progress."
+    staging = "staging."
+    hot = "hot."
+    blob = "blob."
+    blob_refs = "blobrefs."
+    snapshot = "snapshot."
+    inflight = "inflight."
+    recent = "recent."
+    alias = "alias."
+    trace = "trace."
+    history = "history."
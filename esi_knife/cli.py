@@ -8,42 +8,70 @@ you can host your own with instructions from https://github.com/a-tal/esi-knife
 
 Usage:
     knife [options]
+    knife export --sqlite DB FILE
 
 Options:
     -o FILE, --open FILE     open and display a previously created knife file
+    -l, --list               only list the routes in the opened knife file
+    -r ROUTE, --route ROUTE  only display this route from the opened file,
+                             either the full URL or a unique ending of it
+    -s, --stream             print the opened file as it's decompressed, with
+                             bounded memory but keys in file order (default
+                             for files over 32MB)
+    -b FILE, --batch FILE    knife every access token in FILE, one per line
+                             (use - to read tokens from stdin)
+    -c N, --concurrency N    characters to knife at once in batch mode
+                             [default: 4]
+    -p NAME, --profile NAME  what to fetch, full or quick (character routes
+                             only). defaults to $ESI_KNIFE_PROFILE or full
+    --sqlite DB              export the knife FILE to a SQLite database DB
     --client-id CLIENT_ID    client ID, if override is required
     --port PORT              callback port, if override is required
 """
 
 
 import os
+import sys
 import json
-import uuid
+import zlib
+import errno
 import base64
 import codecs
-import webbrowser
 
 import docopt
 
 from esi_knife import ESI
 from esi_knife import SCOPES
-from esi_knife.utils import request_or_wait
-from esi_knife.worker import get_results
+from esi_knife import stream
+from esi_knife import columnar
+from esi_knife import container
 
 
 try:
-    from http import server
-    from urllib.parse import parse_qsl
-    from gzip import compress
     from gzip import decompress
 except ImportError:
     # python2
-    import BaseHTTPServer as server
-    from urlparse import parse_qsl
-    from zlib import compress
     from zlib import decompress
 
 
+# the SSO flow, ESI client and worker are only imported when creating a new
+# knife file, knife --open shouldn't pay for gevent, flask, requests et al.
+
+
+def request_or_wait(*args, **kwargs):
+    """Proxy to esi_knife.utils.request_or_wait."""
+
+    from esi_knife import utils
+    return utils.request_or_wait(*args, **kwargs)
+
+
+def get_results(*args, **kwargs):
+    """Proxy to esi_knife.worker.get_results."""
+
+    from esi_knife import worker
+    return worker.get_results(*args, **kwargs)
+
+
 def get_access_token(client_id=None, port=None, scopes=None):
     """Generate a new access token.
 
@@ -59,6 +87,17 @@ def get_access_token(client_id=None, port=None, scopes=None):
         SystemExit on failure
     """
 
+    import uuid
+    import webbrowser
+
+    try:
+        from http import server
+        from urllib.parse import parse_qsl
+    except ImportError:
+        # python2
+        import BaseHTTPServer as server
+        from urlparse import parse_qsl
+
     client_id = client_id or "13927a4b444a46a3ad9a2bd99059181e"
     port = port or 27392
     if scopes is None:
@@ -164,20 +203,139 @@ def get_roles(headers, character_id):
     raise SystemExit("Could not deterine character's corporation roles")
 
 
-def display_results(filename):
-    """Display the results from a compressed .knife file."""
+def _find_route(routes, route):
+    """Return the route matching exactly, or by a unique ending.
+
+    Raises:
+        SystemExit if there isn't exactly one match
+    """
+
+    if route in routes:
+        return route
+
+    matches = [x for x in routes if x.endswith(route)]
+    if len(matches) == 1:
+        return matches[0]
+
+    raise SystemExit("{} routes match {}{}".format(
+        len(matches),
+        route,
+        "".join("\n  {}".format(x) for x in sorted(matches)),
+    ))
+
+
+def _print_routes(routes, read):
+    """Print routes as one JSON object, reading each route as it's needed.
+
+    The output is the same as json.dumps(indent=4, sort_keys=True) of the
+    whole document, without having all of it in memory.
+    """
+
+    if not routes:
+        print("{}")
+        return
+
+    print("{")
+    for i, route in enumerate(routes, 1):
+        print("    {}: {}{}".format(
+            json.dumps(route),
+            json.dumps(
+                read(route),
+                indent=4,
+                sort_keys=True,
+            ).replace("\n", "\n    "),
+            "," if i < len(routes) else "",
+        ))
+    print("}")
+
+
+STREAM_THRESHOLD = 33554432  # 32MB
+
+
+def _read_v1(filename):
+    """Return the results from a v1 (base64 gzip) .knife file."""
 
     try:
         with open(filename, "r") as infile:
-            data = json.loads(decompress(base64.b64decode(infile.read())))
+            return json.loads(decompress(base64.b64decode(infile.read())))
     except Exception as error:
         raise SystemExit("Failed to read {}: {!r}".format(filename, error))
 
-    print(json.dumps(data, indent=4, sort_keys=True))
+
+def _display_v2(filename, route, list_routes, streaming):
+    """Display the results from a v2 .knife file, see display_results."""
+
+    try:
+        reader = container.Reader(filename)
+    except Exception as error:
+        raise SystemExit("Failed to read {}: {!r}".format(
+            filename,
+            error,
+        ))
+
+    with reader:
+        routes = sorted(reader.routes())
+        if list_routes:
+            print("\n".join(routes))
+        elif streaming and route:
+            stream.write_route(
+                reader,
+                _find_route(routes, route),
+                sys.stdout,
+            )
+        elif streaming:
+            stream.write_v2(reader, sys.stdout, routes=routes)
+        elif route:
+            print(json.dumps(
+                reader.read(_find_route(routes, route)),
+                indent=4,
+                sort_keys=True,
+            ))
+        else:
+            _print_routes(routes, reader.read)
+
+
+def display_results(filename, route=None, list_routes=False, streaming=False):
+    """Display the results from a compressed .knife file.
+
+    KWargs:
+        route: only display this route, the URL or a unique ending of it
+        list_routes: boolean to only list the routes in the file
+        streaming: boolean to print while decompressing, unsorted
+    """
+
+    try:
+        streaming = streaming or os.path.getsize(filename) > STREAM_THRESHOLD
+    except OSError as error:
+        raise SystemExit("Failed to read {}: {!r}".format(filename, error))
+
+    if container.is_v2(filename):
+        _display_v2(filename, route, list_routes, streaming)
+        return
+
+    if streaming and not route and not list_routes:
+        try:
+            stream.write_v1(filename, sys.stdout)
+        except (ValueError, TypeError, zlib.error) as error:
+            raise SystemExit("Failed to read {}: {!r}".format(
+                filename,
+                error,
+            ))
+        return
+
+    data = _read_v1(filename)
+
+    if list_routes:
+        print("\n".join(sorted(data)))
+    elif route:
+        data = data[_find_route(list(data), route)]
+        print(json.dumps(data, indent=4, sort_keys=True))
+    else:
+        print(json.dumps(data, indent=4, sort_keys=True))
 
 
 def write_results(results, character_id):
-    """Write the results to a compressed .knife file."""
+    """Write the results to a compressed v2 .knife file."""
 
     fname = "{}.knife".format(character_id)
     i = 0
@@ -185,22 +343,51 @@ def write_results(results, character_id):
         i += 1
         fname = "{}-{}.knife".format(character_id, i)
 
-    with open(fname, "w") as openout:
-        openout.write(codecs.decode(
-            base64.b64encode(compress(codecs.encode(
-                json.dumps(results),
-                "utf-8",
-            ))),
-            "utf-8",
-        ))
+    with open(fname, "wb") as outfile:
+        writer = container.Writer(outfile)
+        for route in sorted(results):
+            writer.add(route, columnar.expand(results[route]))
+        writer.finish()
 
     print("created {}".format(fname))
 
 
-def run(args):
-    """Create a new knife file."""
+def export_results(filename, database):
+    """Export the results from a .knife file to a SQLite database.
+
+    v2 files are exported one route at a time, v1 files have to be loaded
+    completely first.
+    """
+
+    from esi_knife import export
+
+    if container.is_v2(filename):
+        try:
+            reader = container.Reader(filename)
+        except Exception as error:
+            raise SystemExit("Failed to read {}: {!r}".format(
+                filename,
+                error,
+            ))
+        with reader:
+            export.to_sqlite(database, reader.items())
+    else:
+        export.to_sqlite(database, sorted(_read_v1(filename).items()))
+
+    print("created {}".format(database))
 
-    token = get_access_token(args["--client-id"], args["--port"])
+
+def knife_token(token, scheduler=None, profile=None):
+    """Fetch all results for an access token and write its knife file.
+
+    Args:
+        token: SSO access token
+        scheduler: optional esi_knife.scheduler.Scheduler to share
+        profile: optional name of the esi_knife.cost profile to fetch
+
+    Raises:
+        SystemExit on error
+    """
 
     headers = {"Authorization": "Bearer {}".format(token)}
     character_id, scopes = verify_token(headers)
@@ -216,19 +403,115 @@ def run(args):
 
     roles = get_roles(headers, character_id)
 
-    results = get_results(public, character_id, scopes, roles, headers)
+    results = get_results(
+        public,
+        character_id,
+        scopes,
+        roles,
+        headers,
+        scheduler=scheduler,
+        profile=profile,
+    )
 
-    write_results(results, character_id)
+    with results:
+        write_results(results, character_id)
+
+
+def run(args):
+    """Create a new knife file."""
+
+    knife_token(
+        get_access_token(args["--client-id"], args["--port"]),
+        profile=args["--profile"],
+    )
+
+
+def run_batch(filename, concurrency, profile=None):
+    """Create a knife file for every access token in filename.
+
+    Characters are knifed concurrently on one shared scheduler, so
+    corporation and alliance routes and resolved names are only fetched
+    once for characters in the same corporation.
+
+    Args:
+        filename: path to a file of access tokens, or - for stdin
+        concurrency: integer number of characters to knife at once
+        profile: optional name of the esi_knife.cost profile to fetch
+
+    Raises:
+        SystemExit if any token failed
+    """
+
+    from concurrent.futures import as_completed
+    from concurrent.futures import ThreadPoolExecutor
+    from esi_knife.scheduler import Scheduler
+
+    try:
+        if filename == "-":
+            lines = sys.stdin.readlines()
+        else:
+            with open(filename, "r") as infile:
+                lines = infile.readlines()
+    except Exception as error:
+        raise SystemExit("Failed to read {}: {!r}".format(filename, error))
+
+    tokens = [x.strip() for x in lines if x.strip()]
+    failures = 0
+
+    with Scheduler(share=True) as scheduler:
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            futures = {
+                pool.submit(knife_token, token, scheduler, profile): i
+                for i, token in enumerate(tokens, 1)
+            }
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                except (SystemExit, Exception) as error:
+                    failures += 1
+                    print("token {} failed: {}".format(futures[future], error))
+
+    if failures:
+        raise SystemExit("{} of {} tokens failed".format(
+            failures,
+            len(tokens),
+        ))
 
 
 def main():
     """CLI entrypoint."""
 
     args = docopt.docopt(__doc__)
-    if args["--open"]:
-        display_results(args["--open"])
+    if args["export"]:
+        export_results(args["FILE"], args["--sqlite"])
+    elif args["--open"]:
+        try:
+            display_results(
+                args["--open"],
+                route=args["--route"],
+                list_routes=args["--list"],
+                streaming=args["--stream"],
+            )
+        except IOError as error:
+            if error.errno != errno.EPIPE:
+                raise
+            # the reader went away, ie knife --open | head
+            os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
     else:
-        run(args)
+        from esi_knife import cost
+        try:
+            cost.profile(args["--profile"])
+        except ValueError as error:
+            raise SystemExit(str(error))
+
+        if args["--batch"]:
+            try:
+                concurrency = max(int(args["--concurrency"]), 1)
+            except ValueError:
+                raise SystemExit("--concurrency must be a number")
+            run_batch(args["--batch"], concurrency, args["--profile"])
+        else:
+            run(args)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,156 @@
+"""Columnar compaction of homogeneous list-of-dict routes.
+
+Routes like assets, wallet journals and corporation members are long lists
+of same-shaped dictionaries. Compacted, they're held as one list per key
+instead of one dictionary per row, and columns of repetitive strings are
+dictionary encoded:
+
+    {
+        "__columnar__": 1,
+        "length": 3,
+        "columns": {"type_id": [34, 34, 35], "location_flag": [0, 0, 1]},
+        "dictionaries": {"location_flag": ["Hangar", "Cargo"]},
+        "missing": {"quantity": [2]},
+    }
+
+where "missing" lists the rows which didn't have that key at all. expand()
+returns the original list of dictionaries.
+"""
+
+
+from operator import itemgetter
+
+from esi_knife import env_flag
+
+
+MARKER = "__columnar__"
+MIN_ROWS = 16
+ENABLED = env_flag("ESI_KNIFE_COLUMNAR", True)
+
+try:
+    STRING_TYPES = (str, unicode)  # pylint: disable=undefined-variable
+except NameError:
+    STRING_TYPES = (str,)
+
+
+def is_columnar(data):
+    """Return True if data is in the compacted form."""
+
+    return isinstance(data, dict) and MARKER in data
+
+
+def _dictionary(values):
+    """Dictionary encode values if they're repetitive strings.
+
+    Returns:
+        tuple of (list of unique values, list of codes), or None
+    """
+
+    codes = {}
+    for value in values:
+        if value is not None:
+            if not isinstance(value, STRING_TYPES):
+                return None
+            codes.setdefault(value, len(codes))
+
+    if not codes or len(codes) > len(values) / 2:
+        return None
+
+    return (
+        [value for value, _ in sorted(codes.items(), key=itemgetter(1))],
+        [None if value is None else codes[value] for value in values],
+    )
+
+
+def add_column(data, key, values):
+    """Add (or replace) a column on compacted data.
+
+    Args:
+        data: columnar dictionary
+        key: string column name
+        values: list of values per row, None where the row has no value
+    """
+
+    missing = [i for i, value in enumerate(values) if value is None]
+    encoded = _dictionary(values)
+
+    data["columns"][key] = values if encoded is None else encoded[1]
+    for optional in ("dictionaries", "missing"):
+        data.get(optional, {}).pop(key, None)
+
+    if encoded is not None:
+        data.setdefault("dictionaries", {})[key] = encoded[0]
+    if missing:
+        data.setdefault("missing", {})[key] = missing
+
+
+def column(data, key):
+    """Return the decoded values of one column, None for missing rows."""
+
+    values = data["columns"][key]
+    lookup = data.get("dictionaries", {}).get(key)
+    if lookup is not None:
+        return [None if code is None else lookup[code] for code in values]
+    return values
+
+
+def compact(rows):
+    """Return rows in columnar form if enabled and they're homogeneous.
+
+    Anything other than a list of at least MIN_ROWS dictionaries is
+    returned as it was.
+    """
+
+    if not ENABLED or not isinstance(rows, list) or len(rows) < MIN_ROWS:
+        return rows
+
+    keys = []
+    seen = set()
+    for row in rows:
+        if not isinstance(row, dict):
+            return rows
+        for key in row:
+            if key not in seen:
+                seen.add(key)
+                keys.append(key)
+
+    data = {MARKER: 1, "length": len(rows), "columns": {}}
+    for key in keys:
+        values = [row.get(key) for row in rows]
+        absent = [i for i, row in enumerate(rows) if key not in row]
+        add_column(data, key, values)
+        # add_column treats every None as missing, keep explicit nulls
+        if absent:
+            data.setdefault("missing", {})[key] = absent
+        else:
+            data.get("missing", {}).pop(key, None)
+
+    if not data.get("missing", True):
+        data.pop("missing")
+
+    return data
+
+
+def expand(data):
+    """Return compacted data as a list of dictionaries, anything else as is."""
+
+    if not is_columnar(data):
+        return data
+
+    rows = [{} for _ in range(data["length"])]
+    missing = data.get("missing", {})
+    for key in data["columns"]:
+        absent = set(missing.get(key, ()))
+        for i, value in enumerate(column(data, key)):
+            if i not in absent:
+                rows[i][key] = value
+    return rows
+
+
+def expand_all(results):
+    """Expand every compacted route in a results dictionary, in place."""
+
+    for route, data in results.items():
+        if is_columnar(data):
+            results[route] = expand(data)
+    return results
@@ -0,0 +1,174 @@
+"""Seekable .knife v2 container.
+
+A v2 file is a header, then one zlib compressed JSON frame per route, then a
+compressed JSON index of the frames, then a fixed size footer pointing at
+the index:
+
+    MAGIC
+    frame, frame, ...
+    index: [[route, offset, length], ...]
+    footer: index offset (u64), index length (u64), MAGIC
+
+Readers only decompress the frames they ask for. v1 files (base64 of the
+gzipped JSON document) never start with MAGIC.
+"""
+
+
+import json
+import mmap
+import zlib
+import struct
+
+
+MAGIC = b"KNIFEv2\n"
+FOOTER = struct.Struct("<QQ")
+FOOTER_SIZE = FOOTER.size + len(MAGIC)
+
+
+def compress_frame(data):
+    """Return the compressed frame for JSON-able data."""
+
+    return zlib.compress(json.dumps(data).encode("utf-8"))
+
+
+def decompress_frame(frame):
+    """Return the data from a compressed frame."""
+
+    return json.loads(zlib.decompress(frame).decode("utf-8"))
+
+
+def is_v2(filename):
+    """Return True if filename is a v2 knife file."""
+
+    try:
+        with open(filename, "rb") as infile:
+            return infile.read(len(MAGIC)) == MAGIC
+    except (IOError, OSError):
+        return False
+
+
+class Writer(object):
+    """Write routes to a v2 container one frame at a time.
+
+    Args:
+        fileobj: binary file object opened for writing
+    """
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.index = []
+        self.offset = len(MAGIC)
+        fileobj.write(MAGIC)
+
+    def add(self, route, data):
+        """Compress and append the data for route."""
+
+        self.add_frame(route, compress_frame(data))
+
+    def add_frame(self, route, frame):
+        """Append an already compressed frame for route."""
+
+        self.fileobj.write(frame)
+        self.index.append([route, self.offset, len(frame)])
+        self.offset += len(frame)
+
+    def finish(self):
+        """Write the index and footer."""
+
+        index = zlib.compress(json.dumps(self.index).encode("utf-8"))
+        self.fileobj.write(index)
+        self.fileobj.write(FOOTER.pack(self.offset, len(index)))
+        self.fileobj.write(MAGIC)
+
+
+class Reader(object):
+    """Random access to the routes in a v2 container via mmap.
+
+    Args:
+        filename: path to the v2 knife file
+
+    Raises:
+        ValueError if the file is not a valid v2 container
+    """
+
+    def __init__(self, filename):
+        self._file = open(filename, "rb")
+        try:
+            self._map = mmap.mmap(
+                self._file.fileno(),
+                0,
+                access=mmap.ACCESS_READ,
+            )
+        except ValueError:
+            self._file.close()
+            raise ValueError("{} is empty".format(filename))
+
+        try:
+            self.index = self._read_index()
+        except Exception:
+            self.close()
+            raise
+
+        self._frames = {route: (offset, length)
+                        for route, offset, length in self.index}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def __contains__(self, route):
+        return route in self._frames
+
+    def _read_index(self):
+        """Validate the container and return its index."""
+
+        size = len(self._map)
+        if size < len(MAGIC) + FOOTER_SIZE or \
+                self._map[:len(MAGIC)] != MAGIC or \
+                self._map[size - len(MAGIC):] != MAGIC:
+            raise ValueError("not a v2 knife file")
+
+        offset, length = FOOTER.unpack_from(self._map, size - FOOTER_SIZE)
+        if offset + length > size - FOOTER_SIZE:
+            raise ValueError("corrupt v2 knife file index")
+
+        return json.loads(zlib.decompress(
+            self._map[offset:offset + length]
+        ).decode("utf-8"))
+
+    def close(self):
+        """Release the mmap and file."""
+
+        self._map.close()
+        self._file.close()
+
+    def routes(self):
+        """Return the routes in the container, in file order."""
+
+        return [route for route, _, _ in self.index]
+
+    def frame(self, route):
+        """Return the compressed frame for route."""
+
+        offset, length = self._frames[route]
+        return self._map[offset:offset + length]
+
+    def frame_chunks(self, route, size=65536):
+        """Yield the compressed frame for route in pieces of size bytes."""
+
+        offset, length = self._frames[route]
+        for start in range(offset, offset + length, size):
+            yield self._map[start:min(start + size, offset + length)]
+
+    def read(self, route):
+        """Return the data for route."""
+
+        return decompress_frame(self.frame(route))
+
+    def items(self):
+        """Yield (route, data) pairs, decompressing one route at a time."""
+
+        for route in self.routes():
+            yield route, self.read(route)
@@ -0,0 +1,116 @@
+"""Request cost estimates, budgets and fetch profiles.
+
+A job's cost is only known once its parameters are expanded: how many
+mails, contracts, wallet divisions and so on it fans out to, and how many
+pages each route has. With the expanded URLs and the route history (see
+esi_knife.history) the number of requests to fetch them is estimated
+before any are dispatched.
+
+Jobs estimated above ESI_KNIFE_MAX_REQUESTS are capped, by skipping the
+routes with the most pages until the estimate fits. Skipped routes are
+listed in the result. Jobs aren't deferred until quieter hours, their
+access tokens expire long before and can't be refreshed.
+
+Profiles choose what a job fetches at all, ESI_KNIFE_PROFILE for the
+worker or --profile for the CLI:
+
+    full   everything the token's scopes and roles allow (default)
+    quick  character routes only, nothing for the corporation or alliance
+"""
+
+
+import os
+
+from esi_knife import LOG
+
+
+PROFILES = {
+    "full": {"corporation": True, "alliance": True},
+    "quick": {"corporation": False, "alliance": False},
+}
+PROFILE = os.environ.get("ESI_KNIFE_PROFILE", "full")
+MAX_REQUESTS = int(os.environ.get("ESI_KNIFE_MAX_REQUESTS", 0))
+
+
+def profile(name=None):
+    """Return the named profile, or the configured one.
+
+    Raises:
+        ValueError if there's no such profile
+    """
+
+    name = name or PROFILE
+    try:
+        return PROFILES[name]
+    except KeyError:
+        raise ValueError("unknown profile {!r}, expected one of: {}".format(
+            name,
+            ", ".join(sorted(PROFILES)),
+        ))
+
+
+def estimate(urls, history):
+    """Return the expected number of requests to fetch urls.
+
+    Args:
+        urls: list of string URLs
+        history: history.History of the job's entities
+    """
+
+    return int(round(sum(history.expected(url)[0] for url in urls)))
+
+
+class Budget(object):
+    """Enforce the request budget on one job.
+
+    KWargs:
+        max_requests: integer most requests a job should make, 0 for any
+    """
+
+    def __init__(self, max_requests=MAX_REQUESTS):
+        self.max_requests = max_requests
+        self.estimated = 0
+        self.skipped = []
+
+    def plan(self, urls, history, report):
+        """Return the urls to fetch within the budget.
+
+        Args:
+            urls: list of string URLs the job would fetch
+            history: history.History of the job's entities
+            report: progress callable
+        """
+
+        self.estimated = estimate(urls, history)
+        report(estimated_requests=self.estimated)
+        if not self.max_requests or self.estimated <= self.max_requests:
+            return urls
+
+        # fetch the cheapest routes which fit
+        fetch = []
+        requests = 0
+        for url in sorted(urls, key=lambda x: history.expected(x)[0]):
+            pages = history.expected(url)[0]
+            if requests + pages <= self.max_requests:
+                requests += pages
+                fetch.append(url)
+            else:
+                self.skipped.append(url)
+        LOG.warning(
+            "estimated %d requests, over the budget of %d. skipping %d routes",
+            self.estimated,
+            self.max_requests,
+            len(self.skipped),
+        )
+        return fetch
+
+    def note(self):
+        """Return a description of the skipped routes for the result."""
+
+        if not self.skipped:
+            return None
+        return {
+            "estimated_requests": self.estimated,
+            "max_requests": self.max_requests,
+            "skipped": sorted(self.skipped),
+        }
@@ -0,0 +1,211 @@
+"""SQLite export of knife results.
+
+Each route becomes rows in a table named after its URL template, ie every
+/characters/{character_id}/mail/{mail_id}/ route is loaded into the
+characters_mail table. The IDs from the route's path are added as columns
+(_character_id, _mail_id) along with the route itself (_route). Nested
+objects are flattened into parent_child columns, lists are stored as JSON.
+Routes which failed to fetch are recorded in the _errors table.
+
+Routes are loaded one at a time in bulk inserts, so memory use is bounded by
+the largest route rather than the whole document.
+"""
+
+
+import re
+import json
+import sqlite3
+
+from esi_knife import ID_KEYS
+from esi_knife import LOCATION_ID_KEYS
+
+
+BATCH_SIZE = 1000
+ERRORS_TABLE = "_errors"
+
+_VERSION = re.compile(r"^(latest|legacy|dev|v[0-9]+)$")
+_HASH = re.compile(r"^[0-9a-f]{32,}$")
+_UNSAFE = re.compile(r"[^a-z0-9_]")
+
+
+def _quote(name):
+    """Return name as a quoted SQL identifier."""
+
+    return '"{}"'.format(name.replace('"', '""'))
+
+
+def table_for(route):
+    """Return the table name and path ID columns for a route URL.
+
+    Returns:
+        tuple of (string table name, dictionary of {column: id})
+    """
+
+    path = route.split("://", 1)[-1].split("?", 1)[0]
+    segments = path.strip("/").split("/")[1:]  # drop the host
+
+    names = []
+    path_ids = {}
+    previous = "route"
+    for segment in segments:
+        if segment.isdigit():
+            path_ids["_{}_id".format(previous.rstrip("s"))] = int(segment)
+        elif _HASH.match(segment):
+            path_ids["_{}_hash".format(previous.rstrip("s"))] = segment
+        elif not _VERSION.match(segment):
+            names.append(segment)
+            previous = segment
+
+    table = _UNSAFE.sub("_", "_".join(names).lower()) or "root"
+    return table, path_ids
+
+
+def _flatten(item, prefix=""):
+    """Flatten nested dictionaries into one row."""
+
+    row = {}
+    for key, value in item.items():
+        column = "{}{}".format(prefix, key)
+        if isinstance(value, dict):
+            row.update(_flatten(value, "{}_".format(column)))
+        elif isinstance(value, list):
+            row[column] = json.dumps(value)
+        elif isinstance(value, bool):
+            row[column] = int(value)
+        else:
+            row[column] = value
+    return row
+
+
+def rows_for(data):
+    """Yield rows (dictionaries) for a route's data."""
+
+    if isinstance(data, dict):
+        data = [data]
+    elif not isinstance(data, list):
+        data = [data]
+
+    for item in data:
+        if isinstance(item, dict):
+            yield _flatten(item)
+        elif isinstance(item, list):
+            yield {"value": json.dumps(item)}
+        else:
+            yield _flatten({"value": item})
+
+
+def _sql_type(value):
+    """Return the column type for a python value."""
+
+    if isinstance(value, (bool, int)):
+        return "INTEGER"
+    if isinstance(value, float):
+        return "REAL"
+    return "TEXT"
+
+
+class Exporter(object):
+    """Load routes into a SQLite database.
+
+    Args:
+        path: database file to create or add to
+        index_columns: columns to index in any table they appear in
+    """
+
+    def __init__(self, path, index_columns=()):
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("PRAGMA journal_mode=OFF")
+        self.connection.execute("PRAGMA synchronous=OFF")
+        self.index_columns = set(index_columns)
+        self.tables = {}  # {table: [column, ...]}
+
+    def _ensure_columns(self, table, rows):
+        """Create table and any columns in rows it doesn't have yet."""
+
+        if table not in self.tables:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS {} ({} TEXT)".format(
+                    _quote(table),
+                    _quote("_route"),
+                )
+            )
+            self.tables[table] = [
+                x[1] for x in self.connection.execute(
+                    "PRAGMA table_info({})".format(_quote(table))
+                )
+            ]
+
+        columns = self.tables[table]
+        known = set(columns)
+        for row in rows:
+            for column, value in row.items():
+                if column not in known:
+                    self.connection.execute(
+                        "ALTER TABLE {} ADD COLUMN {} {}".format(
+                            _quote(table),
+                            _quote(column),
+                            _sql_type(value),
+                        )
+                    )
+                    columns.append(column)
+                    known.add(column)
+        return columns
+
+    def _insert(self, table, rows):
+        """Bulk insert one batch of rows."""
+
+        columns = self._ensure_columns(table, rows)
+        self.connection.executemany(
+            "INSERT INTO {} ({}) VALUES ({})".format(
+                _quote(table),
+                ", ".join(_quote(x) for x in columns),
+                ", ".join("?" for _ in columns),
+            ),
+            [tuple(row.get(x) for x in columns) for row in rows],
+        )
+
+    def add(self, route, data):
+        """Load one route's data."""
+
+        if isinstance(data, str) and data.startswith("Error fetching data"):
+            self._insert(ERRORS_TABLE, [{"_route": route, "error": data}])
+            return
+
+        table, path_ids = table_for(route)
+        batch = []
+        for row in rows_for(data):
+            row.update(path_ids)
+            row["_route"] = route
+            batch.append(row)
+            if len(batch) >= BATCH_SIZE:
+                self._insert(table, batch)
+                batch = []
+
+        if batch:
+            self._insert(table, batch)
+
+    def finish(self):
+        """Index the ID columns, commit and close the database."""
+
+        for table, columns in self.tables.items():
+            for column in columns:
+                if column in self.index_columns or (
+                        column.startswith("_") and column.endswith("_id")):
+                    self.connection.execute(
+                        "CREATE INDEX IF NOT EXISTS {} ON {} ({})".format(
+                            _quote("idx_{}_{}".format(table, column)),
+                            _quote(table),
+                            _quote(column),
+                        )
+                    )
+        self.connection.commit()
+        self.connection.close()
+
+
+def to_sqlite(path, routes):
+    """Write (route, data) pairs to a SQLite database at path."""
+
+    exporter = Exporter(path, index_columns=ID_KEYS + LOCATION_ID_KEYS)
+    for route, data in routes:
+        exporter.add(route, data)
+    exporter.finish()
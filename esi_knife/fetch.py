@@ -0,0 +1,316 @@
+"""Fetching a job's routes, with their pages and killmails.
+
+Routes are requested longest expected work first, along with the pages the
+route history (see esi_knife.history) expects them to have. Later pages are
+spooled until every page of the route is in, then merged into the results.
+Routes the snapshot can reuse aren't requested at all.
+"""
+
+
+import re
+from concurrent.futures import as_completed
+
+from esi_knife import ESI
+from esi_knife import LOG
+from esi_knife import tracing
+from esi_knife import columnar
+from esi_knife import immutable
+from esi_knife.spool import Spool
+from esi_knife.spool import JOB_MEMORY
+
+
+KILLMAILS_ROUTE = re.compile(
+    r".*/(characters|corporations)/[0-9]+/killmails/recent/$"
+)
+KILLMAIL_ROUTE = re.compile(r".*/killmails/[0-9]+/[0-9a-f]+/$")
+
+
+def auctions(contracts):
+    """Return the set of IDs of auction contracts, the only ones with bids."""
+
+    if not isinstance(contracts, list):
+        return set()
+
+    return set(
+        contract["contract_id"] for contract in contracts
+        if isinstance(contract, dict) and "contract_id" in contract and
+        contract.get("type") == "auction"
+    )
+
+
+def is_bidless(url, auction_ids):
+    """Return True if url is of the bids on a contract with none."""
+
+    match = immutable.BIDS_ROUTE.match(url)
+    return bool(match) and int(match.group("contract_id")) not in auction_ids
+
+
+class _Pages(object):
+    """Later pages of routes, spooled until they're merged.
+
+    Pages are only read back once, to be merged, so little of them is kept
+    in memory.
+    """
+
+    def __init__(self):
+        self.spool = Spool(budget=JOB_MEMORY // 4)
+        self.pages = {}  # {url: [page, ...]}
+        self.last = {}  # {url: number of pages}, from the first page
+        self.speculated = {}  # {url: set of pages requested early}
+
+    def add(self, url, page, data):
+        """Keep a page of url."""
+
+        self.pages.setdefault(url, []).append(page)
+        self.spool[(url, page)] = data
+
+    def merge(self, results):
+        """Add each paged route to results, in page order."""
+
+        with self.spool:
+            for url, pages in self.pages.items():
+                if url not in self.last:
+                    continue  # speculated, but the route wasn't paged
+                data = []
+                for page in sorted(pages):
+                    if page <= self.last[url]:
+                        data.extend(self.spool.pop((url, page)))
+                if data:
+                    results[url] = columnar.compact(data)
+
+
+class Fetch(object):  # pylint: disable=R0902
+    """Fetch a job's routes into its results.
+
+    Args:
+        results: Spool of {url: data} to add to
+        scheduler: scheduler.Scheduler to request with
+        snapshot: snapshot.Snapshot of the job
+        history: history.History of the job's entities
+        headers: dictionary of request headers
+
+    KWargs:
+        trace: tracing.Trace to record requests in
+        retries: retry.Budget of the job
+    """
+
+    def __init__(self, results, scheduler,  # pylint: disable=R0913
+                 snapshot, history, headers, trace=tracing.NULL,
+                 retries=None):
+        self.results = results
+        self.scheduler = scheduler
+        self.snapshot = snapshot
+        self.history = history
+        self.progress = {"routes_done": 0, "pages_fetched": 0}
+        self.finished_contracts = set()
+        self.auctions = set()
+        self._request = {"headers": headers, "trace": trace,
+                         "retries": retries}
+        self._pages = _Pages()
+
+    def add_expanded(self, expanded):
+        """Add the routes fetched to expand the job's parameters.
+
+        Args:
+            expanded: dictionary of {url: data} from worker.expand_params
+        """
+
+        for url, data in expanded.items():
+            if url.endswith("/contracts/"):
+                self.finished_contracts.update(
+                    immutable.finished_contracts(data)
+                )
+                self.auctions.update(auctions(data))
+            self.results[url] = columnar.compact(data)
+
+    def plan(self, urls, budget, report):
+        """Return the urls to fetch within the cost.Budget.
+
+        Bids are only requested for auctions. Routes reused from the
+        snapshot cost nothing, they're always kept.
+        """
+
+        urls = [x for x in urls if not is_bidless(x, self.auctions)]
+        fresh = set(
+            url for url in urls if self.snapshot.fresh(
+                url,
+                immutable=immutable.cacheable(url, self.finished_contracts),
+            )
+        )
+        planned = set(budget.plan(
+            [x for x in urls if x not in fresh],
+            self.history,
+            report,
+        ))
+        return [x for x in urls if x in fresh or x in planned]
+
+    def run(self, urls, report):
+        """Fetch urls and all of their pages.
+
+        Args:
+            urls: list of string URLs
+            report: progress callable
+        """
+
+        futures = {}  # {future: response details, None for later pages}
+        for url in sorted(urls, key=self.history.work, reverse=True):
+            self._submit(
+                url,
+                futures,
+                immutable.cacheable(url, self.finished_contracts),
+            )
+
+        self.progress["routes_done"] = len(urls) - sum(
+            1 for x in futures.values() if x is not None
+        )
+        report(phase="fetch", routes_total=len(urls), **self.progress)
+
+        while futures:
+            expansion = {}
+            for future in as_completed(futures):
+                self._receive(future, futures[future], expansion)
+                report(**self.progress)
+            futures = expansion
+
+        self._pages.merge(self.results)
+
+    def _submit(self, url, futures, cache):
+        """Request url, and the pages we expect it to have."""
+
+        if self.snapshot.reuse(url, immutable=cache):
+            return
+
+        meta = {}
+        headers = self.snapshot.headers(url, self._request["headers"])
+        futures[self.scheduler.submit(url, **dict(
+            self._request,
+            headers=headers,
+            meta=meta,
+            cache=cache,
+        ))] = meta
+        if "If-None-Match" in headers:
+            return
+
+        for page in self.history.speculative_pages(url):
+            self._pages.speculated.setdefault(url, set()).add(page)
+            futures[self.scheduler.submit(
+                url,
+                page=page,
+                **self._request
+            )] = None
+
+    def _receive(self, future, meta, expansion):
+        """Handle a response, requesting any pages it has in expansion.
+
+        Args:
+            future: completed Future of the request
+            meta: dictionary of response details, None for later pages
+            expansion: dictionary of {future: None} for later pages
+        """
+
+        pages, url, result = future.result()
+        self.progress["pages_fetched"] += 1
+        if meta is None:
+            if isinstance(pages, int):
+                self._pages.add(url, pages, result)
+            return
+
+        paged = bool(pages and isinstance(pages, list))
+        self.progress["routes_done"] += 1
+        self.history.observe(url, len(pages) + 1 if paged else 1, meta)
+        if self.snapshot.record(url, meta, paged=paged):
+            return  # not modified, the previous data is reused
+
+        if not paged:
+            self.results[url] = columnar.compact(result)
+            return
+
+        self._pages.last[url] = pages[-1]
+        self._pages.add(url, 1, result)
+        for page in pages:
+            if page not in self._pages.speculated.get(url, ()):
+                expansion[self.scheduler.submit(
+                    url,
+                    page=page,
+                    **self._request
+                )] = None
+
+    def hydrate_killmails(self):
+        """Fetch the killmails listed in the recent killmails routes.
+
+        Killmails never change, they're fetched via the immutable cache and
+        reused from the snapshot whenever possible.
+        """
+
+        urls = set()
+        for route in self.results:
+            if KILLMAILS_ROUTE.match(route):
+                killmails = columnar.expand(self.results[route])
+                if not isinstance(killmails, list):
+                    continue
+                urls.update(
+                    "{}/latest/killmails/{}/{}/".format(
+                        ESI,
+                        killmail["killmail_id"],
+                        killmail["killmail_hash"],
+                    ) for killmail in killmails
+                    if isinstance(killmail, dict)
+                )
+
+        if any(KILLMAILS_ROUTE.match(x) for x in self.snapshot.reused):
+            # the lists weren't fetched again, keep what they hydrated to
+            urls.update(
+                x for x in self.snapshot.previous if KILLMAIL_ROUTE.match(x)
+            )
+
+        futures = {}
+        for url in urls:
+            if self.snapshot.reuse(url, immutable=True):
+                continue
+            meta = {}
+            futures[self.scheduler.submit(url, **dict(
+                self._request,
+                headers=None,
+                meta=meta,
+                cache=True,
+            ))] = meta
+
+        for future in as_completed(futures):
+            _, url, data = future.result()
+            self.snapshot.record(url, futures[future])
+            self.results[url] = data
+
+    def refetch_expired(self):
+        """Fetch routes again whose reused blobs expired during the job."""
+
+        urls = self.snapshot.drop_expired()
+        if urls:
+            LOG.warning("fetching %d expired routes again", len(urls))
+
+        futures = {}
+        for url in urls:
+            meta = {}
+            futures[self.scheduler.submit(
+                url,
+                meta=meta,
+                **self._request
+            )] = meta
+
+        for future in as_completed(futures):
+            pages, url, data = future.result()
+            paged = bool(pages and isinstance(pages, list))
+            if paged:
+                rest = [self.scheduler.submit(
+                    url,
+                    page=x,
+                    **self._request
+                ) for x in pages]
+                for page in rest:
+                    page_data = page.result()[2]
+                    if isinstance(page_data, list):
+                        data.extend(page_data)
+                    else:
+                        LOG.warning("worker page expansion error: %r",
+                                    page_data)
+            self.snapshot.record(url, futures[future], paged=paged)
+            self.results[url] = columnar.compact(data)
@@ -0,0 +1,163 @@
+"""Page counts and latency of previous requests, for ordering fetches.
+
+After each job the number of pages and the latency of every paged or
+unpaged route requested is saved against the character, corporation or
+alliance in its URL, along with a moving average for each route template.
+The next job touching the same entities submits its routes longest
+expected work first, so a route with hundreds of pages isn't discovered
+last while the request pool sits idle, and requests the pages it expects
+along with the first rather than waiting for its X-Pages header.
+
+Routes never seen for the entity use their template's average, and routes
+never seen at all are assumed to be one quick page.
+"""
+
+
+import re
+
+from esi_knife import LOG
+from esi_knife import env_flag
+from esi_knife import Keys
+from esi_knife import utils
+from esi_knife import tracing
+
+
+ENABLED = env_flag("ESI_KNIFE_HISTORY", True)
+SPECULATE = env_flag("ESI_KNIFE_SPECULATE", True)
+
+DEFAULT_SECONDS = 0.5  # latency of a route we know nothing about
+SMOOTHING = 0.3  # weight of the latest job in the template averages
+SPECULATIVE_MARGIN = 1  # pages short of the last count to request early
+
+ENTITY = re.compile(r"/(characters|corporations|alliances)/([0-9]+)/")
+ENTITY_PARAMS = {
+    "character_id": "characters",
+    "corporation_id": "corporations",
+    "alliance_id": "alliances",
+}
+ROUTES_KEY = "{}routes".format(Keys.history.value)
+
+
+def _entity_key(url):
+    """Return the history key of the entity in url, or None."""
+
+    match = ENTITY.search(url)
+    if match is None:
+        return None
+    return "{}{}.{}".format(Keys.history.value, *match.groups())
+
+
+class History(object):
+    """Previous page counts and latency, and those observed by this job.
+
+    Args:
+        entities: dictionary of {entity key: {url: [pages, seconds]}}
+        routes: dictionary of {route template: [pages, seconds]}
+    """
+
+    def __init__(self, entities=None, routes=None):
+        self.entities = entities or {}
+        self.routes = routes or {}
+        self.urls = {}  # {url: [pages, seconds]} of every entity
+        for entries in self.entities.values():
+            self.urls.update(entries)
+        self.observed = {}  # {url: [pages, seconds]}
+
+    @classmethod
+    def load(cls, known_params):
+        """Return the History of the entities in known_params.
+
+        Args:
+            known_params: dictionary of character_id, and optionally
+                          corporation_id and alliance_id
+        """
+
+        if not ENABLED:
+            return cls()
+
+        keys = [
+            "{}{}.{}".format(Keys.history.value, ENTITY_PARAMS[param], value)
+            for param, value in sorted(known_params.items())
+            if param in ENTITY_PARAMS
+        ]
+        try:
+            batch = utils.Batch(transaction=False)
+            for key in keys + [ROUTES_KEY]:
+                batch.get(key)
+            loaded = batch.execute()
+        except Exception as error:
+            LOG.warning("failed to load history: %r", error)
+            return cls()
+
+        return cls(
+            {key: entries or {} for key, entries in zip(keys, loaded)},
+            loaded[-1] or {},
+        )
+
+    def expected(self, url):
+        """Return the expected (pages, seconds per page) of url."""
+
+        entry = self.urls.get(url) or self.routes.get(tracing.template(url))
+        if entry is None:
+            return 1, DEFAULT_SECONDS
+        return entry[0], entry[1]
+
+    def work(self, url):
+        """Return the expected seconds of requests to fetch url."""
+
+        pages, seconds = self.expected(url)
+        return pages * seconds
+
+    def speculative_pages(self, url):
+        """Return the pages after the first to request along with it.
+
+        Only the entity's own history is used, and pages near the end are
+        left for X-Pages, requesting a page past the end is an error.
+        """
+
+        if not SPECULATE or url not in self.urls:
+            return []
+        return list(range(2, self.urls[url][0] + 1 - SPECULATIVE_MARGIN))
+
+    def observe(self, url, pages, meta):
+        """Record a route's first page.
+
+        Args:
+            url: string URL requested
+            pages: integer number of pages the route has
+            meta: dictionary of response details from request_or_wait
+        """
+
+        if meta.get("status") == 200 and "elapsed" in meta:
+            self.observed[url] = [pages, round(meta["elapsed"], 3)]
+
+    def save(self):
+        """Save the observed page counts and latency."""
+
+        if not ENABLED or not self.observed:
+            return
+
+        templates = {}  # {template: [[pages, seconds], ...]}
+        for url, entry in self.observed.items():
+            key = _entity_key(url)
+            if key is not None:
+                self.entities.setdefault(key, {})[url] = entry
+            templates.setdefault(tracing.template(url), []).append(entry)
+
+        for template, entries in templates.items():
+            pages = sum(x[0] for x in entries) / float(len(entries))
+            seconds = sum(x[1] for x in entries) / float(len(entries))
+            previous = self.routes.get(template)
+            if previous is not None:
+                pages = previous[0] + SMOOTHING * (pages - previous[0])
+                seconds = previous[1] + SMOOTHING * (seconds - previous[1])
+            self.routes[template] = [round(pages, 1), round(seconds, 3)]
+
+        try:
+            batch = utils.Batch(transaction=False)
+            for key, entries in self.entities.items():
+                batch.set(key, entries, timeout=utils.EXPIRY)
+            batch.set(ROUTES_KEY, self.routes, timeout=utils.EXPIRY)
+            batch.execute()
+        except Exception as error:
+            LOG.warning("failed to save history: %r", error)
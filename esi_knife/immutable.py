@@ -0,0 +1,117 @@
+"""In-process cache of ESI resources which never change.
+
+Mail bodies, killmails, contract items and calendar event details are the
+same every time they're requested, as are the bids on a contract which is
+no longer open. They're kept here by URL, compressed, in a least recently
+used cache bounded to ESI_KNIFE_IMMUTABLE_CACHE bytes and shared by every
+job in the process.
+"""
+
+
+import os
+import re
+import zlib
+import threading
+from collections import OrderedDict
+
+import ujson
+
+
+MAX_BYTES = int(os.environ.get("ESI_KNIFE_IMMUTABLE_CACHE", 67108864))
+
+IMMUTABLE_ROUTES = [
+    re.compile(r".*/characters/[0-9]+/mail/[0-9]+/$"),
+    re.compile(r".*/characters/[0-9]+/calendar/[0-9]+/$"),
+    re.compile(
+        r".*/(characters|corporations)/[0-9]+/contracts/[0-9]+/items/$"
+    ),
+    re.compile(r".*/killmails/[0-9]+/[0-9a-f]+/$"),
+]
+BIDS_ROUTE = re.compile(
+    r".*/(characters|corporations)/[0-9]+/contracts/(?P<contract_id>[0-9]+)"
+    r"/bids/$"
+)
+OPEN_CONTRACT_STATES = ("outstanding", "in_progress")
+
+
+def cacheable(url, finished=()):
+    """Return True if the resource at url can be cached forever.
+
+    Args:
+        url: string URL
+        finished: contract IDs which are no longer open
+    """
+
+    if any(route.match(url) for route in IMMUTABLE_ROUTES):
+        return True
+
+    match = BIDS_ROUTE.match(url)
+    return bool(match) and int(match.group("contract_id")) in finished
+
+
+def finished_contracts(contracts):
+    """Return the set of IDs of contracts which are no longer open."""
+
+    if not isinstance(contracts, list):
+        return set()
+
+    return set(
+        contract["contract_id"] for contract in contracts
+        if isinstance(contract, dict) and "contract_id" in contract and
+        contract.get("status") not in OPEN_CONTRACT_STATES
+    )
+
+
+class LRU(object):
+    """Thread safe least recently used cache of JSON-able values.
+
+    Values are stored compressed, and copies are returned.
+
+    Args:
+        max_bytes: integer compressed bytes to hold
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """Return a copy of the value for key, or None."""
+
+        with self._lock:
+            frame = self._entries.pop(key, None)
+            if frame is None:
+                self.misses += 1
+                return None
+            self._entries[key] = frame  # most recently used
+            self.hits += 1
+
+        return ujson.loads(zlib.decompress(frame).decode("utf-8"))
+
+    def put(self, key, value):
+        """Store value for key, evicting the least recently used."""
+
+        frame = zlib.compress(ujson.dumps(value).encode("utf-8"))
+        if len(frame) > self.max_bytes:
+            return
+
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.size -= len(previous)
+
+            self._entries[key] = frame
+            self.size += len(frame)
+            while self.size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.size -= len(evicted)
+
+
+RESOURCES = LRU(MAX_BYTES)
@@ -0,0 +1,148 @@
+"""Hub blocking detection and sampling profiles of a running process.
+
+The web frontend and the worker share one gevent hub per process, any
+greenlet which runs without yielding stalls everything else. With
+ESI_KNIFE_BLOCKING_THRESHOLD set to a number of seconds, gevent's monitor
+thread reports each block longer than that, the greenlet's stack is logged
+and the most recent blocks are kept for /debug/blocks.
+
+sample() profiles whatever the hub's thread is running, from a native
+thread, as folded stacks for flamegraph.pl or speedscope. The web frontend
+serves both at /debug/ endpoints when ESI_KNIFE_DEBUG_TOKEN is set.
+"""
+
+
+import os
+import sys
+import time
+import threading
+import warnings
+import traceback
+from collections import deque
+from collections import Counter
+
+import gevent
+from gevent import events
+from gevent.monkey import get_original
+
+from esi_knife import LOG
+
+
+BLOCKING_THRESHOLD = float(os.environ.get("ESI_KNIFE_BLOCKING_THRESHOLD", 0))
+DEBUG_TOKEN = os.environ.get("ESI_KNIFE_DEBUG_TOKEN")
+MAX_SAMPLE_SECONDS = 60
+SAMPLE_INTERVAL = 0.005
+
+BLOCKS = deque(maxlen=50)  # [{time, seconds, greenlet, stack}], newest last
+_INSTALLED = []
+_SAMPLING = threading.Lock()
+
+# native versions, for the sampling thread and to identify the hub's
+_sleep = get_original("time", "sleep")
+_get_ident = get_original("_thread", "get_ident")
+
+
+def _blocked(event):
+    """Log and keep an EventLoopBlocked event."""
+
+    if not isinstance(event, events.EventLoopBlocked):
+        return
+
+    # called from the monitor thread while the hub's is still blocked
+    frame = sys._current_frames().get(  # pylint: disable=W0212
+        getattr(event.hub, "thread_ident", None)
+    )
+    if frame is None:
+        stack = "\n".join(event.info)
+    else:
+        stack = "".join(traceback.format_stack(frame)).rstrip()
+    BLOCKS.append({
+        "time": time.time(),
+        "seconds": event.blocking_time,
+        "greenlet": repr(event.greenlet),
+        "stack": stack,
+    })
+    LOG.warning(
+        "hub blocked for over %.3fs by %r:\n%s",
+        event.blocking_time,
+        event.greenlet,
+        stack,
+    )
+
+
+def install():
+    """Start reporting hub blocks, if ESI_KNIFE_BLOCKING_THRESHOLD is set.
+
+    Safe to call more than once.
+    """
+
+    if BLOCKING_THRESHOLD <= 0 or _INSTALLED:
+        return
+
+    _INSTALLED.append(True)
+    gevent.config.monitor_thread = True
+    gevent.config.max_blocking_time = BLOCKING_THRESHOLD
+    gevent.config.print_blocking_reports = False  # logged by _blocked
+    events.subscribers.append(_blocked)
+    with warnings.catch_warnings():
+        # memory monitoring wants psutil, it's not used here
+        warnings.filterwarnings("ignore", "Unable to monitor memory")
+        gevent.get_hub().start_periodic_monitoring_thread()
+    LOG.info("reporting hub blocks over %.3fs", BLOCKING_THRESHOLD)
+
+
+def _label(frame):
+    """Return a folded stack label for a frame."""
+
+    code = frame.f_code
+    return "{} ({}:{})".format(
+        code.co_name,
+        os.path.basename(code.co_filename),
+        code.co_firstlineno,
+    )
+
+
+def _sample(thread_id, seconds, interval):
+    """Sample the stack of thread_id, returning a Counter of stacks."""
+
+    stacks = Counter()
+    deadline = time.time() + seconds
+    while time.time() < deadline:
+        frame = sys._current_frames().get(thread_id)  # pylint: disable=W0212
+        labels = []
+        while frame is not None:
+            labels.append(_label(frame))
+            frame = frame.f_back
+        if labels:
+            stacks[";".join(reversed(labels))] += 1
+        _sleep(interval)
+    return stacks
+
+
+def sample(seconds, interval=SAMPLE_INTERVAL):
+    """Profile the calling thread, and so its hub, for a number of seconds.
+
+    Sampling happens on a native thread, the calling greenlet waits without
+    blocking the hub. Only one profile runs at a time.
+
+    Returns:
+        string of folded stacks, one "frame;frame;frame count" per line, or
+        None if a profile is already running
+    """
+
+    if not _SAMPLING.acquire(False):
+        return None
+
+    try:
+        seconds = min(max(float(seconds), 0), MAX_SAMPLE_SECONDS)
+        stacks = gevent.get_hub().threadpool.apply(
+            _sample,
+            (_get_ident(), seconds, interval),
+        )
+    finally:
+        _SAMPLING.release()
+
+    return "".join(
+        "{} {}\n".format(stack, count)
+        for stack, count in stacks.most_common()
+    )
@@ -0,0 +1,154 @@
+"""Live job progress for ESI knife.
+
+The worker publishes a small state dictionary for each job as it runs, the
+web frontend streams those states to the pending page. With redis the
+states are fanned out over pub/sub so any web process can serve the stream,
+without it (the simple cache) the worker and web share one process.
+"""
+
+
+import time
+import threading
+
+import redis
+import ujson
+
+from esi_knife import LOG
+from esi_knife import Keys
+from esi_knife import CACHE
+
+
+PROGRESS_EXPIRY = 7200
+PUBLISH_INTERVAL = 0.5  # seconds between non-phase change publishes
+KEEPALIVE = 15  # seconds between keepalives on an idle stream
+STREAM_DURATION = 300  # seconds before the client is asked to reconnect
+FINAL_PHASES = ("complete",)
+
+_STATES = {}  # {uuid: state}, for jobs running in this process
+_PUBLISHED = {}  # {uuid: time of last publish}
+_LOCK = threading.Lock()
+_CONDITION = threading.Condition()
+_SUBSCRIBERS = []  # redis client for long lived subscriptions
+
+
+def _key(uuid):
+    """Return the cache key for a job's progress."""
+
+    return "{}{}".format(Keys.progress.value, uuid)
+
+
+def _channel(uuid):
+    """Return the redis pub/sub channel for a job's progress."""
+
+    return "{}{}".format(getattr(CACHE.cache, "key_prefix", ""), _key(uuid))
+
+
+def publish(uuid, **update):
+    """Merge update into the job's progress and notify any listeners.
+
+    Updates within the same phase are throttled to one per PUBLISH_INTERVAL,
+    the latest numbers are sent along with the next publish.
+
+    Args:
+        uuid: string uuid token
+        update: progress fields to update, ie phase, routes_done
+    """
+
+    with _LOCK:
+        state = _STATES.setdefault(uuid, {})
+        phase_changed = update.get("phase", state.get("phase")) != \
+            state.get("phase")
+        state.update(update)
+
+        now = time.time()
+        if not phase_changed and \
+                now - _PUBLISHED.get(uuid, 0) < PUBLISH_INTERVAL:
+            return
+
+        _PUBLISHED[uuid] = now
+        snapshot = dict(state)
+        if snapshot.get("phase") in FINAL_PHASES:
+            _STATES.pop(uuid)
+            _PUBLISHED.pop(uuid)
+
+    try:
+        CACHE.set(_key(uuid), snapshot, timeout=PROGRESS_EXPIRY)
+        client = getattr(CACHE.cache, "_client", None)
+        if client is not None:
+            client.publish(_channel(uuid), ujson.dumps(snapshot))
+        else:
+            with _CONDITION:
+                _CONDITION.notify_all()
+    except Exception as error:
+        LOG.warning("failed to publish progress for %s: %r", uuid, error)
+
+
+def reporter(uuid):
+    """Return a callable which publishes progress for uuid."""
+
+    def _report(**update):
+        """Publish a progress update."""
+
+        publish(uuid, **update)
+
+    return _report
+
+
+def current(uuid):
+    """Return the last published progress for uuid, or None."""
+
+    return CACHE.get(_key(uuid))
+
+
+def _subscriber(client):
+    """Return a redis client for subscriptions.
+
+    Subscriptions hold their connection for the life of the stream, so they
+    get their own pool rather than starving the shared one.
+    """
+
+    if not _SUBSCRIBERS:
+        _SUBSCRIBERS.append(redis.Redis(connection_pool=redis.ConnectionPool(
+            connection_class=client.connection_pool.connection_class,
+            **client.connection_pool.connection_kwargs
+        )))
+    return _SUBSCRIBERS[0]
+
+
+def listen(uuid):
+    """Yield progress states for a job as they change.
+
+    The current state is always yielded first, then each new state. None is
+    yielded every KEEPALIVE seconds without a change. Stops after the job
+    reaches a final phase or after STREAM_DURATION seconds.
+    """
+
+    pubsub = None
+    client = getattr(CACHE.cache, "_client", None)
+    if client is not None:
+        pubsub = _subscriber(client).pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(_channel(uuid))
+
+    try:
+        last = current(uuid)
+        yield last
+
+        deadline = time.time() + STREAM_DURATION
+        while time.time() < deadline and \
+                (last or {}).get("phase") not in FINAL_PHASES:
+            if pubsub is not None:
+                message = pubsub.get_message(timeout=KEEPALIVE)
+                state = ujson.loads(message["data"]) if message else None
+            else:
+                with _CONDITION:
+                    _CONDITION.wait(KEEPALIVE)
+                state = current(uuid)
+                if state == last:
+                    state = None
+
+            if state is not None:
+                last = state
+            yield state
+    finally:
+        if pubsub is not None:
+            pubsub.close()
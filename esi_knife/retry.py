@@ -0,0 +1,248 @@
+"""Retries with jittered backoff, and circuit breakers per route.
+
+Every ESI request goes through utils.request_or_wait, which retries 5xx
+responses and connection errors here. Each retry sleeps for a random time
+up to an exponentially growing backoff, and is taken from the job's retry
+budget, so a job which hits a bad patch of ESI can't spend the error limit
+on retries alone.
+
+Each route template has a circuit breaker, shared by all jobs in the
+process. After ESI_KNIFE_BREAKER_FAILURES consecutive 5xx responses or
+connection errors the breaker opens, and requests to the route fail
+without being made. One request is let through per cooldown to find out
+if the route has recovered. The 420 error limit is ESI wide, not the
+route's fault, it's waited out without counting as an attempt.
+"""
+
+
+import os
+import time
+import random
+import threading
+
+import gevent
+
+from esi_knife import APP
+from esi_knife import LOG
+from esi_knife import tracing
+
+
+ATTEMPTS = int(os.environ.get("ESI_KNIFE_RETRY_ATTEMPTS", 3))
+BUDGET = int(os.environ.get("ESI_KNIFE_RETRY_BUDGET", 100))
+BACKOFF = 0.5  # seconds, doubled each attempt
+BACKOFF_CAP = 30
+BREAKER_FAILURES = int(os.environ.get("ESI_KNIFE_BREAKER_FAILURES", 5))
+BREAKER_COOLDOWN = float(os.environ.get("ESI_KNIFE_BREAKER_COOLDOWN", 60))
+
+BREAKERS = {}  # {route template: Breaker}
+_BREAKERS_LOCK = threading.Lock()
+
+
+def retryable(status):
+    """Return True if a failed request's status (None if unanswered) is."""
+
+    return status is None or status >= 500
+
+
+def backoff(attempt):
+    """Return seconds to wait before retrying after attempt tries."""
+
+    return random.uniform(0, min(BACKOFF_CAP, BACKOFF * 2 ** attempt))
+
+
+class Budget(object):
+    """Retries left for one job.
+
+    Args:
+        retries: integer retries the job may make
+    """
+
+    def __init__(self, retries=BUDGET):
+        self.left = retries
+        self._lock = threading.Lock()
+
+    def take(self):
+        """Take a retry from the budget, returning False if it's spent."""
+
+        with self._lock:
+            if self.left <= 0:
+                return False
+            self.left -= 1
+            return True
+
+
+class Breaker(object):
+    """Circuit breaker of one route template.
+
+    Args:
+        name: string route template
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.failures = 0  # consecutive
+        self.trips = 0
+        self.opened = None  # timestamp, or None while closed
+        self.last_attempt = 0
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """Return True if a request to the route should be made."""
+
+        if self.opened is None or BREAKER_FAILURES <= 0:
+            return True
+
+        with self._lock:
+            now = time.time()
+            if now - self.last_attempt >= BREAKER_COOLDOWN:
+                self.last_attempt = now
+                return True  # a trial request, to see if it's recovered
+            return False
+
+    def record(self, success):
+        """Record the outcome of a request to the route."""
+
+        with self._lock:
+            if success:
+                if self.opened is not None:
+                    LOG.info("circuit for %s closed", self.name)
+                self.failures = 0
+                self.opened = None
+                return
+
+            self.failures += 1
+            if BREAKER_FAILURES <= 0 or self.failures < BREAKER_FAILURES:
+                return
+            if self.opened is None:
+                self.trips += 1
+                self.opened = time.time()
+                LOG.warning(
+                    "circuit for %s opened after %d failures",
+                    self.name,
+                    self.failures,
+                )
+            self.last_attempt = time.time()
+
+    def as_dict(self):
+        """Return the breaker's state for display."""
+
+        state = "closed"
+        retry_in = 0
+        if self.opened is not None:
+            state = "open"
+            retry_in = max(
+                0,
+                self.last_attempt + BREAKER_COOLDOWN - time.time(),
+            )
+        return {
+            "route": self.name,
+            "state": state,
+            "failures": self.failures,
+            "trips": self.trips,
+            "retry_in": retry_in,
+        }
+
+
+def breaker(url):
+    """Return the Breaker for url's route template."""
+
+    name = tracing.template(url)
+    try:
+        return BREAKERS[name]
+    except KeyError:
+        with _BREAKERS_LOCK:
+            return BREAKERS.setdefault(name, Breaker(name))
+
+
+def breakers():
+    """Return the state of every breaker which has seen failures.
+
+    Returns:
+        list of dictionaries, open breakers first
+    """
+
+    return sorted(
+        (x.as_dict() for x in list(BREAKERS.values())
+         if x.failures or x.trips),
+        key=lambda x: (x["state"] != "open", -x["failures"], x["route"]),
+    )
+
+
+def _count(meta, wait):
+    """Count a retry of a request and the seconds waited for it in meta."""
+
+    if meta is not None:
+        meta["retries"] = meta.get("retries", 0) + 1
+        meta["waited"] = meta.get("waited", 0) + wait
+
+
+def _wait_out_error_limit(res, meta):
+    """Sleep until ESI's error limit window resets."""
+
+    wait = int(res.headers.get("X-Esi-Error-Limit-Reset", 1)) + 1
+    _count(meta, wait)
+    APP.error_limited = True
+    LOG.warning("hit the error limit, waiting %d seconds", wait)
+    gevent.sleep(wait)
+    APP.error_limited = False
+
+
+def call(request, url, budget=None, meta=None):
+    """Make a request, retrying 5xx responses and connection errors.
+
+    Args:
+        request: callable making the request, returning its response
+        url: string URL requested, for its route's circuit breaker
+
+    KWargs:
+        budget: Budget to take retries from, a new one if not provided
+        meta: dictionary to set a failure's error in, and count retries
+              and seconds waited in
+
+    Returns:
+        tuple of (response, or the exception raised, status code or None),
+        or (None, None) if the route's circuit is open
+    """
+
+    budget = budget or Budget()
+    route = breaker(url)
+    attempt = 0
+    while True:
+        if not route.allow():
+            if meta is not None:
+                meta["error"] = "circuit open"
+            return None, None
+
+        attempt += 1
+        try:
+            res = request()
+            status = res.status_code
+        except Exception as error:
+            res, status = error, None
+
+        if status is not None and status < 400:
+            route.record(True)
+            return res, status
+
+        if meta is not None:
+            meta["error"] = status or type(res).__name__
+
+        if status == 420:
+            _wait_out_error_limit(res, meta)
+            attempt -= 1  # not the route's fault
+            continue
+
+        route.record(not retryable(status))
+        if not retryable(status) or attempt >= ATTEMPTS or \
+                not budget.take():
+            return res, status
+
+        wait = backoff(attempt)
+        _count(meta, wait)
+        LOG.info(
+            "retrying %s in %.1fs after %s",
+            url,
+            wait,
+            status or repr(res),
+        )
+        gevent.sleep(wait)
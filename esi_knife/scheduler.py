@@ -0,0 +1,178 @@
+"""Fetch scheduling for ESI knife jobs."""
+
+
+import re
+import threading
+from concurrent.futures import Future
+from concurrent.futures import ThreadPoolExecutor
+
+import ujson
+
+from esi_knife import utils
+from esi_knife import tracing
+from esi_knife import immutable
+
+
+# routes which return the same payload to every member of the entity
+SHARED_ROUTES = re.compile(r".*/(corporations|alliances)/[0-9]+/")
+
+
+def _copy(data):
+    """Return a deep copy of JSON-able data."""
+
+    return ujson.loads(ujson.dumps(data))
+
+
+def _request_and_cache(url, page=None, headers=None, _meta=None,
+                       _retries=None):
+    """Request an immutable resource, caching it if successful."""
+
+    pages, res_url, data = utils.request_or_wait(
+        url,
+        page=page,
+        headers=headers,
+        _meta=_meta,
+        _retries=_retries,
+    )
+    if not pages and data is not None and not isinstance(data, str):
+        immutable.RESOURCES.put(url, data)
+    return pages, res_url, data
+
+
+class Scheduler(object):
+    """Request pool shared by one or more knife jobs.
+
+    When sharing, requests for corporation and alliance level routes are
+    coalesced between jobs in flight, each job receiving its own copy of
+    the data. Resolved names are kept in `names` for all jobs to use.
+
+    KWargs:
+        max_workers: maximum concurrent requests
+        share: boolean to share corporation and alliance routes
+    """
+
+    def __init__(self, max_workers=20, share=False):
+        self.pool = ThreadPoolExecutor(max_workers=max_workers)
+        self.share = share
+        self.names = {}
+        self._shared = {}  # {(url, page): [future, meta, waiting jobs]}
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.shutdown()
+
+    def shutdown(self):
+        """Wait for outstanding requests and release the pool."""
+
+        self.pool.shutdown(wait=True)
+        self._shared.clear()
+
+    def submit(self,  # pylint: disable=R0913
+               url, page=None, headers=None, meta=None, cache=False,
+               trace=tracing.NULL, retries=None):
+        """Queue a request.
+
+        Conditional requests (with an If-None-Match header) are never
+        shared.
+
+        Args:
+            url: string URL to request
+            page: integer page number or None
+            headers: dictionary of request headers
+            meta: dictionary to update with the response's status, ETag
+                  and Expires, see utils.request_or_wait
+            cache: boolean True if the resource is immutable, it's then
+                   served from and saved to immutable.RESOURCES
+            trace: tracing.Trace to record the request in, shared requests
+                   are only recorded by the job which made them
+            retries: retry.Budget of the job, shared requests are retried
+                     from the budget of the job which made them
+
+        Returns:
+            Future of the utils.request_or_wait return
+        """
+
+        request = utils.request_or_wait
+        if cache and page is None:
+            cached = immutable.RESOURCES.get(url)
+            if cached is not None:
+                if meta is not None:
+                    meta.update(status=200, etag=None, expires=0)
+                trace.cached(url)
+                future = Future()
+                future.set_result((None, url, cached))
+                return future
+            request = _request_and_cache
+
+        def _send(request_meta):
+            """Submit the request, filling request_meta."""
+
+            return self.pool.submit(
+                trace.wrap(request, url, page),
+                url,
+                page=page,
+                headers=headers,
+                _meta=request_meta,
+                _retries=retries,
+            )
+
+        if not self.share or not SHARED_ROUTES.match(url) or \
+                "If-None-Match" in (headers or {}):
+            return _send(meta)
+
+        key = (url, page)
+        entry = self._join(key, _send)
+        future = Future()
+
+        def _resolve(done):
+            """Pass a copy of the shared result to this caller's future."""
+
+            self._leave(key, entry)
+            try:
+                pages, res_url, data = done.result()
+                if meta is not None:
+                    meta.update(entry[1])
+                future.set_result((pages, res_url, _copy(data)))
+            except Exception as error:
+                future.set_exception(error)
+
+        entry[0].add_done_callback(_resolve)
+        return future
+
+    def _join(self, key, send):
+        """Return the shared request for key, sending it if needed.
+
+        Args:
+            key: tuple of (url, page)
+            send: callable to submit the request, given its meta dictionary
+
+        Returns:
+            list of [Future, meta dictionary, number of jobs waiting]
+        """
+
+        with self._lock:
+            entry = self._shared.get(key)
+            if entry is None or (entry[0].done() and (
+                    entry[0].exception() or
+                    isinstance(entry[0].result()[2], str))):
+                # first request, or the last attempt failed
+                shared_meta = {}
+                entry = [send(shared_meta), shared_meta, 0]
+                self._shared[key] = entry
+            entry[2] += 1
+        return entry
+
+    def _leave(self, key, entry):
+        """Stop waiting on a shared request.
+
+        The shared request is dropped once every job waiting on it has
+        its copy, later jobs request it again.
+        """
+
+        with self._lock:
+            entry[2] -= 1
+            if entry[2] <= 0 and self._shared.get(key) is entry:
+                del self._shared[key]
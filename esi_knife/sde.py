@@ -0,0 +1,263 @@
+"""Names of static data IDs, from a memory mapped table built from the SDE.
+
+Most IDs in a knife are static data: types, skills, solar systems,
+regions, NPC stations and corporations. Their names only change with the
+SDE, so with ESI_KNIFE_SDE_NAMES pointing at a table built by knife-sde,
+_get_names looks them up locally and only asks ESI about the rest.
+
+The table is mapped read only, processes on the same host share the one
+copy in the page cache. Its layout, all little endian:
+
+    8 bytes     b"KNIFESDE"
+    uint32      version
+    uint32      count, N
+    N uint32    IDs, ascending
+    N+1 uint32  offsets of each name in the names blob, then its length
+    names blob  UTF-8 names, back to back
+
+Tables are built from Fuzzwork style CSV dumps of the SDE, optionally
+bz2 compressed, ie invTypes.csv, invNames.csv, mapSolarSystems.csv and
+staStations.csv. Each file's names are read from every column pair like
+typeID and typeName (or id and name).
+
+Usage:
+    knife-sde OUT CSV...
+"""
+
+
+import io
+import os
+import sys
+import bz2
+import csv
+import mmap
+import bisect
+import struct
+
+import docopt
+
+from esi_knife import LOG
+from esi_knife import Lazy
+
+
+MAGIC = b"KNIFESDE"
+VERSION = 1
+HEADER = struct.Struct("<8sII")
+UINT32 = struct.Struct("<I")
+MAX_ID = 2 ** 32 - 1
+
+
+class _Uint32s(object):
+    """Little endian uint32s in a buffer, as a sequence."""
+
+    def __init__(self, buf, offset, count):
+        self.buf = buf
+        self.offset = offset
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        return UINT32.unpack_from(self.buf, self.offset + 4 * index)[0]
+
+    def release(self):
+        """Release the buffer."""
+
+        self.buf = None
+
+
+def _uint32s(buf, offset, count):
+    """Return a sequence of the little endian uint32s in buf."""
+
+    if sys.byteorder == "little" and hasattr(memoryview, "cast"):
+        return memoryview(buf)[offset:offset + 4 * count].cast("I")
+    return _Uint32s(buf, offset, count)
+
+
+class NameTable(object):
+    """A read only, memory mapped ID to name table.
+
+    Args:
+        path: path to a table built by write(), or None for an empty one
+
+    Raises:
+        ValueError if the file isn't a table this version can read
+    """
+
+    def __init__(self, path=None):
+        self.count = 0
+        self._map = None
+        self._ids = []
+        self._offsets = []
+        if path is None:
+            return
+
+        with open(path, "rb") as opentable:
+            self._map = mmap.mmap(
+                opentable.fileno(),
+                0,
+                access=mmap.ACCESS_READ,
+            )
+
+        magic, version, count = HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC or version != VERSION:
+            self.close()
+            raise ValueError("{} is not a version {} name table".format(
+                path,
+                VERSION,
+            ))
+        self.count = count
+        self._ids = _uint32s(self._map, HEADER.size, count)
+        self._offsets = _uint32s(
+            self._map,
+            HEADER.size + 4 * count,
+            count + 1,
+        )
+        self._names = HEADER.size + 4 * (2 * count + 1)
+
+    def __len__(self):
+        return self.count
+
+    def get(self, id_):
+        """Return the name of id_, or None."""
+
+        if not self.count or not 0 <= id_ <= MAX_ID:
+            return None
+
+        index = bisect.bisect_left(self._ids, id_)
+        if index == self.count or self._ids[index] != id_:
+            return None
+
+        return self._map[
+            self._names + self._offsets[index]:
+            self._names + self._offsets[index + 1]
+        ].decode("utf-8")
+
+    def names(self, ids):
+        """Return {id: name} of the ids in the table."""
+
+        if not self.count:
+            return {}
+
+        found = {}
+        for id_ in ids:
+            name = self.get(id_)
+            if name is not None:
+                found[id_] = name
+        return found
+
+    def close(self):
+        """Unmap the table."""
+
+        for view in (self._ids, self._offsets):
+            if hasattr(view, "release"):
+                view.release()
+        self._ids = []
+        self._offsets = []
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        self.count = 0
+
+
+def load(path=None):
+    """Return the NameTable at path or ESI_KNIFE_SDE_NAMES, or an empty one.
+
+    A missing or unreadable table is logged, names then all come from ESI.
+    """
+
+    path = path or os.environ.get("ESI_KNIFE_SDE_NAMES")
+    if not path:
+        return NameTable()
+
+    try:
+        table = NameTable(path)
+    except (IOError, OSError, ValueError, struct.error) as error:
+        LOG.warning("failed to load SDE names from %s: %r", path, error)
+        return NameTable()
+
+    LOG.info("loaded %d SDE names from %s", len(table), path)
+    return table
+
+
+NAMES = Lazy(load)
+
+
+def write(path, names):
+    """Write a table of names to path, replacing any table there.
+
+    Running processes keep their mapping of the previous table.
+
+    Args:
+        path: string path to write to
+        names: dictionary of {integer ID: string name}
+    """
+
+    ids = sorted(x for x in names if 0 <= x <= MAX_ID)
+    offsets = [0]
+    blob = io.BytesIO()
+    for id_ in ids:
+        offsets.append(offsets[-1] + blob.write(names[id_].encode("utf-8")))
+
+    staging = "{}.tmp".format(path)
+    with open(staging, "wb") as opentable:
+        opentable.write(HEADER.pack(MAGIC, VERSION, len(ids)))
+        opentable.write(struct.pack("<{}I".format(len(ids)), *ids))
+        opentable.write(struct.pack("<{}I".format(len(offsets)), *offsets))
+        opentable.write(blob.getvalue())
+    os.rename(staging, path)
+
+
+def read_csv(path):
+    """Return {id: name} from an SDE CSV dump.
+
+    Every column pair of a name and its ID is read, ie typeID and typeName
+    from invTypes.csv, or solarSystemID and solarSystemName (but not the
+    unnamed regionID) from mapSolarSystems.csv.
+    """
+
+    if path.endswith(".bz2"):
+        opencsv = bz2.open(path, "rt", encoding="utf-8")
+    else:
+        opencsv = io.open(path, "r", encoding="utf-8", newline="")
+
+    names = {}
+    with opencsv:
+        reader = csv.DictReader(opencsv)
+        pairs = []
+        for column in reader.fieldnames or []:
+            if not column.lower().endswith("name"):
+                continue
+            for id_column in ("ID", "Id", "id"):
+                id_column = column[:-4] + id_column
+                if id_column in reader.fieldnames:
+                    pairs.append((id_column, column))
+                    break
+
+        for row in reader:
+            for id_column, name_column in pairs:
+                try:
+                    if row[name_column]:
+                        names[int(row[id_column])] = row[name_column]
+                except (TypeError, ValueError):
+                    continue
+    return names
+
+
+def main():
+    """Build an SDE name table."""
+
+    args = docopt.docopt(__doc__)
+    names = {}
+    for path in args["CSV"]:
+        found = read_csv(path)
+        LOG.info("read %d names from %s", len(found), path)
+        names.update(found)
+
+    write(args["OUT"], names)
+    print("wrote {} names to {}".format(len(names), args["OUT"]))
+
+
+if __name__ == "__main__":
+    main()
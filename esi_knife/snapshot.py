@@ -0,0 +1,181 @@
+"""Incremental re-knifing from a character's previous snapshot.
+
+After a job completes, each route's blob hash, size, ETag and Expires are
+saved against the character ID. The next job for the character reuses the
+routes which haven't expired without requesting them, and requests the rest
+with If-None-Match, reusing those which are 304 Not Modified. Only changed
+routes are fetched, named and stored as new blobs, the new result's manifest
+references the previous blobs for the rest.
+
+Paged routes have an ETag per page, they're only reused until they expire.
+"""
+
+
+import time
+
+from esi_knife import LOG
+from esi_knife import Keys
+from esi_knife import CACHE
+from esi_knife import utils
+from esi_knife import env_flag
+
+
+ENABLED = env_flag("ESI_KNIFE_INCREMENTAL", True)
+
+
+class Snapshot(object):
+    """Route details from a character's previous job, and for this one.
+
+    Args:
+        character_id: integer character ID
+        routes: dictionary of the previous {url: entry}, where entries are
+                dictionaries of hash, size, etag, expires and paged
+    """
+
+    def __init__(self, character_id, routes=None):
+        self.character_id = character_id
+        self.previous = routes or {}
+        self.reused = {}  # {url: entry}
+        self.fetched = {}  # {url: entry, without hash and size}
+
+    @classmethod
+    def load(cls, character_id):
+        """Return the character's last Snapshot.
+
+        Routes whose blobs have expired since are left out.
+        """
+
+        if not ENABLED:
+            return cls(character_id)
+
+        try:
+            stored = CACHE.get("{}{}".format(
+                Keys.snapshot.value,
+                character_id,
+            )) or {}
+            routes = stored.get("routes", {})
+            missing = utils.missing_blobs(x["hash"] for x in routes.values())
+        except Exception as error:
+            LOG.warning(
+                "failed to load snapshot of %s: %r",
+                character_id,
+                error,
+            )
+            return cls(character_id)
+
+        return cls(character_id, {
+            url: entry for url, entry in routes.items()
+            if entry["hash"] not in missing
+        })
+
+    def reuse(self, url, immutable=False):
+        """Reuse the previous data for url if it hasn't expired.
+
+        KWargs:
+            immutable: boolean True if url never changes, so never expires
+
+        Returns:
+            boolean True if url doesn't need to be requested
+        """
+
+        if self.fresh(url, immutable=immutable):
+            self.reused[url] = self.previous[url]
+            return True
+        return False
+
+    def fresh(self, url, immutable=False):
+        """Return True if the previous data for url can be reused, as is."""
+
+        entry = self.previous.get(url)
+        return bool(entry and (immutable or entry["expires"] > time.time()))
+
+    def headers(self, url, headers):
+        """Return the headers to request url with, conditional if we can."""
+
+        entry = self.previous.get(url)
+        if entry and entry.get("etag") and not entry.get("paged"):
+            headers = dict(headers)
+            headers["If-None-Match"] = entry["etag"]
+        return headers
+
+    def record(self, url, meta, paged=False):
+        """Record the response for url.
+
+        Args:
+            url: string URL requested
+            meta: dictionary of response details from request_or_wait
+            paged: boolean True if the route has more than one page
+
+        Returns:
+            boolean True if it was not modified, and is being reused
+        """
+
+        if not meta.get("status"):
+            return False  # failed, nothing to reuse next time
+
+        if meta["status"] == 304 and url in self.previous:
+            entry = dict(self.previous[url])
+            entry["expires"] = meta["expires"]
+            self.reused[url] = entry
+            return True
+
+        self.fetched[url] = {
+            "etag": meta.get("etag"),
+            "expires": meta.get("expires", 0),
+            "paged": paged,
+        }
+        return False
+
+    def drop_expired(self):
+        """Stop reusing routes whose blobs have expired since load.
+
+        Returns:
+            list of the URLs, they need fetching again
+        """
+
+        missing = utils.missing_blobs(x["hash"] for x in self.reused.values())
+        urls = sorted(
+            url for url, entry in self.reused.items()
+            if entry["hash"] in missing
+        )
+        for url in urls:
+            self.reused.pop(url)
+            self.previous.pop(url, None)
+        return urls
+
+    def reuse_hashes(self):
+        """Return {url: (hash, size)} of the reused routes for write_data."""
+
+        return {
+            url: (entry["hash"], entry["size"])
+            for url, entry in self.reused.items()
+        }
+
+    def save(self, stored):
+        """Save this job's routes as the character's snapshot.
+
+        Args:
+            stored: dictionary of {url: (hash, size)} from write_data
+        """
+
+        if not ENABLED or not stored:
+            return
+
+        routes = {}
+        for url, (digest, size) in stored.items():
+            entry = self.reused.get(url) or self.fetched.get(url)
+            if entry is not None:
+                routes[url] = dict(entry, hash=digest, size=size)
+
+        try:
+            CACHE.set(
+                "{}{}".format(Keys.snapshot.value, self.character_id),
+                {"time": time.time(), "routes": routes},
+                timeout=utils.EXPIRY,
+            )
+        except Exception as error:
+            LOG.warning(
+                "failed to save snapshot of %s: %r",
+                self.character_id,
+                error,
+            )
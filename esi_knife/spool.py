@@ -0,0 +1,123 @@
+"""Bounded-memory storage for a job's results.
+
+Route data is held as compressed JSON frames rather than python objects.
+Frames are kept in memory until the spool's budget is used, then they're
+appended to an anonymous temporary file instead. A job's memory use is then
+bounded by the budget plus the largest single route it's working on, no
+matter how many routes it has.
+"""
+
+
+import os
+import zlib
+import tempfile
+import threading
+
+import ujson
+
+try:
+    from collections.abc import MutableMapping
+except ImportError:
+    # python2
+    from collections import MutableMapping
+
+
+JOB_MEMORY = int(os.environ.get("ESI_KNIFE_JOB_MEMORY", 67108864))  # 64MB
+SPOOL_PATH = os.environ.get("ESI_KNIFE_SPOOL_PATH") or None
+COMPRESS_LEVEL = 1
+
+
+class Spool(MutableMapping):  # pylint: disable=R0902
+    """A dictionary of JSON-able values, spilled to disk past a budget.
+
+    Values are copies, changes to a value read from the spool must be set
+    again to be kept.
+
+    KWargs:
+        budget: integer compressed bytes to hold in memory
+        directory: where to create the spill file, defaults to the system's
+    """
+
+    def __init__(self, budget=JOB_MEMORY, directory=SPOOL_PATH):
+        self.budget = budget
+        self.directory = directory
+        self.spilled = 0  # bytes written to disk
+        self._index = {}  # {key: frame bytes, or (offset, length) on disk}
+        self._memory = 0
+        self._file = None
+        self._offset = 0
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def __len__(self):
+        return len(self._index)
+
+    def __iter__(self):
+        return iter(list(self._index))
+
+    def __contains__(self, key):
+        return key in self._index
+
+    def __getitem__(self, key):
+        return ujson.loads(self.raw(key))
+
+    def __setitem__(self, key, value):
+        frame = zlib.compress(
+            ujson.dumps(value).encode("utf-8"),
+            COMPRESS_LEVEL,
+        )
+
+        with self._lock:
+            self._discard(key)
+            if self._memory + len(frame) <= self.budget:
+                self._index[key] = frame
+                self._memory += len(frame)
+                return
+
+            if self._file is None:
+                self._file = tempfile.TemporaryFile(dir=self.directory)
+            self._file.seek(self._offset)
+            self._file.write(frame)
+            self._index[key] = (self._offset, len(frame))
+            self._offset += len(frame)
+            self.spilled += len(frame)
+
+    def __delitem__(self, key):
+        with self._lock:
+            if key not in self._index:
+                raise KeyError(key)
+            self._discard(key)
+
+    def _discard(self, key):
+        """Forget key's frame, if any. Spilled bytes are not reclaimed."""
+
+        frame = self._index.pop(key, None)
+        if isinstance(frame, bytes):
+            self._memory -= len(frame)
+
+    def raw(self, key):
+        """Return the JSON encoded value for key, as UTF-8 bytes."""
+
+        with self._lock:
+            frame = self._index[key]
+            if not isinstance(frame, bytes):
+                offset, length = frame
+                self._file.seek(offset)
+                frame = self._file.read(length)
+
+        return zlib.decompress(frame)
+
+    def close(self):
+        """Drop all values and remove the spill file."""
+
+        with self._lock:
+            self._index.clear()
+            self._memory = 0
+            if self._file is not None:
+                self._file.close()
+                self._file = None
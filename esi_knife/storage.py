@@ -0,0 +1,416 @@
+"""Tiered storage of completed results.
+
+Results are written to redis, the hot tier. When ESI_KNIFE_COLD_STORAGE is
+set, results which haven't been viewed for ESI_KNIFE_HOT_IDLE seconds, or
+the least recently viewed once the hot tier holds more than
+ESI_KNIFE_HOT_BYTES, are demoted to the cold tier. Their redis value is
+replaced with a small pointer, and they're promoted back on the next view.
+
+Cold storage is either a directory (file:///path) or an S3 compatible
+bucket (s3://bucket/prefix, requires boto3). Without redis, or without cold
+storage configured, everything stays in the hot tier.
+
+Results stored as manifests of shared blobs are written to the cold tier as
+the whole document, and their references to the blobs are released.
+"""
+
+
+import re
+import os
+import time
+import errno
+import tempfile
+
+from esi_knife import LOG
+from esi_knife import Keys
+from esi_knife import CACHE
+
+
+POINTER = b"@"
+HOT_IDLE = int(os.environ.get("ESI_KNIFE_HOT_IDLE", 86400))
+HOT_BYTES = int(os.environ.get("ESI_KNIFE_HOT_BYTES", 0))
+DEMOTE_INTERVAL = 600
+CHUNK_SIZE = 1048576
+COLD_EXPIRY = 604800  # matches utils.EXPIRY, pointers live as long
+HEAD_SIZE = 32  # bytes to read to find the pointer or manifest size
+
+_MANIFEST_SIZE = re.compile(br'^\{"size":([0-9]+)')
+_STORE = []
+
+# drop a reference to a blob, deleting it with the last one
+_RELEASE_LUA = """
+if redis.call("DECR", KEYS[2]) <= 0 then
+    redis.call("DEL", KEYS[1], KEYS[2])
+end
+"""
+_RELEASE_SCRIPT = []
+
+
+class FileStore(object):
+    """Cold storage in a local (or mounted) directory."""
+
+    def __init__(self, path):
+        self.path = path
+        try:
+            os.makedirs(path)
+        except OSError as error:
+            if error.errno != errno.EEXIST:
+                raise
+
+    def _path(self, name):
+        return os.path.join(self.path, name)
+
+    def put(self, name, chunks):
+        """Write an object from an iterable of bytes, atomically."""
+
+        handle, temp = tempfile.mkstemp(dir=self.path, suffix=".partial")
+        try:
+            with os.fdopen(handle, "wb") as outfile:
+                for chunk in chunks:
+                    outfile.write(chunk)
+            os.rename(temp, self._path(name))
+        except Exception:
+            os.unlink(temp)
+            raise
+
+    def has(self, name):
+        """Return True if the object exists, refreshing its age."""
+
+        try:
+            os.utime(self._path(name), None)
+        except OSError:
+            return False
+        return True
+
+    def chunks(self, name, size=CHUNK_SIZE):
+        """Yield the object in pieces of size bytes.
+
+        Raises:
+            KeyError if the object doesn't exist
+        """
+
+        try:
+            infile = open(self._path(name), "rb")
+        except IOError:
+            raise KeyError(name)
+
+        with infile:
+            while True:
+                chunk = infile.read(size)
+                if not chunk:
+                    break
+                yield chunk
+
+    def prune(self, max_age):
+        """Delete objects which haven't been used in max_age seconds."""
+
+        cutoff = time.time() - max_age
+        for name in os.listdir(self.path):
+            try:
+                if os.path.getmtime(self._path(name)) < cutoff:
+                    os.unlink(self._path(name))
+            except OSError:
+                pass
+
+
+class S3Store(object):
+    """Cold storage in an S3 compatible bucket.
+
+    Expiry of old objects is left to the bucket's lifecycle rules.
+    """
+
+    def __init__(self, bucket, prefix="", endpoint=None):
+        import boto3
+
+        self.client = boto3.client("s3", endpoint_url=endpoint)
+        self.bucket = bucket
+        self.prefix = prefix
+
+    def _key(self, name):
+        return "{}{}".format(self.prefix, name)
+
+    def put(self, name, chunks):
+        """Write an object from an iterable of bytes."""
+
+        with tempfile.TemporaryFile() as spool:
+            for chunk in chunks:
+                spool.write(chunk)
+            spool.seek(0)
+            self.client.upload_fileobj(spool, self.bucket, self._key(name))
+
+    def has(self, name):
+        """Return True if the object exists."""
+
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=self._key(name))
+        except Exception:  # botocore's ClientError, 404 or otherwise
+            return False
+        return True
+
+    def chunks(self, name, size=CHUNK_SIZE):
+        """Yield the object in pieces of size bytes.
+
+        Raises:
+            KeyError if the object doesn't exist
+        """
+
+        try:
+            res = self.client.get_object(
+                Bucket=self.bucket,
+                Key=self._key(name),
+            )
+        except Exception:
+            raise KeyError(name)
+
+        for chunk in res["Body"].iter_chunks(size):
+            yield chunk
+
+    def prune(self, max_age):
+        """Lifecycle rules expire objects, nothing to do."""
+
+        pass
+
+
+def _build_store(config):
+    """Return the cold store for an ESI_KNIFE_COLD_STORAGE URL, or None."""
+
+    if not config:
+        return None
+    if config.startswith("file://"):
+        return FileStore(config[len("file://"):])
+    if config.startswith("s3://"):
+        bucket, _, prefix = config[len("s3://"):].partition("/")
+        return S3Store(
+            bucket,
+            prefix=prefix,
+            endpoint=os.environ.get("ESI_KNIFE_S3_ENDPOINT") or None,
+        )
+
+    LOG.warning("unknown cold storage: %r", config)
+    return None
+
+
+def cold_store():
+    """Return the configured cold store, or None."""
+
+    if not _STORE:
+        _STORE.append(_build_store(
+            os.environ.get("ESI_KNIFE_COLD_STORAGE", "")
+        ))
+    return _STORE[0]
+
+
+def _client():
+    """Return the redis client and key prefix, or (None, None)."""
+
+    client = getattr(CACHE.cache, "_client", None)
+    if client is None:
+        return None, None
+    return client, CACHE.cache.key_prefix
+
+
+def is_pointer(content):
+    """Return True if a stored value points at the cold tier."""
+
+    return isinstance(content, bytes) and content.startswith(POINTER)
+
+
+def _redis_chunks(client, key, size=CHUNK_SIZE):
+    """Yield a redis string value in pieces of size bytes."""
+
+    offset = 0
+    while True:
+        chunk = client.getrange(key, offset, offset + size - 1)
+        if not chunk:
+            break
+        yield chunk
+        offset += len(chunk)
+
+
+def _size(head, length):
+    """Return the size of a result from its first bytes and length."""
+
+    match = _MANIFEST_SIZE.match(head)
+    if match:
+        return int(match.group(1))
+    return length
+
+
+def _release(client, prefix, hashes):
+    """Drop one reference to each blob hash."""
+
+    from esi_knife import utils
+
+    if not _RELEASE_SCRIPT:
+        _RELEASE_SCRIPT.append(client.register_script(_RELEASE_LUA))
+
+    pipe = client.pipeline()
+    for digest in hashes:
+        _RELEASE_SCRIPT[0](
+            keys=[prefix + key for key in utils.blob_keys(digest)],
+            client=pipe,
+        )
+    pipe.execute()
+
+
+def demote(uuid):
+    """Move one result to the cold tier, leaving a pointer in redis.
+
+    Returns:
+        integer bytes freed from redis, approximately for manifests
+    """
+
+    from esi_knife import utils
+
+    store = cold_store()
+    client, prefix = _client()
+    if store is None or client is None:
+        return 0
+
+    key = "{}{}{}".format(prefix, Keys.complete.value, uuid)
+    head = client.getrange(key, 0, HEAD_SIZE - 1)
+    ttl = client.ttl(key)
+    if not head or head.startswith(POINTER) or ttl is None or ttl < 1:
+        return 0
+    size = _size(head, client.strlen(key))
+
+    manifest = None
+    if utils.Manifest.is_manifest(head):
+        manifest = utils.Manifest(client.get(key))
+        chunks = utils.encoded_chunks(manifest)
+    else:
+        chunks = _redis_chunks(client, key)
+
+    # results are never modified, an existing copy is the same data
+    if not store.has(uuid):
+        store.put(uuid, chunks)
+
+    pipe = client.pipeline()
+    pipe.setex(key, ttl, POINTER + uuid.encode("utf-8"))
+    pipe.zrem(prefix + Keys.hot.value, uuid)
+    pipe.execute()
+
+    if manifest is not None:
+        _release(client, prefix, manifest.hashes())
+
+    LOG.info("demoted %s (%d bytes)", uuid, size)
+    return size
+
+
+def promote(uuid):
+    """Move a result back to the hot tier.
+
+    Returns:
+        the stored content, or None if it's not in the cold tier
+    """
+
+    store = cold_store()
+    client, prefix = _client()
+    if store is None or client is None:
+        return None
+
+    key = "{}{}{}".format(prefix, Keys.complete.value, uuid)
+    staging = "{}{}{}".format(prefix, Keys.staging.value, uuid)
+    try:
+        client.delete(staging)
+        for chunk in store.chunks(uuid):
+            client.append(staging, chunk)
+    except KeyError:
+        LOG.warning("cold copy of %s is missing", uuid)
+        client.delete(staging)
+        return None
+
+    pipe = client.pipeline()
+    pipe.get(staging)
+    pipe.rename(staging, key)
+    pipe.expire(key, COLD_EXPIRY)
+    pipe.zadd(prefix + Keys.hot.value, {uuid: time.time()})
+    content = pipe.execute()[0]
+    LOG.info("promoted %s", uuid)
+    # the copy is of the raw redis value, which may be pickled
+    return CACHE.cache.load_object(content)
+
+
+def _describe(client, prefix, keys, uuids):
+    """Return [(head, length, last access), ...] of results' keys."""
+
+    pipe = client.pipeline(transaction=False)
+    for key, uuid in zip(keys, uuids):
+        pipe.getrange(key, 0, HEAD_SIZE - 1)
+        pipe.strlen(key)
+        pipe.zscore(prefix + Keys.hot.value, uuid)
+    replies = pipe.execute()
+    return list(zip(replies[0::3], replies[1::3], replies[2::3]))
+
+
+def _hot_results(client, prefix):
+    """Return [(last access, size, uuid), ...] for hot results."""
+
+    pattern = "{}{}*".format(prefix, Keys.complete.value)
+    keys = list(client.scan_iter(match=pattern, count=1000))
+    uuids = [
+        key.decode("utf-8")[len(pattern) - 1:] for key in keys
+    ]
+
+    now = time.time()
+    results = []
+    unseen = {}
+    for uuid, (head, length, accessed) in zip(
+            uuids, _describe(client, prefix, keys, uuids)):
+        if not length or head.startswith(POINTER):
+            continue
+        if accessed is None:
+            # written before access was tracked, start counting now
+            unseen[uuid] = accessed = now
+        results.append((accessed, _size(head, length), uuid))
+
+    if unseen:
+        client.zadd(prefix + Keys.hot.value, unseen)
+
+    return results
+
+
+def _forget_expired(client, prefix, results):
+    """Stop tracking the access of results which have expired from redis.
+
+    Args:
+        results: list of (last access, size, uuid) of the hot results
+    """
+
+    hot_key = prefix + Keys.hot.value
+    tracked = set(x.decode("utf-8") for x in client.zrange(hot_key, 0, -1))
+    gone = tracked - set(uuid for _, _, uuid in results)
+    if gone:
+        client.zrem(hot_key, *gone)
+
+
+def demote_idle(idle=HOT_IDLE, max_bytes=HOT_BYTES):
+    """Demote idle results, then the least recently used over max_bytes.
+
+    Returns:
+        integer bytes freed from redis
+    """
+
+    client, prefix = _client()
+    if cold_store() is None or client is None:
+        return 0
+
+    results = sorted(_hot_results(client, prefix))
+    _forget_expired(client, prefix, results)
+
+    cutoff = time.time() - idle
+    hot_bytes = sum(size for _, size, _ in results)
+    freed = 0
+    for accessed, size, uuid in results:
+        if accessed > cutoff and (not max_bytes or hot_bytes <= max_bytes):
+            break
+        try:
+            demoted = demote(uuid)
+        except Exception as error:
+            LOG.warning("failed to demote %s: %r", uuid, error)
+            continue
+        hot_bytes -= demoted
+        freed += demoted
+
+    cold_store().prune(COLD_EXPIRY)
+    return freed
@@ -0,0 +1,173 @@
+"""Streaming decode and pretty print of .knife files.
+
+Pretty printing only needs to know where strings start and end and how
+deep the current container is, so the document never has to be parsed.
+Memory use is bounded by the chunk size, regardless of the file size.
+Keys are printed in file order, not sorted.
+"""
+
+
+import re
+import json
+import zlib
+import base64
+import codecs
+
+
+CHUNK_SIZE = 65536
+MAX_INFLATE = 1048576  # maximum decompressed bytes per step
+
+# a complete string, a structural character, a scalar, or whitespace
+_TOKENS = re.compile(
+    r'"[^"\\]*(?:\\.[^"\\]*)*"|[{}\[\],:]|[^\s"{}\[\],:]+|\s+'
+)
+
+
+class Reindenter(object):
+    """Incrementally re-indent a JSON text stream.
+
+    KWargs:
+        indent: integer spaces per level
+        depth: integer starting depth, for documents nested in others
+    """
+
+    def __init__(self, indent=4, depth=0):
+        self.indent = indent
+        self.depth = depth
+        self._tail = ""
+        self._opened = None  # container opened without any content yet
+
+    def _pad(self):
+        """Return a newline and the current indentation."""
+
+        return "\n" + " " * (self.indent * self.depth)
+
+    def _token(self, token, out):
+        """Append the output for one token to out."""
+
+        char = token[0]
+        if char.isspace():
+            return
+
+        if self._opened is not None:
+            opened, self._opened = self._opened, None
+            if char in "}]":
+                self.depth -= 1
+                out.append(opened + char)
+                return
+            out.append(opened + self._pad())
+
+        if char in "{[":
+            self.depth += 1
+            self._opened = char
+        elif char in "}]":
+            self.depth -= 1
+            out.append(self._pad() + char)
+        elif char == ",":
+            out.append("," + self._pad())
+        elif char == ":":
+            out.append(": ")
+        else:
+            out.append(token)
+
+    def feed(self, text, final=False):
+        """Return the re-indented output for the next piece of text.
+
+        Tokens which may continue in the next piece are held back until
+        then, or until final is True.
+        """
+
+        text = self._tail + text
+        out = []
+        position = 0
+        for match in _TOKENS.finditer(text):
+            if match.start() != position:
+                break  # unterminated string
+            if match.end() == len(text) and not final:
+                break  # might continue
+            position = match.end()
+            self._token(match.group(), out)
+
+        self._tail = text[position:]
+        if final and self._opened is not None:
+            out.append(self._opened)
+            self._opened = None
+        return "".join(out)
+
+
+def b64_chunks(infile, size=CHUNK_SIZE):
+    """Yield decoded bytes from a base64 file object, one chunk at a time."""
+
+    leftover = b""
+    while True:
+        chunk = infile.read(size)
+        if not chunk:
+            break
+        leftover += b"".join(chunk.split())
+        usable = len(leftover) - len(leftover) % 4
+        yield base64.b64decode(leftover[:usable])
+        leftover = leftover[usable:]
+
+    if leftover:
+        yield base64.b64decode(leftover)
+
+
+def inflate(chunks):
+    """Yield decompressed bytes from gzip or zlib compressed chunks."""
+
+    decompressor = zlib.decompressobj(32 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        while chunk:
+            yield decompressor.decompress(chunk, MAX_INFLATE)
+            chunk = decompressor.unconsumed_tail
+    yield decompressor.flush()
+
+
+def pretty(chunks, depth=0):
+    """Yield pretty printed JSON text from chunks of UTF-8 JSON bytes."""
+
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    reindenter = Reindenter(depth=depth)
+    for chunk in chunks:
+        text = reindenter.feed(decoder.decode(chunk))
+        if text:
+            yield text
+    yield reindenter.feed(decoder.decode(b"", final=True), final=True)
+
+
+def write_v1(filename, out):
+    """Pretty print a v1 (base64 gzip) knife file to out."""
+
+    with open(filename, "rb") as infile:
+        for text in pretty(inflate(b64_chunks(infile))):
+            out.write(text)
+    out.write("\n")
+
+
+def write_route(reader, route, out):
+    """Pretty print one route of an open container.Reader to out."""
+
+    for text in pretty(inflate(reader.frame_chunks(route))):
+        out.write(text)
+    out.write("\n")
+
+
+def write_v2(reader, out, routes=None):
+    """Pretty print the routes of an open container.Reader to out.
+
+    KWargs:
+        routes: list of routes to print, defaults to all of them sorted
+    """
+
+    routes = sorted(reader.routes()) if routes is None else routes
+    if not routes:
+        out.write("{}\n")
+        return
+
+    out.write("{\n")
+    for i, route in enumerate(routes, 1):
+        out.write("    {}: ".format(json.dumps(route)))
+        for text in pretty(inflate(reader.frame_chunks(route)), depth=1):
+            out.write(text)
+        out.write(",\n" if i < len(routes) else "\n")
+    out.write("}\n")
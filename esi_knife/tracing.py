@@ -0,0 +1,366 @@
+"""Per-job timelines of phases and ESI requests.
+
+Each knife job records a span for every phase it passes through, and for
+every request: the URL template, page, time spent queued for the request
+pool, latency, status, and any retries and seconds spent waiting out the
+error limit. Resources served from the immutable cache are zero length
+spans. The trace is stored next to the result, for as long, and can be
+exported as Chrome trace event JSON (chrome://tracing or Perfetto) or as
+OTLP/JSON spans.
+
+Jobs record at most ESI_KNIFE_TRACE_SPANS spans, later requests are only
+counted. Set it to 0 to disable tracing.
+"""
+
+
+import os
+import re
+import time
+import zlib
+import hashlib
+import threading
+
+import ujson
+
+from esi_knife import LOG
+from esi_knife import Keys
+from esi_knife import CACHE
+
+
+MAX_SPANS = int(os.environ.get("ESI_KNIFE_TRACE_SPANS", 100000))
+EXPIRY = 604800  # matches utils.EXPIRY
+
+_IDS = re.compile(r"/([0-9]+|[0-9a-f]{40})(?=/)")
+
+
+def template(url):
+    """Return the route template of an ESI URL, with IDs replaced."""
+
+    return _IDS.sub("/{id}", url.split("/latest", 1)[-1])
+
+
+class Trace(object):
+    """The timeline of one job.
+
+    Phases are recorded through reporter(), requests through wrap(), both
+    are safe to use from the request pool's threads.
+
+    Args:
+        uuid: string uuid token of the job
+    """
+
+    def __init__(self, uuid):
+        self.uuid = uuid
+        self.start = time.time()
+        self.spans = []  # [kind, name, thread, start, end, args]
+        self.dropped = 0
+        self._phase = None  # the open phase span
+        self._threads = {}  # {thread ident: small integer}
+        self._lock = threading.Lock()
+
+    def _thread(self):
+        """Return a small integer for the current thread."""
+
+        ident = threading.current_thread().ident
+        if ident not in self._threads:
+            self._threads[ident] = len(self._threads) + 1
+        return self._threads[ident]
+
+    def _add(self, kind, name, start, end, args):
+        """Record a span, unless we've recorded enough."""
+
+        with self._lock:
+            if len(self.spans) >= MAX_SPANS:
+                self.dropped += 1
+                return
+            self.spans.append([
+                kind,
+                name,
+                0 if kind == "phase" else self._thread(),
+                start,
+                end,
+                args,
+            ])
+
+    def phase(self, name):
+        """End the current phase and start the named one."""
+
+        now = time.time()
+        with self._lock:
+            if self._phase is not None:
+                self._phase[4] = now
+            if name is None:
+                self._phase = None
+                return
+            self._phase = ["phase", name, 0, now, None, {}]
+            self.spans.append(self._phase)
+
+    def reporter(self, report):
+        """Return report, recording phase changes before passing them on."""
+
+        def _report(**update):
+            """Record the phase, if it's changed, then report."""
+
+            phase = update.get("phase")
+            if phase is not None and (
+                    self._phase is None or self._phase[1] != phase):
+                self.phase(phase)
+            report(**update)
+
+        return _report
+
+    def wrap(self, request, url, page=None):
+        """Return request, recording a span for it.
+
+        The queue wait is from now until the returned function is called,
+        by the request pool. request is utils.request_or_wait or similar,
+        called with the _meta dictionary it updates.
+        """
+
+        queued = time.time()
+
+        def _traced(*args, **kwargs):
+            """Make the request, then record it."""
+
+            if kwargs.get("_meta") is None:
+                kwargs["_meta"] = {}
+            meta = kwargs["_meta"]
+            started = time.time()
+            try:
+                return request(*args, **kwargs)
+            finally:
+                self.request(url, page, queued, started, meta)
+
+        return _traced
+
+    def request(self, url, page, queued, started, meta):
+        """Record a finished request.
+
+        Args:
+            url: string URL requested
+            page: integer page number or None
+            queued: timestamp the request was submitted
+            started: timestamp the request was made
+            meta: dictionary updated by utils.request_or_wait
+        """
+
+        args = {
+            "url": url,
+            "status": meta.get("status") or meta.get("error"),
+            "queued_ms": int((started - queued) * 1000),
+        }
+        if page:
+            args["page"] = page
+        if meta.get("retries"):
+            args["retries"] = meta["retries"]
+            args["waited_s"] = meta.get("waited", 0)
+        self._add("request", template(url), started, time.time(), args)
+
+    def cached(self, url):
+        """Record a resource served from the immutable cache."""
+
+        now = time.time()
+        self._add("request", template(url), now, now, {
+            "url": url,
+            "status": "cached",
+        })
+
+    def save(self):
+        """Store the trace, closing any open phase."""
+
+        if not MAX_SPANS:
+            return
+
+        self.phase(None)
+        try:
+            CACHE.set(
+                "{}{}".format(Keys.trace.value, self.uuid),
+                zlib.compress(ujson.dumps({
+                    "uuid": self.uuid,
+                    "start": self.start,
+                    "end": time.time(),
+                    "dropped": self.dropped,
+                    "spans": self.spans,
+                }).encode("utf-8")),
+                timeout=EXPIRY,
+            )
+        except Exception as error:
+            LOG.warning("failed to save trace of %s: %r", self.uuid, error)
+
+
+class _NullTrace(object):
+    """Records nothing, for callers without a job to trace."""
+
+    @staticmethod
+    def reporter(report):
+        """Return report."""
+
+        return report
+
+    @staticmethod
+    def wrap(request, *_, **__):
+        """Return request."""
+
+        return request
+
+    def cached(self, url):
+        """Record nothing."""
+
+        pass
+
+    def save(self):
+        """Store nothing."""
+
+        pass
+
+
+NULL = _NullTrace()
+
+
+def new(uuid):
+    """Return a Trace for the job, or NULL if tracing is disabled."""
+
+    return Trace(uuid) if MAX_SPANS else NULL
+
+
+def load(uuid):
+    """Return the stored trace of a job, or None."""
+
+    try:
+        stored = CACHE.get("{}{}".format(Keys.trace.value, uuid))
+        if stored is not None:
+            return ujson.loads(zlib.decompress(stored).decode("utf-8"))
+    except Exception as error:
+        LOG.warning("failed to load trace of %s: %r", uuid, error)
+    return None
+
+
+def _microseconds(stored, timestamp):
+    """Return microseconds since the start of the trace."""
+
+    return int(((timestamp or stored["end"]) - stored["start"]) * 1000000)
+
+
+def to_chrome(stored):
+    """Return a stored trace as Chrome trace event JSON."""
+
+    events = [
+        {
+            "name": "process_name",
+            "ph": "M",
+            "pid": 1,
+            "args": {"name": "knife {}".format(stored["uuid"])},
+        },
+        {
+            "name": "thread_name",
+            "ph": "M",
+            "pid": 1,
+            "tid": 0,
+            "args": {"name": "phases"},
+        },
+    ]
+    for kind, name, thread, start, end, args in stored["spans"]:
+        events.append({
+            "name": name,
+            "cat": kind,
+            "ph": "X",
+            "pid": 1,
+            "tid": thread,
+            "ts": _microseconds(stored, start),
+            "dur": _microseconds(stored, end) - _microseconds(stored, start),
+            "args": args,
+        })
+
+    return {
+        "traceEvents": events,
+        "displayTimeUnit": "ms",
+        "otherData": {"uuid": stored["uuid"], "dropped": stored["dropped"]},
+    }
+
+
+def _otlp_value(value):
+    """Return value as an OTLP AnyValue."""
+
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def to_otlp(stored):
+    """Return a stored trace as OTLP/JSON resource spans.
+
+    Every span is a child of one span for the whole job.
+    """
+
+    trace_id = hashlib.md5(stored["uuid"].encode("utf-8")).hexdigest()
+    root_id = trace_id[:16]
+
+    def _nanoseconds(timestamp):
+        return str(int((timestamp or stored["end"]) * 1000000000))
+
+    spans = [{
+        "traceId": trace_id,
+        "spanId": root_id,
+        "name": "knife",
+        "kind": 1,
+        "startTimeUnixNano": _nanoseconds(stored["start"]),
+        "endTimeUnixNano": _nanoseconds(stored["end"]),
+        "attributes": [
+            {"key": "knife.uuid", "value": _otlp_value(stored["uuid"])},
+            {"key": "knife.dropped", "value": _otlp_value(stored["dropped"])},
+        ],
+    }]
+    for i, (kind, name, _, start, end, args) in enumerate(stored["spans"]):
+        spans.append({
+            "traceId": trace_id,
+            "spanId": "{:016x}".format(i + 1),
+            "parentSpanId": root_id,
+            "name": name,
+            "kind": 3 if kind == "request" else 1,
+            "startTimeUnixNano": _nanoseconds(start),
+            "endTimeUnixNano": _nanoseconds(end),
+            "attributes": [{"key": "knife.kind", "value": _otlp_value(kind)}] +
+                          [
+                              {"key": key, "value": _otlp_value(value)}
+                              for key, value in sorted(args.items())
+                          ],
+        })
+
+    return {"resourceSpans": [{
+        "resource": {"attributes": [
+            {"key": "service.name", "value": _otlp_value("esi-knife")},
+        ]},
+        "scopeSpans": [{"scope": {"name": "esi_knife"}, "spans": spans}],
+    }]}
+
+
+def summary(stored):
+    """Return the phases and slowest request templates of a stored trace.
+
+    Returns:
+        tuple of ([(phase, seconds)], [(template, requests, seconds,
+        slowest seconds, retries)]) with templates in descending total time
+    """
+
+    phases = []
+    templates = {}
+    for kind, name, _, start, end, args in stored["spans"]:
+        duration = (end or stored["end"]) - start
+        if kind == "phase":
+            phases.append((name, duration))
+            continue
+        entry = templates.setdefault(name, [name, 0, 0.0, 0.0, 0])
+        entry[1] += 1
+        entry[2] += duration
+        entry[3] = max(entry[3], duration)
+        entry[4] += args.get("retries", 0)
+
+    return phases, sorted(
+        (tuple(x) for x in templates.values()),
+        key=lambda x: x[2],
+        reverse=True,
+    )
@@ -0,0 +1,203 @@
+"""HTTP transports for ESI requests.
+
+By default requests are made with a requests.Session, over a pool of
+HTTP/1.1 connections. With ESI_KNIFE_HTTP2 set (and the http2 extra
+installed, ie `pip install esi-knife[http2]`) they're made with httpx
+instead, multiplexed as HTTP/2 streams over a few connections shared by
+every job in the process.
+
+Either way, lookups of ESI's host are cached for ESI_KNIFE_DNS_TTL seconds
+and warm_up() opens connections to ESI before the first job needs them.
+"""
+
+
+import os
+import time
+import socket
+import logging
+import threading
+import importlib.util
+
+try:
+    from urllib.parse import urlparse
+except ImportError:
+    from urlparse import urlparse
+
+import gevent
+
+from esi_knife import ESI
+from esi_knife import LOG
+from esi_knife import env_flag
+
+
+HTTP2 = env_flag("ESI_KNIFE_HTTP2", False)
+HTTP2_CONNECTIONS = int(os.environ.get("ESI_KNIFE_HTTP2_CONNECTIONS", 4))
+DNS_TTL = float(os.environ.get("ESI_KNIFE_DNS_TTL", 300))
+WARM_CONNECTIONS = int(os.environ.get("ESI_KNIFE_WARM_CONNECTIONS", 4))
+
+DNS_CACHE_SIZE = 1000
+
+_ESI_HOST = urlparse(ESI).hostname
+_DNS_CACHE = {}  # {getaddrinfo args: (expiry, addresses)}
+_DNS_LOCK = threading.Lock()
+_INSTALLED = []
+
+
+def _cached_getaddrinfo(getaddrinfo):
+    """Return getaddrinfo, with lookups of ESI cached for DNS_TTL.
+
+    Other hosts (redis, the cold store, ...) are resolved as usual.
+    """
+
+    def _getaddrinfo(*args, **kwargs):
+        """Resolve ESI from the cache, or anything with getaddrinfo."""
+
+        host = args[0] if args else kwargs.get("host")
+        if host != _ESI_HOST:
+            return getaddrinfo(*args, **kwargs)
+
+        key = (args, tuple(sorted(kwargs.items())))
+        cached = _DNS_CACHE.get(key)
+        if cached is not None and cached[0] > time.time():
+            return list(cached[1])
+
+        addresses = getaddrinfo(*args, **kwargs)
+        with _DNS_LOCK:
+            if len(_DNS_CACHE) >= DNS_CACHE_SIZE:
+                _DNS_CACHE.clear()
+            _DNS_CACHE[key] = (time.time() + DNS_TTL, list(addresses))
+        return addresses
+
+    return _getaddrinfo
+
+
+def install_dns_cache():
+    """Cache lookups of ESI for ESI_KNIFE_DNS_TTL seconds, unless it's 0.
+
+    Neither transport takes a resolver, so this wraps socket.getaddrinfo,
+    which both resolve through. Only ESI's host is cached, call it after
+    gevent's monkey patching. Safe to call more than once.
+    """
+
+    if DNS_TTL <= 0 or _INSTALLED:
+        return
+
+    _INSTALLED.append(True)
+    socket.getaddrinfo = _cached_getaddrinfo(socket.getaddrinfo)
+
+
+class _Http2Response(object):
+    """An httpx response which only raises for errors, as requests does.
+
+    httpx also raises for redirects, including the 304s of conditional
+    requests.
+    """
+
+    def __init__(self, response):
+        self._response = response
+
+    def __getattr__(self, name):
+        return getattr(self._response, name)
+
+    def raise_for_status(self):
+        """Raise for 4xx and 5xx responses."""
+
+        if self._response.status_code >= 400:
+            self._response.raise_for_status()
+
+
+class Http2Session(object):
+    """The parts of requests.Session that utils.request_or_wait uses.
+
+    Args:
+        headers: dictionary of headers sent with every request
+    """
+
+    http2 = True
+
+    def __init__(self, headers):
+        import httpx
+
+        # httpx logs every request at INFO
+        logging.getLogger("httpx").setLevel(logging.WARNING)
+        self.headers = headers
+        self.client = httpx.Client(
+            headers=headers,
+            # no read timeout, as with requests
+            timeout=httpx.Timeout(None, connect=10),
+            transport=httpx.HTTPTransport(
+                http2=True,
+                limits=httpx.Limits(
+                    max_connections=HTTP2_CONNECTIONS,
+                    max_keepalive_connections=HTTP2_CONNECTIONS,
+                ),
+            ),
+        )
+
+    def request(self, method, url, **kwargs):
+        """Make a request, returning a requests-like response."""
+
+        return _Http2Response(self.client.request(method, url, **kwargs))
+
+    def get(self, url, **kwargs):
+        """Make a GET request."""
+
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        """Make a POST request."""
+
+        return self.request("POST", url, **kwargs)
+
+    def close(self):
+        """Close all connections."""
+
+        self.client.close()
+
+
+def http2_session(headers):
+    """Return an Http2Session, or None if HTTP/2 is off or unavailable."""
+
+    if not HTTP2:
+        return None
+
+    if importlib.util.find_spec("h2") is None or \
+            importlib.util.find_spec("httpx") is None:
+        LOG.warning(
+            "ESI_KNIFE_HTTP2 needs the http2 extra, "
+            "pip install esi-knife[http2]. using HTTP/1.1"
+        )
+        return None
+
+    return Http2Session(headers)
+
+
+def warm_up(session, connections=WARM_CONNECTIONS):
+    """Open connections to ESI before the first job needs them.
+
+    Over HTTP/2 every request shares one connection, so only one is made.
+    Failures are logged, jobs will connect as usual.
+    """
+
+    if connections <= 0:
+        return
+
+    if getattr(session, "http2", False):
+        connections = 1
+
+    def _ping():
+        """Request ESI's ping, leaving the connection in the pool."""
+
+        try:
+            session.get("{}/ping".format(ESI))
+        except Exception as error:
+            LOG.warning("failed to warm up a connection to ESI: %r", error)
+
+    start = time.time()
+    gevent.joinall([gevent.spawn(_ping) for _ in range(connections)])
+    LOG.info(
+        "warmed up %d connection%s to ESI in %.2fs",
+        connections,
+        "" if connections == 1 else "s",
+        time.time() - start,
+    )
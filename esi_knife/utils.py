@@ -1,59 +1,335 @@
 """ESI Knife utils."""
 
 
+import os
+import zlib
 import time
 import base64
 import codecs
+import hashlib
+import functools
+import threading
+from email.utils import mktime_tz
+from email.utils import parsedate_tz
 
 import redis
 import ujson
-import gevent
 import requests
 from flask import request
 from jsonderef import JsonDeref
 from requests.adapters import HTTPAdapter
 
 from esi_knife import __version__
+from esi_knife import Lazy
 from esi_knife import Keys
-from esi_knife import APP
 from esi_knife import ESI
 from esi_knife import LOG
 from esi_knife import CACHE
+from esi_knife import retry
+from esi_knife import storage
+from esi_knife import columnar
+from esi_knife import transport
 
 
 try:
-    from gzip import compress
     from gzip import decompress
+    WBITS = 16 + zlib.MAX_WBITS  # gzip
 except ImportError:
     # python2
-    from zlib import compress
     from zlib import decompress
+    WBITS = zlib.MAX_WBITS
 
 
 EXPIRY = 604800  # 7 days
+WRITE_CHUNK = 1048575  # compressed bytes per append, a multiple of 3
+BLOB_GROUP = 100  # routes per blob round trip
+BLOB_GROUP_BYTES = 16777216  # or uncompressed bytes, whichever is first
+
+
+def _parse_rate_limits(config):
+    """Parse "route:requests/seconds,..." into a dictionary of limits."""
+
+    limits = {"default": (20, 60)}
+    for rule in config.split(","):
+        if not rule.strip():
+            continue
+        try:
+            route, limit = rule.split(":")
+            reqs, period = limit.split("/")
+            limits[route.strip()] = (int(reqs), int(period))
+        except ValueError:
+            LOG.warning("invalid rate limit rule: %r", rule)
+    return limits
+
+
+# per-route token buckets, capacity requests refilled over period seconds
+RATE_LIMITS = _parse_rate_limits(
+    os.environ.get("ESI_KNIFE_RATE_LIMITS", "")
+)
+
+# refill, take one token and return 1 if limited. atomic via EVALSHA
+_RATE_LIMIT_LUA = """
+local capacity = tonumber(ARGV[1])
+local period = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local bucket = redis.call("HMGET", KEYS[1], "tokens", "stamp")
+local tokens = tonumber(bucket[1]) or capacity
+local stamp = tonumber(bucket[2]) or now
+local refill = math.max(0, now - stamp) * capacity / period
+tokens = math.min(capacity, tokens + refill)
+local limited = 1
+if tokens >= 1 then
+    tokens = tokens - 1
+    limited = 0
+end
+redis.call("HMSET", KEYS[1], "tokens", tokens, "stamp", tostring(now))
+redis.call("EXPIRE", KEYS[1], math.ceil(period))
+return limited
+"""
+_RATE_LIMIT_SCRIPT = []
+_LOCAL_BUCKETS = {}
+_LOCAL_BUCKETS_LOCK = threading.Lock()
 
 
 def new_session():
-    """Build a new requests.Session object."""
+    """Build a new requests.Session, or HTTP/2 session if configured."""
+
+    transport.install_dns_cache()
+    headers = {"User-Agent": "ESI-knife/{}".format(__version__)}
+    session = transport.http2_session(headers)
+    if session is not None:
+        return session
 
     session = requests.Session()
-    session.headers["User-Agent"] = "ESI-knife/{}".format(__version__)
+    session.headers.update(headers)
     session.mount(
         "https://",
-        HTTPAdapter(max_retries=3, pool_connections=10, pool_maxsize=100),
+        # retries are made by request_or_wait, see esi_knife.retry
+        HTTPAdapter(pool_connections=10, pool_maxsize=100),
     )
     return session
 
 
-SESSION = new_session()
+SESSION = Lazy(new_session)
+
+
+class Batch(object):
+    """Queue cache operations to run in a single round trip.
+
+    With redis the operations are sent as one pipeline, by default wrapped
+    in MULTI/EXEC so they're also applied atomically. Without redis they're
+    run in order against the simple cache on execute.
+    """
+
+    def __init__(self, transaction=True):
+        self.transaction = transaction
+        self.operations = []
+
+    def get(self, key):
+        """Queue a get, its result is the loaded value or None."""
+
+        self.operations.append(("get", key, ()))
+
+    def set(self, key, value, timeout=None):
+        """Queue a set, with the cache's default timeout if not provided."""
+
+        self.operations.append(("set", key, (value, timeout)))
+
+    def delete(self, *keys):
+        """Queue deleting one or more keys."""
+
+        self.operations.append(("delete", keys, ()))
+
+    def has(self, key):
+        """Queue an existence check, its result is a boolean."""
+
+        self.operations.append(("has", key, ()))
+
+    def expire(self, key, timeout):
+        """Queue resetting the key's timeout."""
+
+        self.operations.append(("expire", key, (timeout,)))
+
+    def inc(self, key, delta=1):
+        """Queue an increment, its result is the new value."""
+
+        self.operations.append(("inc", key, (delta,)))
+
+    def rename(self, key, new_key):
+        """Queue moving the value at key to new_key."""
+
+        self.operations.append(("rename", key, (new_key,)))
+
+    def zadd(self, key, member, score):
+        """Queue setting member's score in a sorted set (redis only)."""
+
+        self.operations.append(("zadd", key, (member, score)))
+
+    def execute(self):
+        """Run all queued operations.
+
+        Returns:
+            list of results, in the order the operations were queued
+        """
+
+        operations, self.operations = self.operations, []
+        if not operations:
+            return []
+
+        cache = CACHE.cache
+        client = getattr(cache, "_client", None)
+        if client is None:
+            return [self._run_local(cache, *op) for op in operations]
+
+        pipe = client.pipeline(transaction=self.transaction)
+        for operation, key, args in operations:
+            queue = getattr(self, "_redis_{}".format(operation), None)
+            if queue is None:
+                getattr(pipe, operation)(cache.key_prefix + key, *args)
+            else:
+                queue(pipe, cache, key, args)
+
+        loaders = {"get": cache.load_object, "has": bool}
+        return [
+            loaders[operation](result) if operation in loaders else result
+            for (operation, _, _), result in zip(operations, pipe.execute())
+        ]
+
+    @staticmethod
+    def _redis_delete(pipe, cache, keys, _):
+        """Queue deleting keys."""
+
+        pipe.delete(*[cache.key_prefix + x for x in keys])
+
+    @staticmethod
+    def _redis_set(pipe, cache, key, args):
+        """Queue a set, with or without a timeout."""
+
+        value, timeout = args
+        timeout = cache._normalize_timeout(timeout)  # pylint: disable=W0212
+        if timeout == -1:
+            pipe.set(cache.key_prefix + key, cache.dump_object(value))
+        else:
+            pipe.setex(
+                cache.key_prefix + key,
+                timeout,
+                cache.dump_object(value),
+            )
+
+    @staticmethod
+    def _redis_has(pipe, cache, key, _):
+        """Queue an existence check."""
+
+        pipe.exists(cache.key_prefix + key)
+
+    @staticmethod
+    def _redis_inc(pipe, cache, key, args):
+        """Queue an increment."""
+
+        pipe.incr(cache.key_prefix + key, args[0])
+
+    @staticmethod
+    def _redis_zadd(pipe, cache, key, args):
+        """Queue setting a sorted set member's score."""
+
+        pipe.zadd(cache.key_prefix + key, {args[0]: args[1]})
+
+    @staticmethod
+    def _redis_rename(pipe, cache, key, args):
+        """Queue a rename."""
+
+        pipe.rename(cache.key_prefix + key, cache.key_prefix + args[0])
+
+    @staticmethod
+    def _run_local(cache, operation, key, args):
+        """Run a single operation against a non-redis cache."""
+
+        run = getattr(Batch, "_local_{}".format(operation), None)
+        if run is None:
+            return getattr(cache, operation)(key, *args)
+        return run(cache, key, args)
+
+    @staticmethod
+    def _local_delete(cache, keys, _):
+        """Delete keys."""
+
+        return cache.delete_many(*keys)
+
+    @staticmethod
+    def _local_has(cache, key, _):
+        """Return True if the key exists."""
+
+        return bool(cache.has(key))
+
+    @staticmethod
+    def _local_expire(cache, key, args):
+        """Reset the key's timeout, the simple cache has no expire."""
+
+        entries = getattr(cache, "_cache", {})
+        if key not in entries:
+            return False
+        entries[key] = (
+            cache._normalize_timeout(args[0]),  # pylint: disable=W0212
+            entries[key][1],
+        )
+        return True
+
+    @staticmethod
+    def _local_rename(cache, key, args):
+        """Move the value at key to the new key."""
+
+        cache.set(args[0], cache.get(key))
+        return cache.delete(key)
+
+    @staticmethod
+    def _local_zadd(*_):
+        """Sorted sets are only used for tiering, which needs redis."""
+
+        return 0
+
+
+def resolve(uuid):
+    """Return the uuid of the job uuid was attached to, or uuid."""
+
+    try:
+        return CACHE.get("{}{}".format(Keys.alias.value, uuid)) or uuid
+    except Exception as error:
+        LOG.warning("failed to resolve %s: %r", uuid, error)
+    return uuid
+
+
+def _touch(uuid):
+    """Record a result's use, for demoting idle results to cold storage.
+
+    Only results which exist are recorded, and only with cold storage
+    configured, demote_idle is what prunes the record.
+    """
+
+    if storage.cold_store() is None:
+        return
+
+    batch = Batch(transaction=False)
+    batch.zadd(Keys.hot.value, uuid, time.time())
+    try:
+        batch.execute()
+    except Exception as error:
+        LOG.warning("failed to record use of %s: %r", uuid, error)
 
 
 def get_data(uuid):
     """Open and return the character's data."""
 
+    uuid = resolve(uuid)
     cache_key = "{}{}".format(Keys.complete.value, uuid)
+    batch = Batch(transaction=False)
+    batch.get(cache_key)
+    batch.expire(cache_key, EXPIRY)
     try:
-        content = CACHE.get(cache_key)
+        content = batch.execute()[0]
+        if storage.is_pointer(content):
+            content = storage.promote(uuid)
+        elif content is not None:
+            _touch(uuid)
     except Exception as error:
         LOG.warning("failed to get %s: %r", cache_key, error)
     else:
@@ -61,18 +337,51 @@ def get_data(uuid):
             return None
 
         try:
-            return ujson.loads(decompress(base64.b64decode(content)))
+            if Manifest.is_manifest(content):
+                return columnar.expand_all(Manifest(content).read_all())
+            return columnar.expand_all(
+                ujson.loads(decompress(base64.b64decode(content)))
+            )
         except Exception as error:
             LOG.warning("failed to decode %s: %r", content, error)
-        else:
-            CACHE.cache._client.expire(  # pylint: disable=protected-access
-                cache_key,
-                EXPIRY,
-            )
 
     return None
 
 
+def get_state(uuid):
+    """Return the Keys member for an unfinished job's state, or None."""
+
+    uuid = resolve(uuid)
+    states = (Keys.pending, Keys.processing, Keys.new)
+    batch = Batch(transaction=False)
+    for state in states:
+        batch.has("{}{}".format(state.value, uuid))
+
+    try:
+        found = batch.execute()
+    except Exception as error:
+        LOG.warning("failed to get state for %s: %r", uuid, error)
+        return None
+
+    for state, exists in zip(states, found):
+        if exists:
+            return state
+    return None
+
+
+def has_data(uuid):
+    """Return True if results are stored for uuid."""
+
+    try:
+        return bool(CACHE.cache.has("{}{}".format(
+            Keys.complete.value,
+            resolve(uuid),
+        )))
+    except Exception as error:
+        LOG.warning("failed to check for %s: %r", uuid, error)
+    return False
+
+
 def list_keys(prefix):
     """Return all keys with the given prefix."""
 
@@ -90,27 +399,337 @@ def list_keys(prefix):
     ]
 
 
-def write_data(uuid, data):
-    """Try to store the data, log errors."""
+def _json_chunks(data):
+    """Yield the JSON document for data as UTF-8 bytes, a route at a time.
 
-    try:
-        CACHE.set(
-            "{}{}".format(Keys.complete.value, uuid),
-            codecs.decode(
-                base64.b64encode(compress(codecs.encode(
-                    ujson.dumps(data),
-                    "utf-8",
-                ))),
-                "utf-8",
-            ),
-            timeout=EXPIRY,
+    Spooled values are copied out as JSON without being decoded.
+    """
+
+    raw = getattr(data, "raw", None)
+    yield b"{"
+    for i, key in enumerate(data):
+        yield codecs.encode(
+            "{}{}:".format("," if i else "", ujson.dumps(key)),
+            "utf-8",
         )
+        if raw is None:
+            yield codecs.encode(ujson.dumps(data[key]), "utf-8")
+        else:
+            yield raw(key)
+    yield b"}"
+
+
+def encoded_chunks(data):
+    """Yield the base64 compressed document for data in WRITE_CHUNK pieces.
+
+    Each piece is a multiple of 3 bytes before encoding, so the pieces can
+    be concatenated into one valid base64 string.
+    """
+
+    compressor = zlib.compressobj(9, zlib.DEFLATED, WBITS)
+    pending = b""
+    for chunk in _json_chunks(data):
+        pending += compressor.compress(chunk)
+        while len(pending) >= WRITE_CHUNK:
+            yield base64.b64encode(pending[:WRITE_CHUNK])
+            pending = pending[WRITE_CHUNK:]
+
+    pending += compressor.flush()
+    for i in range(0, len(pending), WRITE_CHUNK):
+        yield base64.b64encode(pending[i:i + WRITE_CHUNK])
+
+
+def blob_keys(digest):
+    """Return the blob and reference count keys for a hash."""
+
+    return (
+        "{}{}".format(Keys.blob.value, digest),
+        "{}{}".format(Keys.blob_refs.value, digest),
+    )
+
+
+def _put_blobs(payloads):
+    """Reference blobs for {hash: JSON bytes}, storing any that are new.
+
+    The references are counted before checking for the blob, so a blob
+    being released at the same time is either kept or written again. A
+    payload of None only references an existing blob.
+
+    Returns:
+        tuple of (integer compressed bytes written, set of missing hashes)
+    """
+
+    batch = Batch()
+    for digest in payloads:
+        blob_key, refs_key = blob_keys(digest)
+        batch.inc(refs_key)
+        batch.expire(refs_key, EXPIRY)
+        batch.has(blob_key)
+    exists = batch.execute()[2::3]
+
+    written = 0
+    missing = set()
+    batch = Batch(transaction=False)
+    for digest, found in zip(payloads, exists):
+        blob_key, _ = blob_keys(digest)
+        if found:
+            batch.expire(blob_key, EXPIRY)
+        elif payloads[digest] is None:
+            missing.add(digest)
+        else:
+            frame = zlib.compress(payloads[digest])
+            batch.set(blob_key, frame, timeout=EXPIRY)
+            written += len(frame)
+    batch.execute()
+    return written, missing
+
+
+def missing_blobs(hashes):
+    """Return the set of hashes whose blobs aren't stored."""
+
+    hashes = sorted(set(hashes))
+    batch = Batch(transaction=False)
+    for digest in hashes:
+        batch.has(blob_keys(digest)[0])
+    return set(
+        digest for digest, exists in zip(hashes, batch.execute())
+        if not exists
+    )
+
+
+def _reference_blobs(reuse):
+    """Reference the blobs of reused routes, all or none of them.
+
+    Returns:
+        set of the hashes referenced, or None if any blob is missing
+    """
+
+    hashes = dict.fromkeys(digest for digest, _ in reuse.values())
+    if not hashes:
+        return set()
+
+    _, missing = _put_blobs(hashes)
+    if not missing:
+        return set(hashes)
+
+    batch = Batch(transaction=False)
+    for digest in hashes:
+        batch.inc(blob_keys(digest)[1], -1)
+    batch.execute()
+    LOG.warning("%d reused blobs are missing", len(missing))
+    return None
+
+
+def _store_blobs(data, reuse=None):
+    """Store every route in data as a content-addressed blob.
+
+    KWargs:
+        reuse: dictionary of {route: (hash, size)} already stored as blobs
+
+    Returns:
+        dictionary of {route: (hash, uncompressed size)}, or None if any
+        reused blob has expired, nothing is then stored
+    """
+
+    reuse = reuse or {}
+    seen = _reference_blobs(reuse)
+    if seen is None:
+        return None
+
+    raw = getattr(data, "raw", None)
+    routes = dict(reuse)
+    size = 0
+    written = 0
+    group = {}
+    group_bytes = 0
+
+    for route in data:
+        if raw is None:
+            payload = codecs.encode(ujson.dumps(data[route]), "utf-8")
+        else:
+            payload = raw(route)
+
+        digest = hashlib.sha1(payload).hexdigest()
+        routes[route] = (digest, len(payload))
+        size += len(payload)
+        if digest in seen:
+            continue  # referenced once per result
+
+        seen.add(digest)
+        group[digest] = payload
+        group_bytes += len(payload)
+        if len(group) >= BLOB_GROUP or group_bytes >= BLOB_GROUP_BYTES:
+            written += _put_blobs(group)[0]
+            group = {}
+            group_bytes = 0
+
+    if group:
+        written += _put_blobs(group)[0]
+
+    LOG.debug("wrote %d of %d bytes as new blobs", written, size)
+    return routes
+
+
+class Manifest(object):
+    """A stored result, as a mapping of route to content-addressed blobs.
+
+    Manifests are JSON, with the size first so it can be read cheaply:
+
+        {"size": 1234, "routes": {route: hash, ...}}
+
+    Args:
+        content: the stored manifest
+    """
+
+    def __init__(self, content):
+        manifest = ujson.loads(content)
+        self.size = manifest["size"]
+        self.routes = manifest["routes"]
+
+    @staticmethod
+    def is_manifest(content):
+        """Return True if stored content is a manifest."""
+
+        return content[:1] in (b"{", "{")
+
+    @staticmethod
+    def dumps(routes):
+        """Return the manifest for {route: (hash, size)}, as bytes."""
+
+        return codecs.encode('{{"size":{},"routes":{}}}'.format(
+            sum(size for _, size in routes.values()),
+            ujson.dumps({k: digest for k, (digest, _) in routes.items()}),
+        ), "utf-8")
+
+    def __iter__(self):
+        return iter(self.routes)
+
+    def __len__(self):
+        return len(self.routes)
+
+    def __getitem__(self, route):
+        return ujson.loads(self.raw(route))
+
+    def hashes(self):
+        """Return the unique blob hashes in the manifest."""
+
+        return sorted(set(self.routes.values()))
+
+    def raw(self, route):
+        """Return the JSON encoded data for route, as UTF-8 bytes.
+
+        Raises:
+            KeyError if the route or its blob is missing
+        """
+
+        blob_key, _ = blob_keys(self.routes[route])
+        frame = CACHE.get(blob_key)
+        if frame is None:
+            raise KeyError(blob_key)
+        return zlib.decompress(frame)
+
+    def read_all(self):
+        """Return {route: data}, refreshing the blobs' timeouts.
+
+        Routes whose blob is missing are logged and left out.
+        """
+
+        hashes = self.hashes()
+        batch = Batch(transaction=False)
+        for digest in hashes:
+            blob_key, refs_key = blob_keys(digest)
+            batch.get(blob_key)
+            batch.expire(blob_key, EXPIRY)
+            batch.expire(refs_key, EXPIRY)
+        frames = dict(zip(hashes, batch.execute()[::3]))
+
+        results = {}
+        for route, digest in self.routes.items():
+            if frames[digest] is None:
+                LOG.warning("blob %s for %s is missing", digest, route)
+            else:
+                results[route] = ujson.loads(zlib.decompress(frames[digest]))
+        return results
+
+
+def write_data(uuid, data, batch=None, reuse=None):
+    """Try to store the data, log errors.
+
+    Each route is stored once as a blob addressed by its hash, shared by
+    every result with the same data for that route. The result itself is a
+    Manifest, written to a staging key then renamed into place. data can be
+    a dictionary or a Spool.
+
+    If a Batch is provided the rename is only queued in it, the caller is
+    responsible for executing it along with any other state changes.
+
+    KWargs:
+        batch: Batch to queue the rename in
+        reuse: dictionary of {route: (hash, size)} of previously stored
+               routes to include in the result, nothing is stored if any
+               have expired
+
+    Returns:
+        dictionary of {route: (hash, size)} stored, or None on failure
+    """
+
+    staging_key = "{}{}".format(Keys.staging.value, uuid)
+    complete_key = "{}{}".format(Keys.complete.value, uuid)
+
+    try:
+        routes = _store_blobs(data, reuse=reuse)
+        if routes is None:
+            # rather than a result missing the routes
+            LOG.warning("not saving %s, its reused routes expired", uuid)
+            return None
+        manifest = Manifest.dumps(routes)
+        cache = CACHE.cache
+        client = getattr(cache, "_client", None)
+        if client is None:
+            cache.set(
+                staging_key,
+                codecs.decode(manifest, "utf-8"),
+                timeout=EXPIRY,
+            )
+        else:
+            client.setex(cache.key_prefix + staging_key, EXPIRY, manifest)
+
+        queue = batch or Batch()
+        queue.rename(staging_key, complete_key)
+        queue.expire(complete_key, EXPIRY)
+        if storage.cold_store() is not None:
+            queue.zadd(Keys.hot.value, uuid, time.time())
+        if batch is None:
+            queue.execute()
     except Exception as error:
         LOG.warning("Failed to save data: %r", error)
+        return None
+
+    return routes
+
+
+def _expires(res):
+    """Return the Expires header of a response as a timestamp, or 0."""
 
+    parsed = parsedate_tz(res.headers.get("Expires") or "")
+    return mktime_tz(parsed) if parsed else 0
 
-def request_or_wait(url, _as_res=False, page=None, method="get", **kwargs):
-    """Request the URL, or wait if we're error limited."""
+
+def request_or_wait(url, _as_res=False,  # pylint: disable=R0913
+                    page=None, method="get", _meta=None, _retries=None,
+                    **kwargs):
+    """Request the URL, retrying failures and waiting out the error limit.
+
+    5xx responses and connection errors are retried with jittered backoff,
+    up to retry.ATTEMPTS tries, each retry taken from the _retries budget
+    (the job's retry.Budget, or a new one). Requests to a route whose
+    circuit breaker is open fail without being made.
+
+    If _meta is a dictionary it's updated with the response's status,
+    ETag, Expires (as a timestamp) and elapsed seconds. A 304 response
+    returns None data. Failures set its error to the status code, and it
+    counts the retries and seconds waited, backing off or error limited.
+    """
 
     check_x_pages = True
     if page:
@@ -121,23 +740,21 @@ def request_or_wait(url, _as_res=False, page=None, method="get", **kwargs):
     else:
         LOG.debug("requesting: %s", url)
 
-    try:
-        res = getattr(SESSION, method)(url, **kwargs)
-        res.raise_for_status()
-    except Exception as err:
-        try:
-            if res.status_code == 420:
-                wait = int(res.headers.get("X-Esi-Error-Limit-Reset", 1)) + 1
-                APP.error_limited = True
-                LOG.warning("hit the error limit, waiting %d seconds", wait)
-                # error limited. wait out the window then carry on
-                gevent.sleep(wait)
-                APP.error_limited = False
-                return request_or_wait(url, _as_res=_as_res, page=page,
-                                       method=method, **kwargs)
-        except Exception as error:
-            LOG.warning("error handling error: %r: %r", err, error)
+    res, status = retry.call(
+        functools.partial(getattr(SESSION, method), url, **kwargs),
+        url,
+        budget=_retries,
+        meta=_meta,
+    )
+    if res is None:
+        return None, url, "Error fetching data: {} circuit open".format(
+            retry.breaker(url).name,
+        )
+
+    if status is None:
+        return None, url, "Error fetching data: {!r}".format(res)
 
+    if status >= 400:
         try:
             content = res.json()
         except Exception:
@@ -146,20 +763,32 @@ def request_or_wait(url, _as_res=False, page=None, method="get", **kwargs):
         # /shrug some other error, can't win em all
         return None, url, \
             res if _as_res else "Error fetching data: {} {}".format(
-                res.status_code,
+                status,
                 content,
             )
+
+    if _meta is not None:
+        _meta.update(
+            status=res.status_code,
+            etag=res.headers.get("ETag"),
+            expires=_expires(res),
+            elapsed=res.elapsed.total_seconds(),
+        )
+
+    if check_x_pages:
+        try:
+            pages = list(range(2, int(res.headers.get("X-Pages", 0)) + 1))
+        except Exception as error:
+            LOG.warning("error checking x-pages for %s: %r", url, error)
+            pages = None
     else:
-        if check_x_pages:
-            try:
-                pages = list(range(2, int(res.headers.get("X-Pages", 0))))
-            except Exception as error:
-                LOG.warning("error checking x-pages for %s: %r", url, error)
-                pages = None
-        else:
-            pages = page
+        pages = page
 
-        return pages, url, res if _as_res else res.json()
+    if _as_res:
+        return pages, url, res
+    if res.status_code == 304:
+        return pages, url, None
+    return pages, url, res.json()
 
 
 def refresh_spec():
@@ -222,13 +851,55 @@ def get_ip():
         return request.remote_addr
 
 
-def rate_limit():
-    """Apply a rate limit."""
+def _local_rate_limit(key, capacity, period):
+    """In-process token bucket, used when redis is unavailable.
 
-    key = "".join((Keys.rate_limit.value, get_ip()))
-    reqs = CACHE.get(key) or 0
-    if reqs >= 20:
-        return True
+    This is only approximate, each process keeps its own buckets.
+    """
 
-    CACHE.set(key, reqs + 1, timeout=60)
-    return False
+    now = time.time()
+    with _LOCAL_BUCKETS_LOCK:
+        if len(_LOCAL_BUCKETS) > 10000:
+            for stale in [k for k, (_, stamp, ttl) in _LOCAL_BUCKETS.items()
+                          if now - stamp > ttl]:
+                _LOCAL_BUCKETS.pop(stale)
+
+        tokens, stamp, _ = _LOCAL_BUCKETS.get(key, (capacity, now, period))
+        refill = max(0, now - stamp) * capacity / float(period)
+        tokens = min(capacity, tokens + refill)
+        limited = tokens < 1
+        if not limited:
+            tokens -= 1
+        _LOCAL_BUCKETS[key] = (tokens, now, period)
+
+    return limited
+
+
+def rate_limit(route="default"):
+    """Apply a rate limit.
+
+    Args:
+        route: name of the limit to apply from RATE_LIMITS
+
+    Returns:
+        boolean True if the request should be refused
+    """
+
+    capacity, period = RATE_LIMITS.get(route, RATE_LIMITS["default"])
+    key = "{}{}.{}".format(Keys.rate_limit.value, route, get_ip())
+
+    client = getattr(CACHE.cache, "_client", None)
+    if client is not None:
+        try:
+            if not _RATE_LIMIT_SCRIPT:
+                _RATE_LIMIT_SCRIPT.append(
+                    client.register_script(_RATE_LIMIT_LUA)
+                )
+            return bool(_RATE_LIMIT_SCRIPT[0](
+                keys=["{}{}".format(CACHE.cache.key_prefix, key)],
+                args=[capacity, period, repr(time.time())],
+            ))
+        except Exception as error:
+            LOG.warning("rate limit script failed: %r", error)
+
+    return _local_rate_limit(key, capacity, period)
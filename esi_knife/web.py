@@ -5,14 +5,19 @@ from gevent import monkey
 monkey.patch_all()
 
 
+import os
+import hmac
 import uuid
+import tempfile
 from datetime import datetime
 
 import ujson
 import gevent
+from flask import abort
 from flask import request
 from flask import redirect
 from flask import Response
+from flask import send_file
 from flask import render_template
 
 from esi_knife import APP
@@ -23,7 +28,12 @@ from esi_knife import CLIENT_ID
 from esi_knife import EXPOSED_URL
 from esi_knife import CALLBACK_URL
 from esi_knife import utils
+from esi_knife import export
+from esi_knife import retry
 from esi_knife import worker
+from esi_knife import tracing
+from esi_knife import progress
+from esi_knife import profiler
 
 
 @APP.route("/", methods=["GET"])
@@ -76,7 +86,7 @@ def callback_route():
 def get_knife(token):
     """Direct URL access to a knife result."""
 
-    if utils.rate_limit():
+    if utils.rate_limit("view"):
         return Response(
             "chill out bruh, maybe you need to run a self-hosted copy",
             status=420,
@@ -84,13 +94,13 @@ def get_knife(token):
 
     results = utils.get_data(token)
     if results is None:
-        for state in (Keys.pending, Keys.processing, Keys.new):
-            if utils.list_keys("{}{}".format(state.value, token)):
-                return render_template(
-                    "pending.html",
-                    token=token,
-                    state=state.value,
-                )
+        state = utils.get_state(token)
+        if state is not None:
+            return render_template(
+                "pending.html",
+                token=token,
+                state=state.value,
+            )
         return redirect("/?e=invalid_token")
 
     if request.headers.get("Accept") == "application/json":
@@ -107,6 +117,118 @@ def get_knife(token):
     )
 
 
+@APP.route("/view/<token>/sqlite", methods=["GET"])
+def knife_sqlite(token):
+    """Download a knife result as a SQLite database."""
+
+    if utils.rate_limit("view"):
+        return Response(
+            "chill out bruh, maybe you need to run a self-hosted copy",
+            status=420,
+        )
+
+    results = utils.get_data(token)
+    if results is None:
+        return redirect("/view/{}/".format(token))
+
+    handle, path = tempfile.mkstemp(suffix=".sqlite")
+    os.close(handle)
+    try:
+        # built off the event loop, it's CPU bound for large results
+        gevent.get_hub().threadpool.apply(
+            export.to_sqlite,
+            (path, sorted(results.items())),
+        )
+        database = open(path, "rb")
+    finally:
+        os.remove(path)
+
+    filename = "{}.sqlite".format(token)
+    try:
+        # download_name is Flask 2.0+, attachment_filename is gone in 2.2
+        return send_file(  # pylint: disable=E1123
+            database,
+            mimetype="application/x-sqlite3",
+            as_attachment=True,
+            download_name=filename,
+        )
+    except TypeError:  # Flask < 2.0
+        return send_file(
+            database,
+            mimetype="application/x-sqlite3",
+            as_attachment=True,
+            attachment_filename=filename,
+        )
+
+
+@APP.route("/view/<token>/trace", methods=["GET"])
+def knife_trace(token):
+    """Display a knife run's trace, or download it with ?format=."""
+
+    if utils.rate_limit("view"):
+        return Response(
+            "chill out bruh, maybe you need to run a self-hosted copy",
+            status=420,
+        )
+
+    stored = tracing.load(utils.resolve(token))
+    if stored is None:
+        return redirect("/view/{}/".format(token))
+
+    exporters = {"chrome": tracing.to_chrome, "otlp": tracing.to_otlp}
+    export_format = request.args.get("format")
+    if export_format in exporters:
+        return Response(
+            ujson.dumps(exporters[export_format](stored)),
+            content_type="application/json",
+            headers={"Content-Disposition": "attachment; filename={}.{}.json"
+                                            .format(token, export_format)},
+        )
+
+    phases, routes = tracing.summary(stored)
+    return render_template(
+        "trace.html",
+        token=token,
+        phases=phases,
+        routes=routes[:100],
+        requests=sum(x[1] for x in routes),
+        total=stored["end"] - stored["start"],
+        dropped=stored["dropped"],
+    )
+
+
+@APP.route("/view/<token>/events", methods=["GET"])
+def knife_events(token):
+    """Stream a pending knife run's progress as server-sent events."""
+
+    if utils.rate_limit("events"):
+        return Response(
+            "chill out bruh, maybe you need to run a self-hosted copy",
+            status=420,
+        )
+
+    def _stream():
+        """Yield server-sent events until the job completes."""
+
+        for state in progress.listen(utils.resolve(token)):
+            if state is None:
+                if not utils.has_data(token):
+                    yield ": keepalive\n\n"
+                    continue
+                state = {"phase": "complete"}
+
+            yield "data: {}\n\n".format(ujson.dumps(state))
+
+            if state.get("phase") in progress.FINAL_PHASES:
+                break
+
+    return Response(
+        _stream(),
+        content_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
 @APP.route("/metrics", methods=["GET"])
 @CACHE.cached(timeout=20)
 def metrics_index():
@@ -121,13 +243,61 @@ def metrics_index():
         alltime=CACHE.get(Keys.alltime.value) or 0,
         worker=not APP.knife_worker.dead,
         error_limited=APP.error_limited,
+        breakers=retry.breakers(),
         now=datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ"),
     )
 
 
+def _debug_authorized():
+    """Abort unless the request has the ESI_KNIFE_DEBUG_TOKEN bearer token.
+
+    The /debug/ endpoints don't exist without one configured.
+    """
+
+    if not profiler.DEBUG_TOKEN:
+        abort(404)
+
+    if not hmac.compare_digest(
+            request.headers.get("Authorization", "").encode("utf-8"),
+            "Bearer {}".format(profiler.DEBUG_TOKEN).encode("utf-8")):
+        abort(403)
+
+
+@APP.route("/debug/blocks", methods=["GET"])
+def debug_blocks():
+    """Return the most recent hub blocks, newest first."""
+
+    _debug_authorized()
+    return Response(
+        ujson.dumps({
+            "threshold": profiler.BLOCKING_THRESHOLD,
+            "blocks": list(reversed(profiler.BLOCKS)),
+        }),
+        content_type="application/json",
+    )
+
+
+@APP.route("/debug/profile", methods=["GET"])
+def debug_profile():
+    """Sample this process for ?seconds= (default 10), as folded stacks."""
+
+    _debug_authorized()
+    try:
+        seconds = float(request.args.get("seconds", 10))
+    except ValueError:
+        abort(400)
+
+    stacks = profiler.sample(seconds)
+    if stacks is None:
+        return Response("a profile is already running", status=409)
+
+    return Response(stacks, content_type="text/plain")
+
+
 def main(debug=False):
     """Main gunicorn entrypoint."""
 
+    profiler.install()
     APP.knife_worker = gevent.spawn(worker.main)
     APP.config["debug"] = debug
     return APP
@@ -3,22 +3,44 @@
 
 import re
 import gc
+import os
 import copy
+import time
+import hashlib
 import random
 from traceback import format_exception
 from concurrent.futures import as_completed
-from concurrent.futures import ThreadPoolExecutor
 
+import ujson
 import gevent
 
 from esi_knife import LOG
 from esi_knife import ESI
 from esi_knife import Keys
 from esi_knife import CACHE
+from esi_knife import ID_KEYS
+from esi_knife import sde
+from esi_knife import cost
+from esi_knife import fetch
+from esi_knife import retry
 from esi_knife import utils
+from esi_knife import columnar
+from esi_knife import storage
+from esi_knife import tracing
+from esi_knife import progress
+from esi_knife import profiler
+from esi_knife import transport
+from esi_knife.spool import Spool
+from esi_knife.history import History
+from esi_knife.snapshot import Snapshot
+from esi_knife.scheduler import Scheduler
 
 
 WORKERS = []
+PROCESSING_EXPIRY = 7200
+# seconds a completed result is reused for duplicate submissions, and
+# whether duplicates attach to running jobs at all
+DEDUPE_WINDOW = int(os.environ.get("ESI_KNIFE_DEDUPE_WINDOW", 300))
 ADDITIONAL_PARAMS = {
     "character_id": {
         "event_id": "/characters/{character_id}/calendar/",
@@ -37,6 +59,46 @@ ADDITIONAL_PARAMS = {
 }
 
 
+def _flight_key(verify, roles):
+    """Return the single-flight key for a character, scopes and roles."""
+
+    return "{}.{}".format(verify["CharacterID"], hashlib.sha1(ujson.dumps([
+        sorted(verify["Scopes"].split()),
+        sorted(roles),
+    ]).encode("utf-8")).hexdigest())
+
+
+def _attach(uuid, flight_key):
+    """Find a running or recent job for the same character to attach to.
+
+    Returns:
+        uuid of the job to attach to, or None if this job should run, in
+        which case it's claimed the flight
+    """
+
+    if DEDUPE_WINDOW <= 0:
+        return None
+
+    recent = CACHE.get("{}{}".format(Keys.recent.value, flight_key))
+    if recent and utils.has_data(recent):
+        return recent
+
+    inflight_key = "{}{}".format(Keys.inflight.value, flight_key)
+    if CACHE.cache.add(inflight_key, uuid, timeout=PROCESSING_EXPIRY):
+        return None
+
+    # a job which claimed the flight is pending until its processing key
+    # is set, after _attach returns
+    running = CACHE.get(inflight_key)
+    if running and running != uuid and \
+            utils.get_state(running) is not None:
+        return running
+
+    # the claim outlived its job
+    CACHE.set(inflight_key, uuid, timeout=PROCESSING_EXPIRY)
+    return None
+
+
 def process_new():
     """Process all new tokens, verify or we're done early."""
 
@@ -44,8 +106,11 @@ def process_new():
         uuid = new_key.split(".")[-1]
         LOG.info("processing new uuid: %r", uuid)
 
-        token = CACHE.get(new_key)
-        CACHE.delete(new_key)
+        # claim the token atomically, other consumers will see it deleted
+        claim = utils.Batch()
+        claim.get(new_key)
+        claim.delete(new_key)
+        token = claim.execute()[0]
 
         if not token:
             LOG.warning("no token stored for uuid: %r", uuid)
@@ -57,15 +122,19 @@ def process_new():
             "1",
             timeout=70,
         )
+        progress.publish(uuid, phase="verify")
         headers = {"Authorization": "Bearer {}".format(token)}
         _, _, res = utils.request_or_wait(
             "{}/verify/".format(ESI),
             headers=headers,
         )
 
+        batch = utils.Batch()
+        batch.delete(pending_key)
+
         failed = False
         if isinstance(res, str) or "CharacterID" not in res:
-            utils.write_data(uuid, {"auth failure": res})
+            utils.write_data(uuid, {"auth failure": res}, batch=batch)
             failed = True
         else:
             _, _, roles = utils.request_or_wait(
@@ -76,18 +145,33 @@ def process_new():
                 headers=headers,
             )
             if isinstance(roles, str):
-                utils.write_data(uuid, {"roles failure": roles})
+                utils.write_data(uuid, {"roles failure": roles}, batch=batch)
                 failed = True
 
-        CACHE.delete(pending_key)
-
+        attached = None
         if not failed:
-            CACHE.set(
+            attached = _attach(uuid, _flight_key(res, roles))
+
+        if attached is not None:
+            batch.set(
+                "{}{}".format(Keys.alias.value, uuid),
+                attached,
+                timeout=utils.EXPIRY,
+            )
+        elif not failed:
+            batch.set(
                 "{}{}".format(Keys.processing.value, uuid),
                 res["CharacterID"],
-                timeout=7200,
+                timeout=PROCESSING_EXPIRY,
             )
 
+        batch.execute()
+
+        if failed:
+            progress.publish(uuid, phase="complete")
+        elif attached is not None:
+            LOG.info("attached uuid %r to %r", uuid, attached)
+        else:
             WORKERS.append(
                 gevent.spawn(knife, uuid, token, res, roles)
             )
@@ -100,8 +184,6 @@ def build_urls(scopes, roles, spec,  # pylint: disable=R0914,R0912
     ignored = [
         "/loyalty/stores/{corporation_id}/offers/",
         "/characters/{character_id}/search/",
-        "/corporations/{corporation_id}/contracts/{contract_id}/bids/",
-        "/corporations/{corporation_id}/contracts/{contract_id}/items/",
         "/characters/{character_id}/opportunities/",
     ]
 
@@ -179,10 +261,19 @@ def build_urls(scopes, roles, spec,  # pylint: disable=R0914,R0912
     return urls
 
 
+def _no_progress(**_):
+    """Default progress reporter, does nothing."""
+
+    pass
+
+
 def expand_params(scopes, roles, spec,  # pylint: disable=R0914,R0913
-                  known_params, all_params, headers):
+                  known_params, all_params, headers, scheduler,
+                  report=_no_progress, trace=tracing.NULL, retries=None):
     """Gather IDs from all_params into known_params."""
 
+    report(phase="expand")
+
     errors = []
     purge = {x: [] for x in all_params}
 
@@ -205,82 +296,60 @@ def expand_params(scopes, roles, spec,  # pylint: disable=R0914,R0913
 
     expansion_results = {}
 
-    with ThreadPoolExecutor(max_workers=20) as pool:
-        futures = {}
-        for parent, id_types in all_params.items():
-            for id_type, url in id_types.items():
-                oper = spec["paths"][url]["get"]
-                required_roles = oper.get("x-required-roles", [])
-                if any(x not in roles for x in required_roles):
-                    # we don't have the corporate roles for this route
-                    purge[parent].append(id_type)
-                    continue
+    futures = {}
+    for parent, id_types in all_params.items():
+        for id_type, url in id_types.items():
+            oper = spec["paths"][url]["get"]
+            required_roles = oper.get("x-required-roles", [])
+            if any(x not in roles for x in required_roles):
+                # we don't have the corporate roles for this route
+                purge[parent].append(id_type)
+                continue
 
-                required_sso = oper.get("security", [{}])[0].get("evesso", [])
-                if any(x not in scopes for x in required_sso):
-                    # our access token doesn't have this scope
-                    purge[parent].append(id_type)
-                    continue
+            required_sso = oper.get("security", [{}])[0].get("evesso", [])
+            if any(x not in scopes for x in required_sso):
+                # our access token doesn't have this scope
+                purge[parent].append(id_type)
+                continue
 
-                path = "https://esi.evetech.net/latest{}".format(
-                    url.format(**known_params)
-                )
-                futures[pool.submit(
-                    utils.request_or_wait,
-                    path,
-                    headers=headers,
-                )] = (url, parent, id_type)
-
-        pages = {}
-        while True:
-            completed = []
-            expansion = {}
-            for future in as_completed(futures):
-                completed.append(future)
-                templated_url, parent, id_type = futures[future]
-                page, url, data = future.result()
-                page_key = (templated_url, parent, id_type, url)
-
-                if page and isinstance(page, list):
-                    pages[page_key] = {1: data}
-                    for _page in page:
-                        expansion[pool.submit(
-                            utils.request_or_wait,
-                            url,
-                            page=_page,
-                            headers=headers,
-                        )] = (templated_url, parent, id_type)
-                elif isinstance(page, int):
-                    if isinstance(data, list):
-                        pages[page_key][page] = data
-                    else:
-                        LOG.warning("worker page expansion error: %r", data)
-                else:
-                    if templated_url in transform:
-                        expansion_results[url] = data
-                        all_params[parent][id_type] = transform[templated_url](
-                            data
-                        )
-                    elif isinstance(data, list):
-                        all_params[parent][id_type] = data
-                    else:
-                        LOG.warning("worker expansion error: %r", data)
-
-            for complete in completed:
-                futures.pop(complete)
-            futures.update(expansion)
-
-            if not futures:
-                break
+            path = "{}/latest{}".format(ESI, url.format(**known_params))
+            futures[scheduler.submit(
+                path,
+                headers=headers,
+                trace=trace,
+                retries=retries,
+            )] = (url, parent, id_type)
 
-        for details, page_data in pages.items():
-            templated_url, parent, id_type, url = details
-            data = []
-            for page in sorted(page_data):
-                data.extend(page_data[page])
-            if not data:
-                continue
-            if templated_url in transform:
+    pages = {}
+    while True:
+        completed = []
+        expansion = {}
+        for future in as_completed(futures):
+            completed.append(future)
+            templated_url, parent, id_type = futures[future]
+            page, url, data = future.result()
+            page_key = (templated_url, parent, id_type, url)
+
+            if page and isinstance(page, list):
+                pages[page_key] = {1: data}
+                for _page in page:
+                    expansion[scheduler.submit(
+                        url,
+                        page=_page,
+                        headers=headers,
+                        trace=trace,
+                        retries=retries,
+                    )] = (templated_url, parent, id_type)
+            elif isinstance(page, int):
+                if isinstance(data, list):
+                    pages[page_key][page] = data
+                else:
+                    LOG.warning("worker page expansion error: %r", data)
+            elif isinstance(data, str):
+                # failed, don't fan out on the characters of the URL
+                LOG.warning("worker expansion error: %r", data)
+                purge[parent].append(id_type)
+            elif templated_url in transform:
                 expansion_results[url] = data
                 try:
                     all_params[parent][id_type] = transform[templated_url](
@@ -293,12 +362,48 @@ def expand_params(scopes, roles, spec,  # pylint: disable=R0914,R0913
                         error,
                         data,
                     )
-            else:
+                    purge[parent].append(id_type)
+            elif isinstance(data, list):
                 all_params[parent][id_type] = data
+            else:
+                LOG.warning("worker expansion error: %r", data)
+                purge[parent].append(id_type)
+
+        for complete in completed:
+            futures.pop(complete)
+        futures.update(expansion)
+
+        if not futures:
+            break
 
-        for parent, purged_ids in purge.items():
-            for purged_id in purged_ids:
-                all_params[parent].pop(purged_id)
+    for details, page_data in pages.items():
+        templated_url, parent, id_type, url = details
+        data = []
+        for page in sorted(page_data):
+            data.extend(page_data[page])
+        if not data:
+            purge[parent].append(id_type)
+            continue
+        if templated_url in transform:
+            expansion_results[url] = data
+            try:
+                all_params[parent][id_type] = transform[templated_url](
+                    data
+                )
+            except Exception as error:
+                LOG.warning(
+                    "failed to transform %s. error: %r data: %r",
+                    url,
+                    error,
+                    data,
+                )
+                purge[parent].append(id_type)
+        else:
+            all_params[parent][id_type] = data
+
+    for parent, purged_ids in purge.items():
+        for purged_id in purged_ids:
+            all_params[parent].pop(purged_id, None)
 
     if errors:
         LOG.warning("worker errors: %s", " ".join(errors))
@@ -306,110 +411,69 @@ def expand_params(scopes, roles, spec,  # pylint: disable=R0914,R0913
     return expansion_results
 
 
-def _get_all_data(scopes, roles, known_params, all_params, headers):
-    """Retrieve all data for the parameters."""
+def _get_all_data(scopes, roles, known_params,  # pylint: disable=R0913
+                  all_params, headers, scheduler, report=_no_progress,
+                  snapshot=None, trace=tracing.NULL, budget=None,
+                  retries=None):
+    """Retrieve all data for the parameters.
+
+    Routes the snapshot can reuse are not requested, and not included.
+    Routes over the cost.Budget are skipped, they're listed in the results.
+
+    Returns:
+        Spool of {url: data}, the caller should close it when done
+    """
+
+    if snapshot is None:
+        snapshot = Snapshot(known_params["character_id"])
+    if budget is None:
+        budget = cost.Budget()
 
     spec = utils.refresh_spec()
-    results = expand_params(
+    history = History.load(known_params)
+    job = fetch.Fetch(
+        Spool(),
+        scheduler,
+        snapshot,
+        history,
+        headers,
+        trace=trace,
+        retries=retries,
+    )
+    job.add_expanded(expand_params(
         scopes,
         roles,
         spec,
         known_params,
         all_params,
         headers,
+        scheduler,
+        report=report,
+        trace=trace,
+        retries=retries,
+    ))
+    job.run(
+        job.plan(
+            build_urls(scopes, roles, spec, known_params, all_params),
+            budget,
+            report,
+        ),
+        report,
     )
+    history.save()
+    LOG.info(
+        "estimated %d requests for %s, made %d",
+        budget.estimated,
+        known_params["character_id"],
+        job.progress["pages_fetched"],
+    )
+    if budget.note() is not None:
+        job.results["budget exceeded"] = budget.note()
 
-    urls = build_urls(scopes, roles, spec, known_params, all_params)
-
-    page_expansions = {}  # {url: {page: results}}
-
-    with ThreadPoolExecutor(max_workers=20) as pool:
-        futures = []
-        for url in urls:
-            futures.append(pool.submit(
-                utils.request_or_wait,
-                url,
-                headers=headers,
-            ))
-
-        while True:
-            expansion_requests = []
-            completed_futures = []
-            for future in as_completed(futures):
-                completed_futures.append(future)
-                pages, url, result = future.result()
-                if pages and isinstance(pages, list):
-                    page_expansions[url] = {1: result}
-                    for page in pages:
-                        expansion_requests.append(pool.submit(
-                            utils.request_or_wait,
-                            url,
-                            page=page,
-                            headers=headers,
-                        ))
-                elif isinstance(pages, int):
-                    page_expansions[url][pages] = result
-                else:
-                    results[url] = result
-
-            for complete in completed_futures:
-                futures.remove(complete)
-            futures.extend(expansion_requests)
-
-            if not futures:
-                break
-
-    for url, pages in page_expansions.items():
-        data = []
-        for page in sorted(pages):
-            data.extend(pages[page])
-        if data:
-            results[url] = data
-
-    return results
-
-
-# attribute keys that can be resolved via /universe/names/
-ID_KEYS = [
-    "type_id",
-    "creator_id",
-    "creator_corporation_id",
-    "executor_corporation_id",
-    "contact_id",
-    "alliance_id",
-    "corporation_id",
-    "issuer_corporation_id",
-    "issuer_id",
-    "ship_type_id",
-    "installer_id",
-    "blueprint_type_id",
-    "product_type_id",
-    "solar_system_id",
-    # "from",  /mail/, can include mailing lists though
-    # "recipient_id",  /mail/, can include mailing lists though
-    # "sender_id",  /notifications/, can include factions though
-    "region_id",
-    # "planet_id",  use /universe/planets/{planet_id}/
-    "skill_id",
-    # "first_party_id",  includes factions
-    # "second_party_id",  includes factions
-    "tax_receiver_id",
-    "client_id",
-    "ceo_id",
-    "home_station_id",
-    "assignee_id",
-]
+    job.hydrate_killmails()
+    job.refetch_expired()
+    return job.results
 
-# TODO
-LOCATION_ID_KEYS = [
-    "location_id",
-    "end_location_id",
-    "start_location_id",
-    "blueprint_location_id",
-    "facility_id",
-    "output_location_id",
-    # "station_id",  # in industry/jobs, double check if this can be a cit
-]
 
 RAW_ID_KEYS = [
     re.compile(r".*/alliances/(?P<alliance_id>[0-9]+)/corporations/$"),
@@ -423,7 +487,16 @@ def _recurse_for_ids(data):
 
     ids = []
 
-    if isinstance(data, dict):
+    if columnar.is_columnar(data):
+        for key in data["columns"]:
+            if key in ID_KEYS:
+                ids.extend(
+                    x for x in columnar.column(data, key) if isinstance(x, int)
+                )
+            else:
+                ids.extend(_recurse_for_ids(columnar.column(data, key)))
+
+    elif isinstance(data, dict):
         for key, val in data.items():
             if isinstance(val, int) and key in ID_KEYS:
                 ids.append(val)
@@ -456,7 +529,19 @@ def _get_all_ids(results):
 def _recurse_apply_ids(data, ids):
     """Apply name keys for found ids."""
 
-    if isinstance(data, dict):
+    if columnar.is_columnar(data):
+        for key in list(data["columns"]):
+            values = columnar.column(data, key)
+            if key in ID_KEYS:
+                names = [
+                    ids.get(x) if isinstance(x, int) else None for x in values
+                ]
+                if any(x is not None for x in names):
+                    columnar.add_column(data, "{}_name".format(key), names)
+            else:
+                _recurse_apply_ids(values, ids)
+
+    elif isinstance(data, dict):
         for key in list(data.keys()):
             if isinstance(data[key], int):
                 if key in ID_KEYS and data[key] in ids:
@@ -481,28 +566,63 @@ def _apply_all_ids(results, ids):
                     if item in ids:
                         new_item["name"] = ids[item]
                     normalized.append(new_item)
-                results[route] = normalized
+                results[route] = columnar.compact(normalized)
                 break
         else:
-            _recurse_apply_ids(results[route], ids)
+            # results may be spooled, set the named copy back
+            data = results[route]
+            _recurse_apply_ids(data, ids)
+            results[route] = data
 
 
-def _get_names(ids):
-    """Resolve ids to names."""
+def _get_names(ids, known=None, trace=tracing.NULL, retries=None):
+    """Resolve ids to names.
 
-    resolved = {}
-    failed = []
-    for i in range(0, len(ids), 1000):
-        batch = ids[i:i+1000]
-        _, _, res = utils.request_or_wait(
-            "{}/latest/universe/names/".format(ESI),
+    Static data IDs are named from the SDE table if there is one, see
+    esi_knife.sde. ESI fails a whole batch if any ID in it can't be
+    resolved, batches it rejects are split until the bad IDs are found.
+    Other failures have already been retried by request_or_wait, their IDs
+    are left unnamed.
+
+    Args:
+        ids: list of integer IDs
+        known: optional dictionary of {id: name}, updated with new names
+        trace: tracing.Trace to record the requests in
+        retries: retry.Budget of the job
+    """
+
+    if known is None:
+        known = {}
+
+    names_url = "{}/latest/universe/names/".format(ESI)
+    resolved = {x: known[x] for x in ids if x in known}
+    resolved.update(sde.NAMES.names(x for x in ids if x not in resolved))
+    ids = [x for x in ids if x not in resolved]
+
+    def _post(batch):
+        """Resolve a batch, returning True if ESI rejected it."""
+
+        meta = {}
+        _, _, res = trace.wrap(utils.request_or_wait, names_url)(
+            names_url,
             method="post",
             json=batch,
+            _meta=meta,
+            _retries=retries,
         )
         if isinstance(res, list):
             for _res in res:
                 resolved[_res["id"]] = _res["name"]
-        else:
+            return False
+        if isinstance(meta.get("error"), int) and 400 <= meta["error"] < 500:
+            return True
+        LOG.warning("failed to resolve %d ids: %s", len(batch), res)
+        return False
+
+    failed = []
+    for i in range(0, len(ids), 1000):
+        batch = ids[i:i+1000]
+        if _post(batch):
             failed.extend(batch)
 
     while failed:
@@ -511,16 +631,7 @@ def _get_names(ids):
         batch_size = max(min(int(len(failed) / 2), 500), 1)
         for i in range(0, len(failed), batch_size):
             batch = failed[i:i+batch_size]
-
-            _, _, res = utils.request_or_wait(
-                "{}/latest/universe/names/".format(ESI),
-                method="post",
-                json=batch,
-            )
-            if isinstance(res, list):
-                for _res in res:
-                    resolved[_res["id"]] = _res["name"]
-            else:
+            if _post(batch):
                 still_failed.extend(batch)
 
         failed = still_failed
@@ -529,37 +640,100 @@ def _get_names(ids):
             LOG.warning("failed to resolve: %r", still_failed)
             break
 
+    known.update(resolved)
     return resolved
 
 
-def _add_names(results):
+def _add_names(results, known=None, trace=tracing.NULL, retries=None):
     """Best-effort resolve IDs to names."""
 
-    _apply_all_ids(results, _get_names(_get_all_ids(results)))
+    _apply_all_ids(results, _get_names(
+        _get_all_ids(results),
+        known=known,
+        trace=trace,
+        retries=retries,
+    ))
+
+
+def get_results(public, character_id,  # pylint: disable=R0913,R0914
+                scopes, roles, headers, report=_no_progress, scheduler=None,
+                snapshot=None, trace=tracing.NULL, budget=None, profile=None,
+                retries=None):
+    """Expand parameters and fetch all results.
+
+    A Scheduler can be provided to share requests and names between jobs,
+    otherwise one is created for this job. With a Snapshot, routes it can
+    reuse are left out of the results. Requests are recorded in the trace.
+    The job is kept within the cost.Budget, fetching what the named
+    cost.PROFILES profile (or the configured one) includes. Failed requests
+    are retried from the job's retry.Budget, a new one if not provided.
+
+    Returns:
+        Spool of {url: data}, the caller should close it when done
+    """
 
+    if scheduler is None:
+        with Scheduler() as job_scheduler:
+            return get_results(
+                public,
+                character_id,
+                scopes,
+                roles,
+                headers,
+                report=report,
+                scheduler=job_scheduler,
+                snapshot=snapshot,
+                trace=trace,
+                budget=budget,
+                profile=profile,
+                retries=retries,
+            )
 
-def get_results(public, character_id, scopes, roles, headers):
-    """Expand parameters and fetch all results."""
+    if retries is None:
+        retries = retry.Budget()
 
     all_params = copy.deepcopy(ADDITIONAL_PARAMS)
 
     known_params = {"character_id": character_id}
 
-    if public["corporation_id"] > 2000000:
+    fetching = cost.profile(profile)
+    if public["corporation_id"] > 2000000 and fetching["corporation"]:
         known_params["corporation_id"] = public["corporation_id"]
     else:
         all_params.pop("corporation_id")
 
-    if "alliance_id" in public:
+    if "alliance_id" in public and fetching["alliance"]:
         known_params["alliance_id"] = public["alliance_id"]
 
-    results = _get_all_data(scopes, roles, known_params, all_params, headers)
-    _add_names(results)
+    results = _get_all_data(
+        scopes,
+        roles,
+        known_params,
+        all_params,
+        headers,
+        scheduler,
+        report=report,
+        snapshot=snapshot,
+        trace=trace,
+        budget=budget,
+        retries=retries,
+    )
+    report(phase="names")
+    try:
+        _add_names(
+            results,
+            known=scheduler.names,
+            trace=trace,
+            retries=retries,
+        )
+    except Exception:
+        results.close()
+        raise
     return results
 
 
-def knife(uuid, token, verify, roles):  # pylint: disable=R0914
-    """Pull all ESI data for a character_id.
+def knife(uuid, token, verify, roles):
+    """Pull all ESI data for a character_id, releasing its flight if we fail.
 
     Args:
         uuid: string uuid token
@@ -568,26 +742,110 @@ def knife(uuid, token, verify, roles):  # pylint: disable=R0914
         roles: list of corporation roles
     """
 
+    flight_key = _flight_key(verify, roles)
+    trace = tracing.new(uuid)
+    try:
+        _knife(uuid, token, verify, roles, flight_key, trace)
+    except Exception:
+        CACHE.delete("{}{}".format(Keys.inflight.value, flight_key))
+        raise
+    finally:
+        trace.save()
+
+
+def _finish(batch, uuid, flight_key):
+    """Run a job's final batch, releasing the job even if it fails.
+
+    Returns:
+        boolean True if the batch ran
+    """
+
+    try:
+        batch.execute()
+    except Exception as error:
+        LOG.warning("failed to complete %s: %r", uuid, error)
+    else:
+        return True
+
+    try:
+        CACHE.delete_many(
+            "{}{}".format(Keys.processing.value, uuid),
+            "{}{}".format(Keys.inflight.value, flight_key),
+        )
+    except Exception as error:
+        LOG.warning("failed to release %s: %r", uuid, error)
+    return False
+
+
+def _knife(uuid, token, verify, roles,  # pylint: disable=R0913,R0914
+           flight_key, trace):
+    """Pull all ESI data for a character_id."""
+
     character_id = verify["CharacterID"]
     LOG.info("knife run started for character: %s", character_id)
+    report = trace.reporter(progress.reporter(uuid))
+    report(phase="public")
 
     scopes = verify["Scopes"]
 
-    _, _, public = utils.request_or_wait(
-        "{}/latest/characters/{}/".format(ESI, character_id)
-    )
+    public_url = "{}/latest/characters/{}/".format(ESI, character_id)
+    _, _, public = trace.wrap(utils.request_or_wait, public_url)(public_url)
+
+    processing_key = "{}{}".format(Keys.processing.value, uuid)
 
     if isinstance(public, str):
-        CACHE.delete("{}{}".format(Keys.processing.value, uuid))
-        utils.write_data(uuid, {"public info failure": public})
+        batch = utils.Batch()
+        utils.write_data(uuid, {"public info failure": public}, batch=batch)
+        batch.delete(
+            processing_key,
+            "{}{}".format(Keys.inflight.value, flight_key),
+        )
+        _finish(batch, uuid, flight_key)
+        report(phase="complete")
         return
 
     headers = {"Authorization": "Bearer {}".format(token)}
-    results = get_results(public, character_id, scopes, roles, headers)
+    snapshot = Snapshot.load(character_id)
+    results = get_results(
+        public,
+        character_id,
+        scopes,
+        roles,
+        headers,
+        report=report,
+        snapshot=snapshot,
+        trace=trace,
+    )
 
-    utils.write_data(uuid, results)
-    CACHE.delete("{}{}".format(Keys.processing.value, uuid))
-    CACHE.cache.inc(Keys.alltime.value, 1)
+    report(phase="compress")
+    with results:
+        batch = utils.Batch()
+        stored = utils.write_data(
+            uuid,
+            results,
+            batch=batch,
+            reuse=snapshot.reuse_hashes(),
+        )
+        batch.delete(
+            processing_key,
+            "{}{}".format(Keys.inflight.value, flight_key),
+        )
+        if DEDUPE_WINDOW > 0:
+            batch.set(
+                "{}{}".format(Keys.recent.value, flight_key),
+                uuid,
+                timeout=DEDUPE_WINDOW,
+            )
+        batch.inc(Keys.alltime.value)
+        if not _finish(batch, uuid, flight_key):
+            stored = None
+    snapshot.save(stored)
+    report(phase="complete")
+    LOG.info(
+        "character %r reused %d routes",
+        character_id,
+        len(snapshot.reused),
+    )
     LOG.info("completed character: %r", character_id)
 
 
@@ -595,11 +853,14 @@ def main():
     """Main worker entrypoint."""
 
     LOG.info("knife worker online")
+    profiler.install()
+    transport.warm_up(utils.SESSION)
 
     # until we can resume jobs
-    for state in (Keys.processing.value, Keys.pending.value):
-        CACHE.delete_many(*utils.list_keys(state))
+    for state in (Keys.processing, Keys.pending, Keys.inflight):
+        CACHE.delete_many(*utils.list_keys(state.value))
 
+    last_demotion = 0
     while True:
         prune = []
 
@@ -616,7 +877,17 @@ def main():
         for glet in prune:
             WORKERS.remove(glet)
 
+        if prune:
+            # job memory is bounded, but release finished jobs' garbage
+            gc.collect()
+
         process_new()
 
-        gc.collect()
+        if time.time() - last_demotion > storage.DEMOTE_INTERVAL:
+            last_demotion = time.time()
+            try:
+                storage.demote_idle()
+            except Exception as error:
+                LOG.warning("failed to demote idle results: %r", error)
+
         gevent.sleep(10)
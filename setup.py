@@ -37,6 +37,7 @@ setup(
         "console_scripts": [
             "knife = esi_knife.cli:main",
             "knife-worker = esi_knife.worker:main",
+            "knife-sde = esi_knife.sde:main",
         ],
     },
     install_requires=[
@@ -60,6 +61,8 @@ setup(
     ],
     extras_require={
         "deploy": ["gunicorn"],
+        "s3": ["boto3"],
+        "http2": ["httpx[http2]"],
         ":python_version < '3'": ["enum34", "futures"],
     },
     include_package_data=True,
@@ -70,6 +73,6 @@ setup(
             os.listdir(os.path.join("esi_knife", "templates"))
         ],
     },
-    packages=find_packages(),
+    packages=find_packages(exclude=["bench"]),
     long_description=long_description,
 )